@@ -2,26 +2,89 @@ from __future__ import unicode_literals
 
 import os
 import re
-import shutil
-import mimetypes
+import sys
+import errno
+import time
+import base64
+import hashlib
 import logging
 
+from collections import OrderedDict
+from timeit import default_timer
+
+import six
 from six.moves.urllib.parse import quote
 
-from django.conf import settings
+# Note: the bundled test project's settings module is django_transfer.settings.
+# Importing it replaces this package's "settings" attribute, so settings are
+# always read through django.conf.
+from django import conf
+from django.dispatch import receiver
+try:
+    from django.core.signals import setting_changed
+except ImportError:
+    # Django < 1.8
+    from django.test.signals import setting_changed
 try:
     from django.http import StreamingHttpResponse
 except:
     from django.http import HttpResponse as StreamingHttpResponse
-from django.core.files.uploadedfile import UploadedFile
-from django.core.exceptions import ImproperlyConfigured
+from django.core.files.uploadedfile import UploadedFile, TemporaryUploadedFile
+from django.core.exceptions import ImproperlyConfigured, SuspiciousOperation
+from django.http import QueryDict
+from django.utils.datastructures import MultiValueDict
+from django.utils.http import http_date
 from django.http.multipartparser import MultiPartParserError
+try:
+    from django.utils.module_loading import import_string
+except ImportError:
+    # Django < 1.7
+    from django.utils.module_loading import import_by_path as import_string
 
 try:
     from django.utils.deprecation import MiddlewareMixin
 except ImportError:
     MiddlewareMixin = object
 
+from django_transfer.cache import LRUCache, StatCache
+from django_transfer.archive import ZipStream, split_item
+from django_transfer.files import move_file
+from django_transfer.checksums import ALGORITHMS, new_hasher, hash_file
+from django_transfer.parser import load_form, parse_disposition
+from django_transfer.mime import MimeResolver
+from django_transfer.ratelimit import TokenBucket, parse_limit_rate
+from django_transfer.resumable import ResumableUploads, resumable_upload
+from django_transfer.streaming import FileIterator, MultipartFileIterator
+from django_transfer.streaming import make_etag, is_not_modified
+from django_transfer.streaming import if_range_matches, parse_ranges
+
+
+def is_asgi_request(request):
+    return False
+
+
+class AsyncMiddlewareMixin(object):
+    "Replaced by django_transfer.asgi's when ASGI is supported."
+    pass
+
+
+# ASGI support needs Python 3.6 and Django 3.0.
+if sys.version_info >= (3, 6):
+    try:
+        from django_transfer.asgi import AsyncMiddlewareMixin
+        from django_transfer.asgi import AsyncFileIterator
+        from django_transfer.asgi import AsyncMultipartFileIterator
+        from django_transfer.asgi import is_asgi_request
+    except ImportError:
+        # Django < 3.0
+        pass
+
+try:
+    # Registers the system checks.
+    from django_transfer import checks
+except ImportError:
+    # Django < 1.7
+    pass
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.NullHandler())
@@ -36,140 +99,943 @@ SERVER_HEADERS = {
     SERVER_LIGHTTPD: 'X-SendFile',
 }
 
-# Default to POST method only. Can be overridden in settings.
-UPLOAD_METHODS = getattr(settings, 'TRANSFER_UPLOAD_METHODS', ('POST',))
-# Default to whitelist all paths.
-UPLOAD_ACL = getattr(settings, 'TRANSFER_UPLOAD_ACL', ((), ()))
+# nginx response headers that tune how X-Accel-Redirect is served.
+ACCEL_HEADERS = {
+    'buffering': 'X-Accel-Buffering',
+    'limit_rate': 'X-Accel-Limit-Rate',
+    'expires': 'X-Accel-Expires',
+    'charset': 'X-Accel-Charset',
+}
+
+# Header asking nginx's mod_zip to build an archive from the response body.
+ARCHIVE_HEADER = 'X-Archive-Files'
+
+# Attributes that mark a field[attribute] as a file stored by nginx's upload
+# module. Others (size, content type, checksums) are only read for those, so
+# ordinary fields named like them are left alone.
+UPLOAD_ATTRIBUTES = frozenset(('filename]', 'path]'))
+
+# Number of recent paths whose ACL verdict is remembered.
+ACL_CACHE_SIZE = 1024
+# Number of recent paths whose header value is remembered.
+HEADER_CACHE_SIZE = 4096
+# Read size used when Django sends file contents itself.
+CHUNK_SIZE = 64 * 1024
+
+
+def compile_patterns(patterns):
+    """
+    Compiles re.match() patterns into as few regular expressions as possible.
+
+    Patterns are joined into a single alternation unless they contain groups
+    or inline flags, which would change meaning once combined. Those are
+    compiled on their own.
+    """
+    combined, separate = [], []
+    for pattern in patterns:
+        regex = re.compile(pattern)
+        if regex.groups or regex.flags & ~re.UNICODE:
+            separate.append(regex)
+        else:
+            combined.append('(?:%s)' % regex.pattern)
+    if combined:
+        separate.insert(0, re.compile('|'.join(combined)))
+    return separate
+
+
+class UploadACL(object):
+    """
+    Compiled form of settings.TRANSFER_UPLOAD_ACL.
+
+    The verdicts for recently checked paths are cached, so hot endpoints skip
+    regular expression matching entirely.
+    """
+    def __init__(self, acl, cache_size=ACL_CACHE_SIZE):
+        white, black = acl
+        self.white = compile_patterns(white)
+        self.black = compile_patterns(black)
+        self.verdicts = LRUCache(cache_size)
+
+    def check(self, path):
+        path = path.lstrip('/')
+        allow = self.verdicts.get(path)
+        if allow is None:
+            allow = self.match(path)
+            self.verdicts.set(path, allow)
+        return allow
+
+    def match(self, path):
+        # An empty whitelist allows all paths.
+        if self.white:
+            if not any(regex.match(path) for regex in self.white):
+                return False
+        if self.black:
+            if any(regex.match(path) for regex in self.black):
+                return False
+        return True
+
+
+def get_accel_headers(options):
+    "Formats nginx X-Accel-* tuning options as headers, skipping None."
+    headers = {}
+    for name, value in options.items():
+        try:
+            header = ACCEL_HEADERS[name]
+        except KeyError:
+            raise ImproperlyConfigured('Invalid X-Accel option "%s"' % name)
+        if value is None:
+            continue
+        if value is True:
+            value = 'yes'
+        elif value is False:
+            value = 'no' if name == 'buffering' else 'off'
+        headers[header] = six.text_type(value)
+    return headers
+
+
+class MappingIndex(object):
+    """
+    Maps filesystem paths to nginx internal locations.
+
+    Built once from settings.TRANSFER_MAPPINGS. A lookup walks up the
+    components of the path until it finds a configured root, so it costs
+    O(path depth) no matter how many mappings exist, and the longest
+    matching root always wins.
+
+    A mapping is either the location, or a dict with a "location" key and
+    default X-Accel-* options for files under that root.
+    """
+    def __init__(self, mappings):
+        self.roots = {}
+        for root, location in mappings.items():
+            headers = {}
+            if isinstance(location, dict):
+                options = dict(location)
+                try:
+                    location = options.pop('location')
+                except KeyError:
+                    raise ImproperlyConfigured('Please specify a location for '
+                                               'mapping "%s"' % root)
+                headers = get_accel_headers(options)
+            self.roots[os.path.normpath(root)] = (location.rstrip('/'),
+                                                  headers)
+
+    def __len__(self):
+        return len(self.roots)
+
+    def resolve(self, path):
+        """
+        Returns the internal location for path and the X-Accel-* headers
+        configured for its root, or (None, None) if path is unmapped.
+        """
+        path = head = os.path.normpath(path)
+        while True:
+            mapping = self.roots.get(head)
+            if mapping is not None:
+                break
+            parent = os.path.dirname(head)
+            if parent == head:
+                return None, None
+            head = parent
+        location, headers = mapping
+        tail = path[len(head):].lstrip('/')
+        if not tail:
+            return location or '/', headers
+        return '%s/%s' % (location, tail), headers
+
+    def lookup(self, path):
+        "Returns the internal location for path, or None if unmapped."
+        return self.resolve(path)[0]
+
+    def find_root(self, path):
+        "Returns the configured root path is under, or None."
+        head = os.path.normpath(path)
+        while head not in self.roots:
+            parent = os.path.dirname(head)
+            if parent == head:
+                return None
+            head = parent
+        return head
+
+    def resolve_many(self, paths):
+        """
+        Like resolve(), for each of paths. Paths in the same directory share
+        a single lookup.
+        """
+        directories = {}
+        for path in paths:
+            path = os.path.normpath(path)
+            if path in self.roots:
+                yield self.resolve(path)
+                continue
+            directory, name = os.path.split(path)
+            mapping = directories.get(directory)
+            if mapping is None:
+                mapping = directories[directory] = self.resolve(directory)
+            location, headers = mapping
+            if location is None or not name:
+                yield None, None
+            else:
+                yield '%s/%s' % (location.rstrip('/'), name), headers
+
+
+class SecureLink(object):
+    """
+    Signs internal locations for nginx's secure_link module.
+
+    Signed locations get "v", "md5" and "expires" arguments, to be checked
+    with:
+
+        secure_link $arg_md5,$arg_expires;
+        secure_link_md5 "$secure_link_expires$uri$arg_v <secret>";
+
+    "v" identifies the version of the file (its modification time and size).
+    Expiry times are rounded up so that a location signed during one ttl
+    window stays the same, and valid for at least ttl seconds. Together they
+    make signed locations safe to cache.
+    """
+    def __init__(self, secret, ttl=3600):
+        self.secret = secret
+        self.ttl = ttl
+
+    def get_expires(self, now):
+        return (int(now) // self.ttl + 2) * self.ttl
+
+    def sign(self, location, stat, now):
+        """
+        Returns location with the signature arguments, and the time until
+        which it can be reused.
+        """
+        expires = self.get_expires(now)
+        version = make_etag(stat).strip('"')
+        digest = hashlib.md5(('%d%s%s %s' % (
+            expires, location, version, self.secret)).encode('utf-8')).digest()
+        token = base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+        value = '%s?v=%s&md5=%s&expires=%d' % (quote(location.encode('utf-8')),
+                                              version, token, expires)
+        return value, expires - self.ttl
+
+
+class TransferConfig(object):
+    """
+    The transfer settings, resolved once.
+
+    Reading Django settings goes through a proxy object on every access. The
+    values needed on each request are looked up here once instead, and the
+    config is rebuilt when the setting_changed signal fires.
+    """
+    __slots__ = ('enabled', 'server', 'header_name', 'mappings',
+                 'upload_methods', 'upload_acl', 'upload_checksums',
+                 'upload_checksums_trusted', 'chunk_size', 'mime', 'header_cache', 'secure_link',
+                 'limit_rate', 'rate_limiter', 'resumable',
+                 'upload_file_header', 'upload_file_field', 'upload_temp_dir',
+                 'stat_cache')
+
+    def __init__(self, settings):
+        server = getattr(settings, 'TRANSFER_SERVER', None)
+        # Allow user to customize the header, otherwise it depends on the
+        # configured server type.
+        header_name = getattr(settings, 'TRANSFER_HEADER', None)
+        if header_name is None:
+            header_name = SERVER_HEADERS.get(server)
+        mappings = getattr(settings, 'TRANSFER_MAPPINGS', None)
+        if mappings is not None:
+            mappings = MappingIndex(mappings)
+        enabled = server is not None
+        if not hasattr(settings, 'ENABLE_TRANSFER') and settings.DEBUG:
+            enabled = False
+        header_cache = None
+        cache_size = getattr(settings, 'TRANSFER_HEADER_CACHE_SIZE',
+                             HEADER_CACHE_SIZE)
+        if cache_size:
+            header_cache = LRUCache(cache_size)
+        secure_link = getattr(settings, 'TRANSFER_SECURE_LINK', None)
+        if secure_link is not None:
+            secure_link = SecureLink(**secure_link)
+        # The limit of all fallback downloads of this process together.
+        rate_limiter = parse_limit_rate(getattr(
+            settings, 'TRANSFER_GLOBAL_LIMIT_RATE', None))
+        if rate_limiter is not None:
+            rate_limiter = TokenBucket(rate_limiter)
+        resumable = getattr(settings, 'TRANSFER_RESUMABLE_UPLOADS', None)
+        if resumable is not None:
+            resumable = ResumableUploads(**resumable)
+        # The request header nginx puts $request_body_file in, as a META key.
+        upload_file_header = getattr(settings, 'TRANSFER_UPLOAD_FILE_HEADER',
+                                     None)
+        if upload_file_header is not None:
+            upload_file_header = 'HTTP_%s' % upload_file_header.upper() \
+                .replace('-', '_')
+        stat_cache = getattr(settings, 'TRANSFER_STAT_CACHE', None)
+        if stat_cache is True:
+            stat_cache = {}
+        if stat_cache is not None:
+            stat_cache = StatCache(**stat_cache)
+        upload_temp_dir = getattr(settings, 'TRANSFER_UPLOAD_TEMP_DIR', None)
+        if upload_temp_dir:
+            upload_temp_dir = os.path.join(os.path.normpath(upload_temp_dir),
+                                           '')
+        values = {
+            'enabled': enabled,
+            'server': server,
+            'header_name': header_name,
+            'mappings': mappings,
+            # Default to POST method only.
+            'upload_methods': frozenset(getattr(
+                settings, 'TRANSFER_UPLOAD_METHODS', ('POST',))),
+            # Default to whitelist all paths.
+            'upload_acl': UploadACL(getattr(
+                settings, 'TRANSFER_UPLOAD_ACL', ((), ()))),
+            'upload_checksums': tuple(getattr(
+                settings, 'TRANSFER_UPLOAD_CHECKSUMS', ())),
+            # Checksum fields may come from the client unless nginx strips
+            # them, don't rely on them by default.
+            'upload_checksums_trusted': bool(getattr(
+                settings, 'TRANSFER_TRUST_UPLOAD_CHECKSUMS', False)),
+            'chunk_size': getattr(settings, 'TRANSFER_CHUNK_SIZE', CHUNK_SIZE),
+            'mime': MimeResolver(getattr(settings, 'TRANSFER_MIME_TYPES', None),
+                                 getattr(settings, 'TRANSFER_MIME_SNIFF',
+                                         False)),
+            'header_cache': header_cache,
+            'secure_link': secure_link,
+            'limit_rate': getattr(settings, 'TRANSFER_LIMIT_RATE', None),
+            'rate_limiter': rate_limiter,
+            'resumable': resumable,
+            'upload_file_header': upload_file_header,
+            'upload_file_field': getattr(settings, 'TRANSFER_UPLOAD_FILE_FIELD',
+                                         'file'),
+            'upload_temp_dir': upload_temp_dir or None,
+            'stat_cache': stat_cache,
+        }
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('TransferConfig is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('TransferConfig is immutable')
+
+
+_CONFIG = None
+# The metrics backend, False until it is loaded. It is kept apart from the
+# config so that changes to other settings don't reset its values.
+_METRICS = False
+
+
+def get_config():
+    global _CONFIG
+    config = _CONFIG
+    if config is None:
+        config = _CONFIG = TransferConfig(conf.settings)
+    return config
+
+
+def get_metrics():
+    "Returns the metrics backend, or None if metrics are disabled."
+    global _METRICS
+    metrics = _METRICS
+    if metrics is False:
+        settings = conf.settings
+        metrics = getattr(settings, 'TRANSFER_METRICS', None)
+        if metrics is not None:
+            metrics = import_string(metrics)(**getattr(
+                settings, 'TRANSFER_METRICS_OPTIONS', {}))
+        _METRICS = metrics
+    return metrics
+
+
+@receiver(setting_changed)
+def reset_config(setting, **kwargs):
+    global _CONFIG, _METRICS
+    if setting.startswith('TRANSFER_') or \
+       setting in ('DEBUG', 'ENABLE_TRANSFER'):
+        _CONFIG = None
+    if setting in ('TRANSFER_METRICS', 'TRANSFER_METRICS_OPTIONS'):
+        _METRICS = False
 
 
 def get_server_name():
-    try:
-        return settings.TRANSFER_SERVER
-    except AttributeError:
+    server_name = get_config().server
+    if server_name is None:
         raise ImproperlyConfigured('Please specify settings.TRANSFER_SERVER')
+    return server_name
 
 
 def get_header_name():
-    # Allow user to customize.
-    try:
-        return settings.TRANSFER_HEADER
-    except AttributeError:
-        pass
-    # Otherwise the header depends on the configured server type.
-    server_name = get_server_name()
-    try:
-        return SERVER_HEADERS[server_name]
-    except KeyError:
+    header_name = get_config().header_name
+    if header_name is None:
         raise ImproperlyConfigured('Invalid server name "%s" for '
-                                   'settings.TRANSFER_SERVER' % server_name)
+                                   'settings.TRANSFER_SERVER' %
+                                   get_server_name())
+    return header_name
 
 
 def is_enabled():
-    if not hasattr(settings, 'ENABLE_TRANSFER'):
-        if settings.DEBUG:
-            return False
+    return get_config().enabled
 
-    if getattr(settings, 'TRANSFER_SERVER', None) is None:
-        return False
 
-    return True
+def check_acl(path):
+    return get_config().upload_acl.check(path)
 
 
-def check_acl(path):
-    path = path.lstrip('/')
-    white, black = UPLOAD_ACL
-    allow = True
-    if white:
-        allow = False
-        for pattern in white:
-            if re.match(pattern, path):
-                allow = True
-                break
-    if black:
-        for pattern in black:
-            if re.match(pattern, path):
-                allow = False
-                break
-    return allow
+def get_mapping_index():
+    mappings = get_config().mappings
+    if mappings is None:
+        raise ImproperlyConfigured('Please specify settings.TRANSFER_MAPPINGS')
+    return mappings
 
 
-def get_header_value(path):
+def stat_file(path):
+    "Returns os.stat(path), through the stat cache if it is enabled."
+    cache = get_config().stat_cache
+    if cache is None:
+        return os.stat(path)
+    stat = cache.stat(path)
+    if stat is None:
+        raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+    return stat
+
+
+def get_limit_rate(path, limit_rate=None):
+    """
+    Returns the bytes per second a fallback download of path is limited to,
+    or None. Like nginx's X-Accel-Limit-Rate, limit_rate wins over the
+    mapping of path, which wins over TRANSFER_LIMIT_RATE.
+    """
+    if limit_rate is None:
+        config = get_config()
+        if config.mappings is not None:
+            headers = config.mappings.resolve(path)[1] or {}
+            limit_rate = headers.get(ACCEL_HEADERS['limit_rate'])
+        if limit_rate is None:
+            limit_rate = config.limit_rate
+    return parse_limit_rate(limit_rate)
+
+
+def resolve_header(path):
+    """
+    Returns the header value for path, and the default X-Accel-* headers of
+    its mapping when the server is nginx.
+
+    Results are cached per path. Signed locations depend on the file, they
+    are reused until the file changes or the signature has to be renewed.
+    """
+    config = get_config()
+    cache = config.header_cache
+    signer = config.secure_link if config.server == SERVER_NGINX else None
+    entry = None if cache is None else cache.get(path)
+    if signer is None:
+        if entry is not None:
+            return entry
+    else:
+        now = time.time()
+        stat = stat_file(path)
+        signature = (stat.st_ino, stat.st_size, stat.st_mtime)
+        if entry is not None and entry[2] == signature and now < entry[3]:
+            return entry[:2]
+    headers = {}
+    location = path
     if get_server_name() == SERVER_NGINX:
-        try:
-            mappings = settings.TRANSFER_MAPPINGS
-        except AttributeError:
-            raise ImproperlyConfigured('Please specify settings.TRANSFER_MAPPINGS')
-        found = False
-        for root, location in mappings.items():
-            if path.startswith(root):
-                found = True
-                path = os.path.relpath(path, root).strip('/')
-                path = os.path.join(location, path)
-                break
-        if not found:
+        location, headers = get_mapping_index().resolve(path)
+        if location is None:
             raise ImproperlyConfigured('Cannot map path "%s"' % path)
-    return quote(path.encode('utf-8'))
+    if signer is None:
+        entry = (quote(location.encode('utf-8')), headers)
+    else:
+        value, until = signer.sign(location, stat, now)
+        entry = (value, headers, signature, until)
+    if cache is not None:
+        cache.set(path, entry)
+    return entry[:2]
+
+
+def get_header_value(path):
+    return resolve_header(path)[0]
+
+
+def get_metric_labels(path):
+    "Returns the labels of metrics about path."
+    config = get_config()
+    root = None
+    if config.mappings is not None:
+        root = config.mappings.find_root(path)
+    return {'server': config.server or '', 'root': root or ''}
+
+
+def resolve_transfer_paths(paths):
+    """
+    Resolves the header values and content types of many paths at once.
+
+    Returns a tuple (resolved, unmapped). resolved is an OrderedDict of the
+    paths that could be mapped (all of them unless the server is nginx), in
+    order, to (header value, content type) tuples. unmapped lists the
+    others.
+    """
+    config = get_config()
+    paths = list(paths)
+    if get_server_name() == SERVER_NGINX:
+        locations = get_mapping_index().resolve_many(paths)
+        signer = config.secure_link
+    else:
+        locations = ((path, None) for path in paths)
+        signer = None
+    now = time.time()
+    resolved, unmapped = OrderedDict(), []
+    # Quoted directories, files in the same one share most of their value.
+    directories = {}
+    for path, (location, headers) in zip(paths, locations):
+        if location is None:
+            unmapped.append(path)
+            continue
+        if signer is None:
+            head, sep, tail = location.rpartition('/')
+            prefix = directories.get(head)
+            if prefix is None:
+                prefix = directories[head] = quote(head.encode('utf-8'))
+            value = prefix + sep + quote(tail.encode('utf-8'))
+        else:
+            value = signer.sign(location, stat_file(path), now)[0]
+        resolved[path] = (value, config.mime.guess(path))
+    return resolved, unmapped
 
 
 class TransferHttpResponse(StreamingHttpResponse):
+    # The iterator over the file when its contents are sent by Django.
+    file_iterator = None
+    # The metrics backend and labels, until the response is closed.
+    metrics = None
+    # Whether the stat cache found the file missing.
+    missing = False
+
     def __init__(self, path, mimetype=None, status=None,
-                 content_type=None):
+                 content_type=None, request=None, accel_buffering=None,
+                 accel_limit_rate=None, accel_expires=None,
+                 accel_charset=None):
         if mimetype:
             content_type = mimetype
+        config = get_config()
         if content_type is None:
-            content_type = mimetypes.guess_type(path)[0]
-        enabled = is_enabled()
-        if enabled:
-            # Don't send content, we will instead send a header.
-            content = ''
-        else:
-            # Fall back to sending file contents via Django HttpResponse.
-            content = open(path, 'rb')
-        super(TransferHttpResponse, self).__init__(content, status=status,
+            content_type = config.mime.guess(path)
+        enabled = config.enabled
+        # Don't send content, we will either send a header, or the file
+        # contents once the superclass is initialized.
+        super(TransferHttpResponse, self).__init__('', status=status,
                                                    content_type=content_type)
-        if enabled:
+        if not enabled:
+            # Fall back to sending file contents via Django HttpResponse.
+            self.stream_file(path, content_type, config.chunk_size, request,
+                             get_limit_rate(path, accel_limit_rate))
+        elif config.stat_cache is None or \
+                self.set_metadata(path, config.stat_cache, request):
             # Now that the superclass is initialized, we can add our header.
-            self[get_header_name()] = get_header_value(path)
+            value, accel = resolve_header(path)
+            self[get_header_name()] = value
+            if config.server == SERVER_NGINX:
+                # Explicit arguments win over the mapping's defaults, which
+                # win over the settings.
+                headers = get_accel_headers({'limit_rate': config.limit_rate})
+                headers.update(accel)
+                headers.update(get_accel_headers({
+                    'buffering': accel_buffering,
+                    'limit_rate': accel_limit_rate,
+                    'expires': accel_expires,
+                    'charset': accel_charset,
+                }))
+                for name, value in headers.items():
+                    self[name] = value
+        metrics = get_metrics()
+        if metrics is not None and not self.missing:
+            labels = get_metric_labels(path)
+            metrics.increment('transfer_responses_total',
+                              mode='offload' if enabled else 'fallback',
+                              **labels)
+            self.metrics = (metrics, labels)
 
+    def close(self):
+        super(TransferHttpResponse, self).close()
+        if self.metrics is None or self.file_iterator is None:
+            return
+        (metrics, labels), self.metrics = self.metrics, None
+        sent = self.file_iterator.sent
+        file = getattr(self, 'file_to_stream', None)
+        if file is not None and getattr(file, 'close', None) == self.close:
+            # Django's WSGI handler hooks the file up like this when it hands
+            # it to wsgi.file_wrapper, which sends all of it.
+            sent = int(self['Content-Length'])
+        metrics.increment('transfer_fallback_bytes_total', sent, **labels)
+
+    def set_metadata(self, path, cache, request=None):
+        """
+        Sets Content-Length, Last-Modified and ETag from the stat cache.
+
+        Returns whether the file should be sent. It is not when it is
+        missing (an empty 404, not counted as offloaded), or when the request is conditional and the client's
+        copy is current (304).
+        """
+        stat = cache.stat(path)
+        if stat is None:
+            # The response no longer describes the file.
+            self.missing = True
+            self.status_code = 404
+            self['Content-Type'] = 'text/plain; charset=%s' % self.charset
+            return False
+        etag = make_etag(stat)
+        self['ETag'] = etag
+        self['Last-Modified'] = http_date(stat.st_mtime)
+        if request is not None and self.status_code == 200 and \
+           request.method in ('GET', 'HEAD') and \
+           is_not_modified(request.META, etag, stat.st_mtime):
+            self.status_code = 304
+            return False
+        self['Content-Length'] = str(stat.st_size)
+        return True
 
-class ProxyUploadedFile(UploadedFile):
-    def __init__(self, path, name, content_type, size):
+    def stream_file(self, path, content_type, chunk_size, request=None,
+                    limit_rate=None):
+        """
+        Streams the file from Django.
+
+        When given the request, conditional (If-None-Match / If-Modified-Since)
+        and Range requests are honoured. Only the needed bytes, if any, are
+        sent. The file is read in a thread pool when the request came through
+        ASGI. The file is sent at no more than limit_rate bytes per second,
+        and within TRANSFER_GLOBAL_LIMIT_RATE.
+        """
+        iterator, multipart = FileIterator, MultipartFileIterator
+        if request is not None and is_asgi_request(request):
+            iterator = AsyncFileIterator
+            multipart = AsyncMultipartFileIterator
+        limiters = []
+        if limit_rate is not None:
+            limiters.append(TokenBucket(limit_rate))
+        rate_limiter = get_config().rate_limiter
+        if rate_limiter is not None:
+            limiters.append(rate_limiter)
+        file = open(path, 'rb')
+        stat = os.fstat(file.fileno())
+        size = stat.st_size
+        if request is not None and self.status_code == 200 and \
+           request.method in ('GET', 'HEAD'):
+            meta = request.META
+            etag = make_etag(stat)
+            self['ETag'] = etag
+            self['Last-Modified'] = http_date(stat.st_mtime)
+            self['Accept-Ranges'] = 'bytes'
+            if is_not_modified(meta, etag, stat.st_mtime):
+                file.close()
+                self.status_code = 304
+                return
+            ranges = None
+            if if_range_matches(meta, etag, stat.st_mtime):
+                ranges = parse_ranges(meta.get('HTTP_RANGE'), size)
+            if ranges is not None:
+                if not ranges:
+                    file.close()
+                    self.status_code = 416
+                    self['Content-Range'] = 'bytes */%d' % size
+                    self['Content-Length'] = '0'
+                    return
+                self.status_code = 206
+                if len(ranges) == 1:
+                    start, end = ranges[0]
+                    self.file_iterator = iterator(file, chunk_size, start,
+                                                  end - start + 1)
+                    self.file_iterator.limiters = limiters
+                    self['Content-Range'] = 'bytes %d-%d/%d' % (start, end,
+                                                                size)
+                    self['Content-Length'] = str(end - start + 1)
+                else:
+                    self.file_iterator = multipart(file, chunk_size, ranges,
+                                                   size, content_type)
+                    self.file_iterator.limiters = limiters
+                    self['Content-Type'] = self.file_iterator.content_type
+                    self['Content-Length'] = str(
+                        self.file_iterator.content_length)
+                self.streaming_content = self.file_iterator
+                return
+        self.file_iterator = iterator(file, chunk_size)
+        self.file_iterator.limiters = limiters
+        self.streaming_content = self.file_iterator
+        self['Content-Length'] = str(size)
+        if limiters:
+            # Only the iterator enforces the limits.
+            return
+        # The WSGI handler hands this to wsgi.file_wrapper when the server
+        # provides one, which typically uses os.sendfile().
+        self.file_to_stream = file
+        self.block_size = chunk_size
+
+
+class TransferZipResponse(StreamingHttpResponse):
+    """
+    Sends a ZIP archive of many files.
+
+    files is an iterable of paths, or of (path, name) tuples to choose the
+    name of each file in the archive. With nginx, the response is a mod_zip
+    manifest of the mapped locations and nginx assembles the archive.
+    Otherwise the archive is streamed by Django, uncompressed, reading one
+    chunk at a time.
+    """
+    def __init__(self, files, status=None, content_type='application/zip'):
+        config = get_config()
+        super(TransferZipResponse, self).__init__('', status=status,
+                                                  content_type=content_type)
+        if config.enabled and config.server == SERVER_NGINX:
+            self[ARCHIVE_HEADER] = 'zip'
+            self.streaming_content = self.manifest(files)
+        else:
+            content = ZipStream(files, config.chunk_size)
+            self.streaming_content = content
+            self['Content-Length'] = str(content.content_length)
+
+    def manifest(self, files):
+        "Returns the mod_zip manifest for files, one line per file."
+        files = [split_item(item) for item in files]
+        resolved, unmapped = resolve_transfer_paths(path for path, name in
+                                                    files)
+        if unmapped:
+            raise ImproperlyConfigured('Cannot map paths: %s' %
+                                       ', '.join(unmapped))
+        lines = []
+        for path, name in files:
+            # The CRC-32 is unknown, nginx computes it.
+            lines.append('- %d %s %s\n' % (stat_file(path).st_size,
+                                            resolved[path][0], name))
+        return lines
+
+
+class ProxyUploadedFile(TemporaryUploadedFile):
+    """
+    A file uploaded to the proxy server and stored at path.
+
+    The file is only opened when its contents are first accessed, so large
+    multi-file uploads don't hold a descriptor per file, and move() never
+    opens it at all. Like Django's own uploads stored on disk, it has a
+    temporary_file_path(), so storages move it instead of copying it.
+
+    checksums maps algorithms to the hex digests nginx computed. Digests of
+    the algorithms listed in track are computed as the file is read from
+    the start, so a view that reads the upload gets them for free.
+    """
+    def __init__(self, path, name, content_type, size, checksums=None,
+                 track=()):
         self.path = path
-        super(ProxyUploadedFile, self).__init__(open(path, 'rb'), name, content_type, size)
+        self._file = None
+        # TemporaryUploadedFile.__init__() would create a temporary file, the
+        # file already exists.
+        UploadedFile.__init__(self, None, name, content_type, size)
+        self.mode = 'rb'
+        self.checksums = dict(checksums or {})
+        # Digests sent with the form, not computed from the file.
+        self._claimed = set(self.checksums)
+        # The bytes up to _hashed have been fed to _hashers.
+        self._hashers = dict((algorithm, new_hasher(algorithm))
+                             for algorithm in track
+                             if algorithm not in self.checksums)
+        self._hashed = 0
+
+    def _get_file(self):
+        if self._file is None:
+            self._file = open(self.path, 'rb')
+        return self._file
+
+    def _set_file(self, file):
+        self._file = file
+
+    file = property(_get_file, _set_file)
+
+    @property
+    def closed(self):
+        return self._file is None or self._file.closed
+
+    def open(self, mode=None):
+        if not self.closed:
+            self.seek(0)
+        else:
+            self._file = open(self.path, mode or self.mode)
+        return self
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+    def temporary_file_path(self):
+        return self.path
+
+    def read(self, *args):
+        file = self.file
+        if not self._hashers:
+            return file.read(*args)
+        position = file.tell()
+        data = file.read(*args)
+        if position == self._hashed:
+            for hasher in self._hashers.values():
+                hasher.update(data)
+            self._hashed += len(data)
+        return data
+
+    def checksum(self, algorithm='sha256'):
+        """
+        Returns the hex digest of the file for algorithm (a hashlib name or
+        "crc32").
+
+        Digests nginx didn't provide are computed on first use, in a single
+        pass that also completes the tracked algorithms from where reads of
+        the file left off.
+        """
+        algorithm = algorithm.lower()
+        if algorithm not in self.checksums:
+            hashers = dict(self._hashers)
+            pending = [(hasher, self._hashed) for hasher in hashers.values()]
+            if algorithm not in hashers:
+                hashers[algorithm] = new_hasher(algorithm)
+                pending.append((hashers[algorithm], 0))
+            hash_file(self.path, pending)
+            for name, hasher in hashers.items():
+                self.checksums[name] = hasher.hexdigest()
+            self._hashers = {}
+        return self.checksums[algorithm]
+
+    def verify_checksum(self, algorithm='sha256'):
+        """
+        Returns the hex digest of the file for algorithm, like checksum(), but
+        a digest that came with the form is checked against the file first.
+        Raises SuspiciousOperation if they differ.
+        """
+        algorithm = algorithm.lower()
+        if algorithm not in self._claimed:
+            return self.checksum(algorithm)
+        hasher = new_hasher(algorithm)
+        hash_file(self.path, [(hasher, 0)])
+        digest = hasher.hexdigest()
+        if digest != self.checksums[algorithm]:
+            raise SuspiciousOperation('The %s checksum of "%s" does not match '
+                                      'its contents' % (algorithm, self.name))
+        self._claimed.discard(algorithm)
+        return digest
 
     def move(self, dst):
-        "Closes then moves the file to dst."
+        """
+        Closes then moves the file to dst.
+
+        Returns the strategy that was used, see
+        django_transfer.files.move_file().
+        """
         self.close()
-        shutil.move(self.path, dst)
+        metrics = get_metrics()
+        if metrics is not None:
+            start = default_timer()
+        strategy = move_file(self.path, dst)
+        if metrics is not None:
+            metrics.timing('transfer_upload_move_seconds',
+                           default_timer() - start, strategy=strategy,
+                           **get_metric_labels(dst))
+        LOGGER.debug('Moved %s to %s (%s)', self.path, dst, strategy)
+        return strategy
 
 
-class TransferMiddleware(MiddlewareMixin):
+class TransferMiddleware(AsyncMiddlewareMixin, MiddlewareMixin):
+    def accepts(self, request):
+        """
+        Returns True if request may carry files stored by nginx. This never
+        blocks, the async middleware relies on that.
+        """
+        config = get_config()
+        if request.method not in config.upload_methods:
+            return False
+        if not config.enabled:
+            return False
+        if config.server != SERVER_NGINX:
+            return False
+        return config.upload_acl.check(request.path)
+
     def process_request(self, request):
-        method = request.method
-        if method not in UPLOAD_METHODS:
-            return
-        if not is_enabled():
+        if not self.accepts(request):
             return
-        if not check_acl(request.path):
+        metrics = get_metrics()
+        if metrics is not None:
+            start = default_timer()
+        config = get_config()
+        body_file = None
+        if config.upload_file_header is not None:
+            body_file = request.META.get(config.upload_file_header)
+        if body_file:
+            self.promote_body(request, body_file)
+        else:
+            self.promote_uploads(request)
+        if metrics is not None:
+            self.measure(metrics, request, default_timer() - start)
+
+    def measure(self, metrics, request, seconds):
+        labels = {'server': get_config().server}
+        metrics.timing('transfer_upload_seconds', seconds, **labels)
+        # Uploads are only counted if the form was parsed, accessing
+        # request.FILES would make Django parse uploads it still has to.
+        files = getattr(request, '_files', None)
+        if files is None:
             return
-        if get_server_name() != SERVER_NGINX:
+        count = sum(isinstance(upload, ProxyUploadedFile)
+                    for field, uploads in files.lists()
+                    for upload in uploads)
+        if count:
+            metrics.increment('transfer_uploads_total', count, **labels)
+
+    def promote_body(self, request, path):
+        """
+        Exposes a request body nginx stored at path (client_body_in_file_only)
+        as a ProxyUploadedFile, in request.FILES under
+        TRANSFER_UPLOAD_FILE_FIELD. The body is not read.
+        """
+        config = get_config()
+        path = self.check_temp_path(path)
+        meta = request.META
+        name = None
+        disposition = meta.get('HTTP_CONTENT_DISPOSITION')
+        if disposition:
+            name = parse_disposition(disposition.encode('latin-1')).get(
+                b'filename')
+            if name:
+                name = name.decode('utf-8', 'replace')
+        if not name:
+            name = request.path.rstrip('/').rpartition('/')[2] or 'upload'
+        content_type = meta.get('CONTENT_TYPE', '').partition(';')[0].strip()
+        if not content_type:
+            content_type = config.mime.guess(name, path)
+        upload = ProxyUploadedFile(path, name, content_type,
+                                   os.path.getsize(path),
+                                   track=config.upload_checksums)
+        # Nothing is left to parse, make sure Django doesn't try.
+        request._post = QueryDict('', encoding=request.encoding)
+        request._files = MultiValueDict({config.upload_file_field: [upload]})
+
+    def check_temp_path(self, path):
+        """
+        Returns path, normalized. Raises SuspiciousOperation if it is not in
+        TRANSFER_UPLOAD_TEMP_DIR, when set: paths come from request headers
+        and fields, which nginx is trusted to have set.
+        """
+        temp_dir = get_config().upload_temp_dir
+        path = os.path.normpath(path)
+        if temp_dir is not None and not path.startswith(temp_dir):
+            raise SuspiciousOperation('Upload file "%s" is not in '
+                                      'TRANSFER_UPLOAD_TEMP_DIR' % path)
+        return path
+
+    def promote_uploads(self, request):
+        """
+        Replaces the fields nginx's upload module added to request.POST with
+        ProxyUploadedFiles in request.FILES.
+        """
+        config = get_config()
+        # nginx has replaced the file bodies with small form fields. Parse
+        # them directly, whatever the request method is.
+        try:
+            load_form(request)
+        except MultiPartParserError:
+            LOGGER.info('Error attempting to parse upload form',
+                        exc_info=True)
             return
-        # If enabled for other methods, masquerade as POST to allow parsing
-        # multipart/form-data.
-        if method != 'POST':
-            request.method = 'POST'
-            try:
-                try:
-                    # There is a fair chance this will fail. If it does, log
-                    # the error and move on.
-                    request._load_post_and_files()
-                finally:
-                    # Don't forget to restore the method.
-                    request.method = method
-            except MultiPartParserError:
-                LOGGER.info('Error attempting to parse non-POST data',
-                            exc_info=True)
-                return
         # Find uploads in request.POST and copy them to request.FILES. Such
         # fields are expected to be named as:
         # __original_field_name__[__attribute__]
@@ -178,7 +1044,7 @@ class TransferMiddleware(MiddlewareMixin):
         fields = set()
         for name in request.POST.keys():
             field, bracket, attr = name.partition('[')
-            if attr in ('filename]', 'path]', 'size]', 'content_type]'):
+            if attr in UPLOAD_ATTRIBUTES:
                 fields.add(field)
         # If we found any field names that match the expected naming scheme, we
         # can now loop through the names, and try to extract the attributes.
@@ -204,11 +1070,19 @@ class TransferMiddleware(MiddlewareMixin):
                     sizes = dict(enumerate(request.POST.pop('%s[size]' % field)))
                 except KeyError:
                     sizes = {}
+                checksums = {}
+                for algorithm in ALGORITHMS:
+                    try:
+                        checksums[algorithm] = dict(enumerate(request.POST.pop('%s[%s]' % (field, algorithm))))
+                    except KeyError:
+                        pass
                 # Iterating over possible multiple files
                 for i, (name, temp) in fields:
-                    content_type = content_types[i] if i in content_types else mimetypes.guess_type(name)[0]
+                    temp = self.check_temp_path(temp)
+                    content_type = content_types[i] if i in content_types else config.mime.guess(name, temp)
                     size = int(sizes[i]) if i in sizes else os.path.getsize(temp)
-                    data.append(ProxyUploadedFile(temp, name, content_type, size))
+                    digests = dict((algorithm, values[i].lower()) for algorithm, values in checksums.items() if values.get(i))
+                    data.append(ProxyUploadedFile(temp, name, content_type, size, digests, config.upload_checksums))
                 # Now add a new UploadedFile object so that the web application
                 # can handle these "files" that were uploaded in the same
                 # fashion as a regular file upload.
@@ -0,0 +1,192 @@
+"""
+Streaming of uncompressed ZIP archives.
+
+The archive is produced while it is sent, reading one chunk of one member at
+a time. Member sizes come from stat(), so the length of the whole archive is
+known before the first byte is sent. CRCs are computed while reading, and
+written after each member in a data descriptor. ZIP64 records are used for
+the members, offsets and counts that need them, so archives and members may
+exceed 4 GiB.
+"""
+from __future__ import unicode_literals
+
+import os
+import time
+import zlib
+import struct
+
+from django.utils.encoding import force_bytes
+
+
+MAX_32 = 0xffffffff
+MAX_16 = 0xffff
+# Values from which ZIP64 records are needed.
+ZIP64_LIMIT = MAX_32
+ZIP_FILECOUNT_LIMIT = MAX_16
+
+# General purpose flags: sizes and CRC follow the data, names are UTF-8.
+FLAGS = 0x08 | 0x800
+VERSION = 20
+VERSION_ZIP64 = 45
+STORED = 0
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+LOCAL_HEADER_SIGNATURE = 0x04034b50
+DATA_DESCRIPTOR = struct.Struct('<IIII')
+DATA_DESCRIPTOR_ZIP64 = struct.Struct('<IIQQ')
+DATA_DESCRIPTOR_SIGNATURE = 0x08074b50
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+CENTRAL_HEADER_SIGNATURE = 0x02014b50
+END_RECORD = struct.Struct('<IHHHHIIH')
+END_RECORD_SIGNATURE = 0x06054b50
+END_RECORD_ZIP64 = struct.Struct('<IQHHIIQQQQ')
+END_RECORD_ZIP64_SIGNATURE = 0x06064b50
+END_LOCATOR_ZIP64 = struct.Struct('<IIQI')
+END_LOCATOR_ZIP64_SIGNATURE = 0x07064b50
+EXTRA_ZIP64 = 0x0001
+
+
+def dos_time(mtime):
+    "Returns the MS-DOS (time, date) of a timestamp."
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+def zip64_extra(*values):
+    "Builds a ZIP64 extended information field holding values."
+    if not values:
+        return b''
+    return struct.pack('<HH%dQ' % len(values), EXTRA_ZIP64, 8 * len(values),
+                       *values)
+
+
+def split_item(item):
+    "Returns the path and archive name of an item of a file list."
+    if isinstance(item, (tuple, list)):
+        return item
+    return item, os.path.basename(item)
+
+
+class ZipMember(object):
+    "A file in the archive, see ZipStream."
+    def __init__(self, path, name, stat, offset):
+        self.path = path
+        self.name = force_bytes(name.replace(os.sep, '/').lstrip('/'))
+        self.size = stat.st_size
+        self.time, self.date = dos_time(stat.st_mtime)
+        self.mode = stat.st_mode
+        self.offset = offset
+        self.zip64 = self.size >= ZIP64_LIMIT
+        self.header = self.local_header()
+        descriptor = DATA_DESCRIPTOR_ZIP64 if self.zip64 else DATA_DESCRIPTOR
+        self.length = len(self.header) + self.size + descriptor.size
+
+    def local_header(self):
+        version, size, extra = VERSION, 0, b''
+        if self.zip64:
+            # The sizes are in the data descriptor, but their ZIP64 field must
+            # be present.
+            version, size = VERSION_ZIP64, MAX_32
+            extra = zip64_extra(0, 0)
+        return LOCAL_HEADER.pack(
+            LOCAL_HEADER_SIGNATURE, version, FLAGS, STORED, self.time,
+            self.date, 0, size, size, len(self.name), len(extra)) + \
+            self.name + extra
+
+    def data_descriptor(self, crc):
+        if self.zip64:
+            return DATA_DESCRIPTOR_ZIP64.pack(DATA_DESCRIPTOR_SIGNATURE, crc,
+                                              self.size, self.size)
+        return DATA_DESCRIPTOR.pack(DATA_DESCRIPTOR_SIGNATURE, crc, self.size,
+                                    self.size)
+
+    def central_header(self, crc):
+        values, size, offset = [], self.size, self.offset
+        if self.zip64:
+            values += [self.size, self.size]
+            size = MAX_32
+        if offset >= ZIP64_LIMIT:
+            values.append(offset)
+            offset = MAX_32
+        extra = zip64_extra(*values)
+        version = VERSION_ZIP64 if values else VERSION
+        return CENTRAL_HEADER.pack(
+            CENTRAL_HEADER_SIGNATURE, (3 << 8) | version, version, FLAGS,
+            STORED, self.time, self.date, crc, size, size, len(self.name),
+            len(extra), 0, 0, 0, (self.mode & 0xffff) << 16, offset) + \
+            self.name + extra
+
+
+class ZipStream(object):
+    """
+    Iterates over a store-mode ZIP archive of files.
+
+    files is an iterable of paths, or of (path, name) tuples where name is
+    the path of the member in the archive (the base name of path by
+    default). Files are read in chunk_size chunks, only one is open at a
+    time. content_length is the exact length of the archive.
+    """
+    def __init__(self, files, chunk_size):
+        self.chunk_size = chunk_size
+        self.members = []
+        offset = 0
+        for item in files:
+            path, name = split_item(item)
+            member = ZipMember(path, name, os.stat(path), offset)
+            self.members.append(member)
+            offset += member.length
+        self.directory_offset = offset
+        # The CRCs don't change the length of the central directory.
+        self.directory_size = sum(len(member.central_header(0))
+                                  for member in self.members)
+        self.zip64 = len(self.members) >= ZIP_FILECOUNT_LIMIT or \
+            self.directory_offset >= ZIP64_LIMIT or \
+            self.directory_size >= ZIP64_LIMIT
+        self.content_length = offset + self.directory_size + END_RECORD.size
+        if self.zip64:
+            self.content_length += END_RECORD_ZIP64.size + \
+                END_LOCATOR_ZIP64.size
+
+    def __iter__(self):
+        crcs = []
+        for member in self.members:
+            yield member.header
+            crc, remaining = 0, member.size
+            with open(member.path, 'rb') as f:
+                while remaining:
+                    chunk = f.read(min(self.chunk_size, remaining))
+                    if not chunk:
+                        raise IOError('%s was truncated while being archived'
+                                      % member.path)
+                    crc = zlib.crc32(chunk, crc)
+                    remaining -= len(chunk)
+                    yield chunk
+            crc &= 0xffffffff
+            crcs.append(crc)
+            yield member.data_descriptor(crc)
+        for member, crc in zip(self.members, crcs):
+            yield member.central_header(crc)
+        for record in self.end_records():
+            yield record
+
+    def end_records(self):
+        count, size = len(self.members), self.directory_size
+        offset = self.directory_offset
+        if self.zip64:
+            yield END_RECORD_ZIP64.pack(
+                END_RECORD_ZIP64_SIGNATURE, END_RECORD_ZIP64.size - 12,
+                (3 << 8) | VERSION_ZIP64, VERSION_ZIP64, 0, 0, count, count,
+                size, offset)
+            yield END_LOCATOR_ZIP64.pack(END_LOCATOR_ZIP64_SIGNATURE, 0,
+                                         offset + size, 1)
+            if count >= ZIP_FILECOUNT_LIMIT:
+                count = MAX_16
+            if size >= ZIP64_LIMIT:
+                size = MAX_32
+            if offset >= ZIP64_LIMIT:
+                offset = MAX_32
+        yield END_RECORD.pack(END_RECORD_SIGNATURE, 0, 0, count, count, size,
+                              offset, 0)
@@ -0,0 +1,180 @@
+"""
+ASGI support, for Python 3.6+ and Django 3.0+.
+
+TransferMiddleware only leaves the event loop for requests it may have to
+promote uploads for. Fallback downloads served to ASGI requests read the file
+in a thread pool, so a slow disk never stalls the event loop. When the server
+supports the zero-copy send extension, TransferASGIHandler hands it the file
+instead, and the contents never pass through Python.
+"""
+import os
+import asyncio
+
+import django
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler, ASGIRequest
+
+from django_transfer.streaming import FileIterator, MultipartFileIterator
+
+
+# https://asgi.readthedocs.io/en/latest/extensions.html#zero-copy-send
+ZEROCOPY_SEND = 'http.response.zerocopysend'
+
+
+def is_asgi_request(request):
+    return isinstance(request, ASGIRequest)
+
+
+class AsyncIteratorMixin(object):
+    """
+    Adds asynchronous iteration to a file iterator.
+
+    Each chunk is produced by a call to the synchronous iterator in the
+    default executor, so seeks and reads happen off the event loop.
+    """
+    def __aiter__(self):
+        return self.aread()
+
+    async def aread(self):
+        loop = asyncio.get_event_loop()
+        chunks = iter(self)
+        while True:
+            chunk = await loop.run_in_executor(None, next, chunks, None)
+            if chunk is None:
+                break
+            yield chunk
+
+
+class AsyncFileIterator(AsyncIteratorMixin, FileIterator):
+    pass
+
+
+class AsyncMultipartFileIterator(AsyncIteratorMixin, MultipartFileIterator):
+    pass
+
+
+class AsyncMiddlewareMixin(object):
+    """
+    Async counterpart of MiddlewareMixin.__call__() for TransferMiddleware.
+
+    Django's MiddlewareMixin runs process_request() in a thread for every
+    request. accepts() is cheap enough to run in the event loop, so only the
+    requests it accepts pay for the thread hop.
+    """
+    async def __acall__(self, request):
+        if self.accepts(request):
+            response = await sync_to_async(self.process_request,
+                                           thread_sensitive=True)(request)
+            if response is not None:
+                return response
+        return await self.get_response(request)
+
+
+def get_response_headers(response):
+    "Returns the headers of response as an ASGI header list."
+    headers = []
+    for header, value in response.items():
+        if isinstance(header, str):
+            header = header.encode('ascii')
+        if isinstance(value, str):
+            value = value.encode('latin1')
+        headers.append((bytes(header), bytes(value)))
+    for cookie in response.cookies.values():
+        headers.append((b'Set-Cookie',
+                        cookie.output(header='').encode('ascii').strip()))
+    return headers
+
+
+class ZeroCopySend(object):
+    "Wraps the send callable of servers that support zero-copy send."
+    def __init__(self, send):
+        self.send = send
+
+    def __call__(self, message):
+        return self.send(message)
+
+
+class TransferASGIHandler(ASGIHandler):
+    """
+    ASGIHandler that sends fallback downloads without blocking.
+
+    If the server advertises the zero-copy send extension, the file of a
+    TransferHttpResponse is handed to it with the offset and length of each
+    range to send, unless the download is rate limited. Otherwise the file is
+    streamed asynchronously, which Django only does itself since 4.2. Every
+    other response is left to Django.
+    """
+    async def __call__(self, scope, receive, send):
+        if ZEROCOPY_SEND in (scope.get('extensions') or {}):
+            send = ZeroCopySend(send)
+        await super().__call__(scope, receive, send)
+
+    async def send_response(self, response, send):
+        iterator = getattr(response, 'file_iterator', None)
+        if iterator is not None and isinstance(send, ZeroCopySend) and \
+           not iterator.limiters:
+            await self.send_file(response, send, iterator)
+        elif hasattr(iterator, '__aiter__'):
+            await self.stream_file(response, send, iterator)
+        else:
+            await super().send_response(response, send)
+
+    async def send_start(self, response, send):
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': get_response_headers(response),
+        })
+
+    async def send_file(self, response, send, iterator):
+        await self.send_start(response, send)
+        try:
+            parts = iterator.parts()
+            for i, part in enumerate(parts, 1):
+                more_body = i < len(parts)
+                if isinstance(part, tuple):
+                    offset, length = part
+                    message = {
+                        'type': ZEROCOPY_SEND,
+                        'file': iterator.file,
+                        'offset': offset,
+                        'more_body': more_body,
+                    }
+                    if length is not None:
+                        message['count'] = length
+                    else:
+                        length = os.fstat(iterator.file.fileno()).st_size - \
+                            offset
+                else:
+                    message = {
+                        'type': 'http.response.body',
+                        'body': part,
+                        'more_body': more_body,
+                    }
+                    length = len(part)
+                await send(message)
+                iterator.sent += length
+        finally:
+            await sync_to_async(response.close, thread_sensitive=True)()
+
+    async def stream_file(self, response, send, iterator):
+        await self.send_start(response, send)
+        try:
+            async for chunk in iterator:
+                await send({
+                    'type': 'http.response.body',
+                    'body': chunk,
+                    'more_body': True,
+                })
+            await send({'type': 'http.response.body'})
+        finally:
+            await sync_to_async(response.close, thread_sensitive=True)()
+
+
+def get_asgi_application():
+    """
+    Like django.core.asgi.get_asgi_application(), but returns a
+    TransferASGIHandler.
+    """
+    django.setup(set_prefix=False)
+    return TransferASGIHandler()
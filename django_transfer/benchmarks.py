@@ -0,0 +1,648 @@
+"""
+Micro-benchmarks for django-transfer hot paths.
+
+These run against the bundled test project:
+
+    python -m django_transfer.benchmarks [name ...]
+
+or, with results as JSON, against any project that installs the app:
+
+    python manage.py transfer_benchmark --json [name ...]
+
+Each benchmark reports one result per case. Run without arguments to
+execute all of them. Set TRANSFER_BENCHMARK_SIZE to change the size (in
+bytes) of the file downloaded by the fallback benchmark.
+
+The asgi benchmark drives Django's ASGI handler in-process, the way uvicorn
+or daphne would, without the network in the way. The proxy benchmark goes
+over HTTP on localhost, through django_transfer.proxy standing in for
+nginx, and compares offloaded transfers to Django doing the work.
+"""
+from __future__ import print_function, unicode_literals
+
+import os
+import re
+import sys
+import random
+import mimetypes
+import timeit
+import tempfile
+import multiprocessing
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+
+BENCHMARKS = []
+# Results of the running benchmarks, and where to print them.
+RESULTS = []
+STREAM = sys.stdout
+# Settings changed by configure(), with their previous values.
+CHANGED = {}
+MISSING = object()
+
+
+def benchmark(func):
+    "Registers a benchmark function."
+    BENCHMARKS.append(func)
+    return func
+
+
+def measure(func, args, number=10):
+    "Returns the mean seconds per call of func over each item in args."
+    # Keep the garbage collector running, as it would be in production.
+    timer = timeit.Timer(lambda: [func(arg) for arg in args],
+                         setup='gc.enable()')
+    total = timer.timeit(number=number)
+    return total / (number * len(args))
+
+
+def record(name, value, unit):
+    "Records a result, and prints it."
+    RESULTS.append({'name': name, 'value': value, 'unit': unit})
+    if STREAM is not None:
+        STREAM.write(format_result(name, value, unit) + '\n')
+
+
+def format_result(name, value, unit):
+    return '%-48s %12.3f %s' % (name, value, unit)
+
+
+def report(name, seconds):
+    "Records a time per operation."
+    record(name, seconds * 1e6, 'us/op')
+
+
+def configure(**values):
+    """
+    Changes settings, and lets django_transfer know. run() restores them
+    once the benchmarks are done.
+    """
+    from django.conf import settings
+    from django_transfer import reset_config
+
+    for name, value in values.items():
+        if name not in CHANGED:
+            CHANGED[name] = getattr(settings, name, MISSING)
+        setattr(settings, name, value)
+        reset_config(name)
+
+
+def restore():
+    "Restores the settings changed by configure()."
+    from django.conf import settings
+    from django_transfer import reset_config
+
+    for name, value in CHANGED.items():
+        if value is MISSING:
+            delattr(settings, name)
+        else:
+            setattr(settings, name, value)
+        reset_config(name)
+    CHANGED.clear()
+
+
+def legacy_mapping(path, mappings):
+    "The linear TRANSFER_MAPPINGS scan replaced by MappingIndex."
+    for root, location in mappings.items():
+        if path.startswith(root):
+            path = os.path.relpath(path, root).strip('/')
+            return os.path.join(location, path)
+
+
+@benchmark
+def mappings():
+    from django_transfer import MappingIndex
+
+    rand = random.Random(0)
+    for count in (10, 100, 1000):
+        mappings = dict(('/srv/volume%04d/files' % i, '/internal/%04d' % i)
+                        for i in range(count))
+        paths = ['/srv/volume%04d/files/a/b/c.bin' % rand.randrange(count)
+                 for i in range(1000)]
+        index = MappingIndex(mappings)
+        report('mappings[%d] linear' % count,
+               measure(lambda p: legacy_mapping(p, mappings), paths))
+        report('mappings[%d] index' % count, measure(index.lookup, paths))
+
+
+def legacy_acl(path, acl):
+    "The per-pattern re.match() loop replaced by UploadACL."
+    path = path.lstrip('/')
+    white, black = acl
+    allow = True
+    if white:
+        allow = False
+        for pattern in white:
+            if re.match(pattern, path):
+                allow = True
+                break
+    if black:
+        for pattern in black:
+            if re.match(pattern, path):
+                allow = False
+                break
+    return allow
+
+
+@benchmark
+def acl():
+    from django_transfer import UploadACL
+
+    rand = random.Random(0)
+    for count in (10, 100, 1000):
+        acl = (
+            [r'^api/v1/resource%04d/upload/$' % i for i in range(count)],
+            [r'^api/v1/resource%04d/upload/private' % i
+             for i in range(0, count, 10)],
+        )
+        # A small set of hot endpoints, as seen in production traffic.
+        hot = ['/api/v1/resource%04d/upload/' % rand.randrange(count)
+               for i in range(20)]
+        paths = [rand.choice(hot) for i in range(200)]
+        # Beyond a few hundred patterns the legacy loop thrashes the re
+        # module's pattern cache, so keep its run short.
+        report('acl[%d] legacy' % count,
+               measure(lambda p: legacy_acl(p, acl), paths, number=1))
+        compiled = UploadACL(acl)
+        report('acl[%d] compiled' % count, measure(compiled.match, paths))
+        report('acl[%d] cached' % count, measure(compiled.check, paths))
+
+
+@benchmark
+def mime():
+    from django_transfer.mime import MimeResolver
+
+    rand = random.Random(0)
+    extensions = ('.jpg', '.png', '.mp4', '.pdf', '.docx', '.zip', '.tar.gz',
+                  '.txt', '.JPG', '')
+    names = ['/mnt/shared/uploads/%d/file %d%s' % (i % 10, i,
+             rand.choice(extensions)) for i in range(1000)]
+    resolver = MimeResolver()
+    report('mime guess_type', measure(lambda n: mimetypes.guess_type(n)[0],
+                                      names))
+    report('mime resolver', measure(resolver.guess, names))
+
+
+def zipf_sample(rand, items, count, s=1.1):
+    "Picks count items, the k-th most popular with weight 1 / k ** s."
+    weights = [1.0 / rank ** s for rank in range(1, len(items) + 1)]
+    return rand.choices(items, weights, k=count)
+
+
+@benchmark
+def headers():
+    import shutil
+    from django_transfer import get_header_value
+
+    rand = random.Random(0)
+    root = tempfile.mkdtemp()
+    try:
+        for i in range(100):
+            os.mkdir(os.path.join(root, '%d' % i))
+        files = [os.path.join(root, '%d' % (i % 100), 'file %05d.bin' % i)
+                 for i in range(10000)]
+        for path in files:
+            open(path, 'w').close()
+        paths = zipf_sample(rand, files, 5000)
+        configure(DEBUG=False, TRANSFER_SERVER='nginx',
+                  TRANSFER_MAPPINGS={root: '/downloads'})
+        for name, cache_size, secure_link in (
+                ('uncached', 0, None),
+                ('cached', 4096, None),
+                ('secure_link uncached', 0, {'secret': 'secret'}),
+                ('secure_link cached', 4096, {'secret': 'secret'})):
+            configure(TRANSFER_HEADER_CACHE_SIZE=cache_size,
+                      TRANSFER_SECURE_LINK=secure_link)
+            report('headers[zipf 10000] %s' % name,
+                   measure(get_header_value, paths))
+    finally:
+        shutil.rmtree(root)
+
+
+@benchmark
+def bulk():
+    from django_transfer import get_config, get_header_value
+    from django_transfer import resolve_transfer_paths
+
+    rand = random.Random(0)
+    configure(DEBUG=False, TRANSFER_SERVER='nginx', TRANSFER_MAPPINGS=dict(
+        ('/srv/volume%03d' % i, '/internal/%03d' % i) for i in range(100)))
+    # A playlist: a few albums, many tracks each.
+    volumes = [rand.randrange(100) for album in range(50)]
+    paths = ['/srv/volume%03d/artist/album %d/track %02d.mp3' % (
+             volumes[album], album, track)
+             for album in range(50) for track in range(20)]
+    for cache_size in (0, 4096):
+        configure(TRANSFER_HEADER_CACHE_SIZE=cache_size)
+        mime = get_config().mime
+        name = 'bulk[%d] per path%s' % (len(paths),
+                                        ' warm cache' if cache_size else '')
+        report(name, measure(lambda p: [(get_header_value(path),
+                                         mime.guess(path)) for path in p],
+                             [paths]) / len(paths))
+    report('bulk[%d] resolve_transfer_paths' % len(paths),
+           measure(resolve_transfer_paths, [paths]) / len(paths))
+
+
+def upload_request(count, method='post'):
+    "Builds a request as forwarded by nginx for an upload of count files."
+    from django.test.client import RequestFactory, encode_multipart
+
+    data = encode_multipart('BoUnDaRy', {
+        'file[filename]': ['file%d.jpg' % i for i in range(count)],
+        'file[path]': ['/mnt/shared/uploads/%d/%010d' % (i % 10, i)
+                       for i in range(count)],
+        'file[content_type]': ['image/jpeg'] * count,
+        'file[size]': [str(1024 * i) for i in range(count)],
+    })
+    return getattr(RequestFactory(), method)(
+        '/upload/', data, content_type='multipart/form-data; '
+                                       'boundary=BoUnDaRy')
+
+
+@benchmark
+def upload_form():
+    from django_transfer.parser import load_form
+
+    # Django's parser refuses more than 1000 fields by default.
+    configure(DATA_UPLOAD_MAX_NUMBER_FIELDS=None)
+    for count in (10, 100, 1000, 5000):
+        number = max(1, 1000 // count)
+        requests = [upload_request(count) for i in range(number)]
+        report('upload_form[%d] MultiPartParser' % count,
+               measure(lambda r: r.POST, requests, number=1))
+        requests = [upload_request(count) for i in range(number)]
+        report('upload_form[%d] load_form' % count,
+               measure(load_form, requests, number=1))
+
+
+def make_sparse_file(size, dir=None):
+    "Creates a file of size zero bytes without writing them to disk."
+    with tempfile.NamedTemporaryFile(delete=False, dir=dir) as temp:
+        temp.truncate(size)
+        return temp.name
+
+
+def stream(path, legacy, queue):
+    "Streams path through a response, runs in a child process."
+    from django.http import StreamingHttpResponse
+    from django_transfer import TransferHttpResponse
+
+    start = timeit.default_timer()
+    if legacy:
+        # What TransferHttpResponse did before FileIterator.
+        response = StreamingHttpResponse(open(path, 'rb'))
+    else:
+        response = TransferHttpResponse(path)
+    total = 0
+    for chunk in response.streaming_content:
+        total += len(chunk)
+    response.close()
+    elapsed = timeit.default_timer() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource \
+        else 0
+    queue.put((total, elapsed, peak))
+
+
+@benchmark
+def fallback():
+    size = int(os.environ.get('TRANSFER_BENCHMARK_SIZE', 1024 ** 3))
+    path = make_sparse_file(size)
+    try:
+        # Make sure responses are not offloaded.
+        configure(DEBUG=True)
+        for name, legacy in (('legacy', True), ('chunked', False)):
+            # Peak RSS is per process, so measure each case in a fresh one.
+            queue = multiprocessing.Queue()
+            child = multiprocessing.Process(target=stream,
+                                            args=(path, legacy, queue))
+            child.start()
+            total, elapsed, peak = queue.get()
+            child.join()
+            case = 'fallback[%d MB] %s' % (total // 1024 ** 2, name)
+            record(case, total / elapsed / 1024 ** 2, 'MB/s')
+            record(case, peak / 1024.0, 'MB peak RSS')
+    finally:
+        os.unlink(path)
+
+
+def consume(path):
+    "Sends the file through a TransferHttpResponse."
+    from django_transfer import TransferHttpResponse
+
+    response = TransferHttpResponse(path)
+    for chunk in response.streaming_content:
+        pass
+    response.close()
+
+
+@benchmark
+def downloads():
+    import shutil
+    from django_transfer import TransferHttpResponse
+
+    root = tempfile.mkdtemp()
+    try:
+        for size, label in ((4 * 1024, '4 KB'), (1024 ** 2, '1 MB'),
+                            (64 * 1024 ** 2, '64 MB')):
+            path = make_sparse_file(size, root)
+            configure(DEBUG=False, TRANSFER_SERVER='nginx',
+                      TRANSFER_MAPPINGS={root: '/downloads'})
+            report('downloads[%s] header' % label,
+                   measure(TransferHttpResponse, [path] * 100))
+            configure(DEBUG=True)
+            report('downloads[%s] fallback' % label,
+                   measure(consume, [path],
+                           number=max(5, 1024 ** 2 * 100 // size)))
+    finally:
+        shutil.rmtree(root)
+
+
+@benchmark
+def middleware():
+    from django_transfer import TransferMiddleware
+
+    configure(DEBUG=False, TRANSFER_SERVER='nginx',
+              DATA_UPLOAD_MAX_NUMBER_FIELDS=None)
+    middleware = TransferMiddleware(lambda request: None)
+    for count in (1, 10, 100, 1000):
+        requests = [upload_request(count)
+                    for i in range(max(10, 1000 // count))]
+        report('middleware[%d files]' % count,
+               measure(middleware.process_request, requests, number=1))
+
+
+def make_asgi_request(path, extensions=()):
+    "Returns an ASGI scope and receive callable for a GET request."
+    import asyncio
+
+    scope = {
+        'type': 'http',
+        'method': 'GET',
+        'path': path,
+        'query_string': b'',
+        'headers': [(b'host', b'localhost')],
+        'extensions': dict((name, {}) for name in extensions),
+    }
+    receive = asyncio.Queue()
+    receive.put_nowait({'type': 'http.request', 'body': b''})
+    return scope, receive.get
+
+
+class Sink(object):
+    """
+    An ASGI send callable that counts the bytes of the response body.
+
+    Files passed with zero-copy send are sent to /dev/null with sendfile(),
+    as a server would send them to the socket.
+    """
+    def __init__(self, loop, devnull):
+        self.loop = loop
+        self.devnull = devnull
+        self.received = 0
+
+    def __call__(self, message):
+        if message['type'] == 'http.response.zerocopysend':
+            fd, offset = message['file'].fileno(), message['offset']
+            count = message.get('count')
+            while count is None or count > 0:
+                sent = os.sendfile(self.devnull, fd, offset,
+                                   count or 1024 ** 3)
+                if not sent:
+                    break
+                offset += sent
+                self.received += sent
+                if count is not None:
+                    count -= sent
+        self.received += len(message.get('body', b''))
+        done = self.loop.create_future()
+        done.set_result(None)
+        return done
+
+
+class StallMeter(object):
+    "Measures how late the event loop runs a callback scheduled every ms."
+    def __init__(self, loop, interval=0.001):
+        self.loop = loop
+        self.interval = interval
+        self.worst = 0
+        self.handle = None
+
+    def start(self):
+        self.due = self.loop.time() + self.interval
+        self.handle = self.loop.call_at(self.due, self.tick)
+
+    def tick(self):
+        self.worst = max(self.worst, self.loop.time() - self.due)
+        self.start()
+
+    def stop(self):
+        self.handle.cancel()
+
+
+urlpatterns = []
+
+
+@benchmark
+def asgi():
+    import asyncio
+    from django.http import HttpResponse
+    from django.urls import path as url_path
+    from django.core.handlers.asgi import ASGIHandler
+    from django.test.client import AsyncRequestFactory
+    from django.utils.deprecation import MiddlewareMixin
+    from asgiref.sync import markcoroutinefunction
+    from django_transfer import TransferHttpResponse, TransferMiddleware
+    from django_transfer.asgi import TransferASGIHandler, ZEROCOPY_SEND
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    configure(DEBUG=True, ALLOWED_HOSTS=['localhost'])
+
+    # Middleware overhead for requests that are not uploads, in front of a
+    # view that answers immediately.
+    response = HttpResponse()
+
+    def view(request):
+        done = loop.create_future()
+        done.set_result(response)
+        return done
+
+    middleware = TransferMiddleware(markcoroutinefunction(view))
+    requests = [AsyncRequestFactory().get('/page/') for i in range(100)]
+    for name, call in (
+            ('thread hop', lambda r: MiddlewareMixin.__acall__(middleware, r)),
+            ('native', middleware)):
+        report('asgi middleware %s' % name, measure(
+            lambda r: loop.run_until_complete(call(r)), requests))
+        report('asgi middleware %s [100 concurrent]' % name, measure(
+            lambda r: loop.run_until_complete(asyncio.gather(
+                *[call(r) for i in range(100)])), requests[:10]) / 100)
+
+    # Concurrent fallback downloads, and how long they stall the event loop.
+    size = 64 * 1024 ** 2
+    path = make_sparse_file(size)
+    urlpatterns[:] = [url_path('download/', lambda r: TransferHttpResponse(
+        path, request=r))]
+    configure(ROOT_URLCONF=__name__)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    try:
+        for name, handler, extensions in (
+                ('ASGIHandler', ASGIHandler(), ()),
+                ('TransferASGIHandler', TransferASGIHandler(), ()),
+                ('TransferASGIHandler zerocopy', TransferASGIHandler(),
+                 (ZEROCOPY_SEND,))):
+            sinks = [Sink(loop, devnull) for i in range(4)]
+            meter = StallMeter(loop)
+            meter.start()
+            start = timeit.default_timer()
+            loop.run_until_complete(asyncio.gather(*[
+                handler(*make_asgi_request('/download/', extensions) +
+                        (sink,))
+                for sink in sinks]))
+            elapsed = timeit.default_timer() - start
+            meter.stop()
+            total = sum(sink.received for sink in sinks)
+            case = 'asgi[4 x %d MB] %s' % (size // 1024 ** 2, name)
+            record(case, total / elapsed / 1024 ** 2, 'MB/s')
+            record(case, meter.worst * 1e3, 'ms stall')
+    finally:
+        os.close(devnull)
+        os.unlink(path)
+        loop.close()
+
+
+def proxy_request(url, method='GET', body=None, headers=None):
+    """
+    Sends a request, and returns the seconds until the response headers
+    arrived and the size of the response body.
+    """
+    from six.moves import http_client
+    from six.moves.urllib.parse import urlsplit
+
+    parts = urlsplit(url)
+    connection = http_client.HTTPConnection(parts.hostname, parts.port)
+    try:
+        start = timeit.default_timer()
+        connection.request(method, parts.path, body, headers or {})
+        response = connection.getresponse()
+        latency = timeit.default_timer() - start
+        total = 0
+        while True:
+            chunk = response.read(1024 ** 2)
+            if not chunk:
+                break
+            total += len(chunk)
+        assert response.status == 200, response.status
+        return latency, total
+    finally:
+        connection.close()
+
+
+@benchmark
+def proxy():
+    import shutil
+    from django.http import HttpResponse
+    from django.urls import path as url_path
+    from django.core.handlers.wsgi import WSGIHandler
+    from django.test.client import encode_multipart
+    from django_transfer import TransferHttpResponse
+    from django_transfer.proxy import ProxyServer
+    from django_transfer.storage import TransferFileSystemStorage
+
+    root = tempfile.mkdtemp()
+    size = 64 * 1024 ** 2
+    path = make_sparse_file(size, root)
+    storage = TransferFileSystemStorage(location=os.path.join(root, 'media'))
+
+    def upload(request):
+        storage.save('upload', request.FILES['file'])
+        return HttpResponse()
+
+    urlpatterns[:] = [
+        url_path('download/', lambda r: TransferHttpResponse(path)),
+        url_path('upload/', upload),
+    ]
+    configure(ROOT_URLCONF=__name__, ALLOWED_HOSTS=['127.0.0.1'],
+              MIDDLEWARE=['django_transfer.TransferMiddleware'],
+              TRANSFER_MAPPINGS={root: '/downloads'})
+    server = ProxyServer(WSGIHandler(), upload_store=root)
+    proxy = server.proxy
+    try:
+        server.start()
+        number = 8
+        for name, values in (
+                ('nginx', dict(DEBUG=False, TRANSFER_SERVER='nginx')),
+                ('apache', dict(DEBUG=False, TRANSFER_SERVER='apache')),
+                ('fallback', dict(DEBUG=True))):
+            configure(**values)
+            proxy.reset()
+            start = timeit.default_timer()
+            results = [proxy_request(server.url + '/download/')
+                       for i in range(number)]
+            elapsed = timeit.default_timer() - start
+            assert proxy.offloaded == (0 if name == 'fallback' else number)
+            case = 'proxy[download %d MB] %s' % (size // 1024 ** 2, name)
+            record(case, sum(total for latency, total in results) /
+                   elapsed / 1024 ** 2, 'MB/s')
+            record(case, sum(latency for latency, total in results) /
+                   number * 1e3, 'ms latency')
+            record(case, proxy.cpu / number * 1e3, 'ms worker CPU')
+
+        # The same form, stored by the proxy or parsed by Django.
+        boundary = 'BenchmarkBoundary'
+        with open(path, 'rb') as f:
+            body = encode_multipart(boundary, {'file': f})
+        headers = {'Content-Type': 'multipart/form-data; boundary=%s' %
+                   boundary}
+        configure(DEBUG=False, TRANSFER_SERVER='nginx')
+        for name, locations in (('nginx', ('/upload',)), ('django', ())):
+            proxy.upload_locations = locations
+            proxy.reset()
+            start = timeit.default_timer()
+            for i in range(number):
+                proxy_request(server.url + '/upload/', 'POST', body, headers)
+            elapsed = timeit.default_timer() - start
+            case = 'proxy[upload %d MB] %s' % (size // 1024 ** 2, name)
+            record(case, size * number / elapsed / 1024 ** 2, 'MB/s')
+            record(case, proxy.cpu / number * 1e3, 'ms worker CPU')
+    finally:
+        server.stop()
+        shutil.rmtree(root)
+
+
+def run(names=None, stream=sys.stdout):
+    """
+    Runs the named benchmarks, or all of them, and returns their results.
+    Django must be set up. Settings are restored afterwards.
+    """
+    global STREAM
+    unknown = set(names or ()) - set(func.__name__ for func in BENCHMARKS)
+    if unknown:
+        raise ValueError('Unknown benchmarks: %s' % ', '.join(sorted(unknown)))
+    del RESULTS[:]
+    STREAM = stream
+    try:
+        for func in BENCHMARKS:
+            if not names or func.__name__ in names:
+                func()
+    finally:
+        restore()
+    return list(RESULTS)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_transfer.settings')
+    import django
+    if hasattr(django, 'setup'):
+        django.setup()
+    run(argv)
+
+
+if __name__ == '__main__':
+    main()
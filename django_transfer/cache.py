@@ -0,0 +1,93 @@
+from __future__ import unicode_literals
+
+import os
+import errno
+import threading
+
+from collections import OrderedDict
+
+try:
+    from time import monotonic as clock
+except ImportError:
+    # Python 2
+    from timeit import default_timer as clock
+
+
+class LRUCache(object):
+    "A small, thread-safe, least recently used mapping."
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        # Reads don't take the lock. Racing with an eviction in another thread
+        # at worst costs a later cache miss.
+        try:
+            value = self.data[key]
+        except KeyError:
+            return default
+        try:
+            self.data.move_to_end(key)
+        except KeyError:
+            pass
+        except AttributeError:
+            # Python 2's OrderedDict has no move_to_end().
+            with self.lock:
+                self.data[key] = self.data.pop(key, value)
+        return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.data.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+class StatCache(object):
+    """
+    Remembers os.stat() results for ttl seconds, and missing files for
+    negative_ttl seconds, for the size most recently used paths.
+    """
+    def __init__(self, size=4096, ttl=5, negative_ttl=1, timer=None):
+        self.cache = LRUCache(size)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.timer = timer or clock
+
+    def stat(self, path):
+        "Returns the stat result of path, or None if it doesn't exist."
+        now = self.timer()
+        entry = self.cache.get(path)
+        if entry is not None and now < entry[1]:
+            return entry[0]
+        try:
+            stat, ttl = os.stat(path), self.ttl
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            stat, ttl = None, self.negative_ttl
+        self.cache.set(path, (stat, now + ttl))
+        return stat
+
+    def invalidate(self, path=None):
+        "Forgets about path, or about all paths."
+        if path is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(path)
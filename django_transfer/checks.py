@@ -0,0 +1,30 @@
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.core.checks import Warning, register
+
+from django_transfer.files import same_filesystem
+
+
+@register()
+def check_upload_filesystem(app_configs=None, **kwargs):
+    """
+    Warns when nginx's upload directory (TRANSFER_UPLOAD_TEMP_DIR) and
+    MEDIA_ROOT are on different filesystems, as every ProxyUploadedFile.move()
+    then has to copy the whole file.
+    """
+    temp_dir = getattr(settings, 'TRANSFER_UPLOAD_TEMP_DIR', None)
+    if not temp_dir or not settings.MEDIA_ROOT:
+        return []
+    try:
+        if same_filesystem(temp_dir, settings.MEDIA_ROOT):
+            return []
+    except OSError as e:
+        return [Warning('Cannot stat upload directories: %s' % e,
+                        id='django_transfer.W002')]
+    return [Warning(
+        'TRANSFER_UPLOAD_TEMP_DIR and MEDIA_ROOT are on different '
+        'filesystems, uploaded files will be copied instead of moved.',
+        hint='Point nginx upload_store at a directory on the same '
+             'filesystem as MEDIA_ROOT.',
+        id='django_transfer.W001')]
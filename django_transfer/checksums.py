@@ -0,0 +1,56 @@
+from __future__ import unicode_literals
+
+import zlib
+import hashlib
+
+
+# Checksums nginx's upload module can compute, by their field name.
+ALGORITHMS = ('md5', 'sha1', 'sha256', 'sha512', 'crc32')
+
+# Bytes read per call when hashing a file.
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class Crc32(object):
+    "A hashlib-like CRC-32, formatted like nginx's $upload_file_crc32."
+    name = 'crc32'
+
+    def __init__(self):
+        self.crc = 0
+
+    def update(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+
+    def hexdigest(self):
+        return '%08x' % (self.crc & 0xffffffff)
+
+
+def new_hasher(algorithm):
+    if algorithm == 'crc32':
+        return Crc32()
+    return hashlib.new(algorithm)
+
+
+def hash_file(path, hashers, chunk_size=HASH_CHUNK_SIZE):
+    """
+    Feeds the contents of a file to hashers in a single pass.
+
+    hashers is a list of (hasher, offset) tuples, each hasher is given the
+    file from its offset on. The file is read from the smallest offset into
+    a reused buffer.
+    """
+    if not hashers:
+        return
+    position = min(offset for hasher, offset in hashers)
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(path, 'rb') as f:
+        f.seek(position)
+        while True:
+            length = f.readinto(buffer)
+            if not length:
+                break
+            for hasher, offset in hashers:
+                if offset < position + length:
+                    hasher.update(view[max(offset - position, 0):length])
+            position += length
@@ -0,0 +1,173 @@
+from __future__ import unicode_literals
+
+import os
+import errno
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+
+MOVE_RENAME = 'rename'
+MOVE_LINK = 'link'
+MOVE_REFLINK = 'reflink'
+MOVE_COPY = 'copy'
+
+# Bytes copied per system call when the file has to be copied.
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+
+# ioctl() request to share the extents of another file (linux/fs.h).
+FICLONE = 0x40049409
+
+
+def copy_file_range(src, dst):
+    while os.copy_file_range(src, dst, COPY_CHUNK_SIZE):
+        pass
+
+
+def sendfile(src, dst):
+    offset = os.lseek(src, 0, os.SEEK_CUR)
+    while True:
+        sent = os.sendfile(dst, src, offset, COPY_CHUNK_SIZE)
+        if not sent:
+            break
+        offset += sent
+
+
+def read_write(src, dst):
+    while True:
+        chunk = os.read(src, COPY_CHUNK_SIZE)
+        if not chunk:
+            break
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(dst, view):]
+
+
+def copy_fd(src, dst):
+    """
+    Copies the rest of file descriptor src to dst, from their current
+    offsets.
+
+    The copy is done in the kernel with copy_file_range() or sendfile() when
+    available, falling back to plain reads and writes.
+    """
+    src_start = os.lseek(src, 0, os.SEEK_CUR)
+    dst_start = os.lseek(dst, 0, os.SEEK_CUR)
+    copiers = []
+    if hasattr(os, 'copy_file_range'):
+        copiers.append(copy_file_range)
+    if hasattr(os, 'sendfile'):
+        copiers.append(sendfile)
+    for copier in copiers:
+        try:
+            return copier(src, dst)
+        except OSError:
+            # Not supported for these files, start over with the next one.
+            os.lseek(src, src_start, os.SEEK_SET)
+            os.lseek(dst, dst_start, os.SEEK_SET)
+            os.ftruncate(dst, dst_start)
+    read_write(src, dst)
+
+
+def copy_file(src, dst):
+    "Copies the contents and metadata of src to dst, see copy_fd()."
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            copy_fd(fsrc.fileno(), fdst.fileno())
+    shutil.copystat(src, dst)
+
+
+def append_file(src, dst, offset=0):
+    """
+    Appends src, from offset on, to dst (which is created if needed). See
+    copy_fd(), nothing before offset is read.
+    """
+    with open(src, 'rb') as fsrc:
+        # Not opened for appending, copy_file_range() refuses that.
+        fd = os.open(dst, os.O_WRONLY | os.O_CREAT, 0o666)
+        with os.fdopen(fd, 'wb') as fdst:
+            fsrc.seek(offset)
+            fdst.seek(0, os.SEEK_END)
+            copy_fd(fsrc.fileno(), fdst.fileno())
+
+
+def reflink(src, dst):
+    "Creates dst as a copy-on-write clone of src, if the filesystem can."
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'reflink is not supported')
+    try:
+        with open(src, 'rb') as fsrc:
+            with open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except (IOError, OSError):
+        # Don't leave an empty file behind.
+        try:
+            os.unlink(dst)
+        except OSError:
+            pass
+        raise
+    shutil.copystat(src, dst)
+
+
+def move_file(src, dst):
+    """
+    Moves src to dst with the cheapest strategy that works.
+
+    Tries, in order, a rename, a hard link, a reflink (copy-on-write clone)
+    and finally a copy. Only the last one touches the file's data. Like
+    shutil.move(), if dst is a directory, src is moved into it.
+
+    Returns the strategy used: MOVE_RENAME, MOVE_LINK, MOVE_REFLINK or
+    MOVE_COPY.
+    """
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    try:
+        os.rename(src, dst)
+        return MOVE_RENAME
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    strategy = link_file(src, dst)
+    os.unlink(src)
+    return strategy
+
+
+def link_file(src, dst):
+    """
+    Makes dst a copy of src with the cheapest strategy that works.
+
+    Tries, in order, a hard link, a reflink and a copy. Returns the strategy
+    used: MOVE_LINK, MOVE_REFLINK or MOVE_COPY.
+    """
+    for name, func in ((MOVE_LINK, getattr(os, 'link', None)),
+                       (MOVE_REFLINK, reflink)):
+        if func is None:
+            continue
+        try:
+            func(src, dst)
+        except (IOError, OSError):
+            continue
+        return name
+    copy_file(src, dst)
+    return MOVE_COPY
+
+
+def same_filesystem(*paths):
+    "Returns True if all paths reside on the same device."
+    return len(set(os.stat(path).st_dev for path in paths)) == 1
+
+
+def makedirs(path, mode=0o777):
+    "Creates directory path and its parents, unless it exists."
+    if not path:
+        return
+    try:
+        os.makedirs(path, mode)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
@@ -0,0 +1,45 @@
+"""
+SQLite indexes kept next to files, shared by several processes.
+"""
+from __future__ import unicode_literals
+
+import os
+import sqlite3
+import threading
+
+from django_transfer.files import makedirs
+
+
+INDEX_NAME = 'index.sqlite3'
+
+# Seconds to wait for another process' write transaction to finish.
+BUSY_TIMEOUT = 30
+
+
+class SQLiteIndex(object):
+    """
+    Base of classes keeping an index in the SQLite database at self.index,
+    created with schema.
+
+    SQLite connections can't be shared between threads, connection is the
+    one of the current thread. Writers wait up to BUSY_TIMEOUT seconds for
+    each other, keep write transactions short.
+    """
+    schema = ''
+    # Transactions are managed by callers, see sqlite3's isolation_level.
+    isolation_level = ''
+
+    def __init__(self, index):
+        self.index = index
+        self.local = threading.local()
+
+    @property
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            makedirs(os.path.dirname(self.index))
+            connection = sqlite3.connect(self.index, timeout=BUSY_TIMEOUT,
+                                         isolation_level=self.isolation_level)
+            connection.executescript(self.schema)
+            self.local.connection = connection
+        return connection
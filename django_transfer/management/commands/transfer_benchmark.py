@@ -0,0 +1,82 @@
+from __future__ import unicode_literals
+
+import json
+import time
+import platform
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+
+from django_transfer import benchmarks
+
+
+def get_version():
+    "Returns the installed version of django-transfer, if known."
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution('django-transfer').version
+    except Exception:
+        return None
+
+
+class Command(BaseCommand):
+    help = 'Runs the django-transfer benchmarks, or the named ones.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', metavar='name',
+                            help='Benchmarks to run (all by default).')
+        parser.add_argument('--list', action='store_true',
+                            help='List the benchmarks and exit.')
+        parser.add_argument('--json', action='store_true',
+                            help='Write the results as JSON.')
+        parser.add_argument('--output', metavar='FILE',
+                            help='Write the results as JSON to FILE.')
+        parser.add_argument('--compare', metavar='FILE',
+                            help='Compare the results to JSON results saved '
+                                 'by an earlier run.')
+
+    def handle(self, *args, **options):
+        if options['list']:
+            for func in benchmarks.BENCHMARKS:
+                self.stdout.write(func.__name__)
+            return
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+        # Keep stdout clean for the JSON document.
+        stream = self.stderr if options['json'] else self.stdout
+        try:
+            results = benchmarks.run(options['names'], stream=stream)
+        except ValueError as e:
+            raise CommandError(e)
+        data = {
+            'version': get_version(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'platform': platform.platform(),
+            'timestamp': time.time(),
+            'results': results,
+        }
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+        if options['json']:
+            self.stdout.write(json.dumps(data, indent=2, sort_keys=True))
+        if baseline is not None:
+            self.compare(baseline, data)
+
+    def compare(self, baseline, data):
+        "Prints results that are in both runs, and their relative change."
+        old = dict(((result['name'], result['unit']), result['value'])
+                   for result in baseline['results'])
+        self.stdout.write('%-48s %12s %12s %8s' % ('', baseline.get(
+            'version') or 'before', data['version'] or 'after', 'change'))
+        for result in data['results']:
+            key = (result['name'], result['unit'])
+            if key not in old:
+                continue
+            before, after = old[key], result['value']
+            change = (after - before) / before * 100 if before else 0.0
+            self.stdout.write('%-48s %12.3f %12.3f %+7.1f%% %s' % (
+                result['name'], before, after, change, result['unit']))
@@ -0,0 +1,159 @@
+"""
+Metrics about transfers.
+
+Set TRANSFER_METRICS to the dotted path of a backend class, and optionally
+TRANSFER_METRICS_OPTIONS to the keyword arguments it is created with.
+Nothing is measured when TRANSFER_METRICS is not set.
+
+Backends receive counters and timings, each with a dict of labels:
+
+    transfer_responses_total       TransferHttpResponses, by server, root
+                                   and mode ("offload" or "fallback").
+    transfer_fallback_bytes_total  Bytes of files sent by Django, by server
+                                   and root.
+    transfer_upload_move_seconds   Time taken by ProxyUploadedFile.move(), by
+                                   server, root and strategy.
+    transfer_uploads_total         Files promoted by TransferMiddleware, by
+                                   server.
+    transfer_upload_seconds        Time TransferMiddleware spent on requests
+                                   carrying nginx uploads, by server.
+
+root is the TRANSFER_MAPPINGS root of the file, or "" if it is unmapped.
+"""
+from __future__ import unicode_literals
+
+import bisect
+import socket
+import threading
+
+
+# Upper bounds, in seconds, of LocalMetrics histogram buckets.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metrics(object):
+    "Base class of metrics backends, it records nothing."
+    def increment(self, name, value=1, **labels):
+        "Adds value to a counter."
+        pass
+
+    def timing(self, name, seconds, **labels):
+        "Records a duration."
+        pass
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"') \
+                .replace('\n', '\\n')
+
+
+def format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape_label(value))
+                             for name, value in labels)
+
+
+class LocalMetrics(Metrics):
+    """
+    Keeps metrics in memory, for this process.
+
+    prometheus() returns them in Prometheus' text exposition format, timings
+    are histograms with the given bucket bounds.
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        # Both keyed by (name, sorted label items).
+        self.counters = {}
+        # [count per bucket..., count, sum]
+        self.histograms = {}
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def timing(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = \
+                    [0] * (len(self.buckets) + 1) + [0.0]
+            if index < len(self.buckets):
+                histogram[index] += 1
+            histogram[-2] += 1
+            histogram[-1] += seconds
+
+    def get(self, name, **labels):
+        "Returns the value of a counter."
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def prometheus(self):
+        "Returns all metrics in Prometheus' text format."
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(value))
+                                for key, value in self.histograms.items())
+        lines, typed = [], set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s counter' % name)
+            lines.append('%s%s %s' % (name, format_labels(labels), value))
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s histogram' % name)
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (
+                    name, format_labels(labels, [('le', repr(bound))]),
+                    cumulative))
+            lines.append('%s_bucket%s %d' % (
+                name, format_labels(labels, [('le', '+Inf')]), histogram[-2]))
+            lines.append('%s_sum%s %r' % (name, format_labels(labels),
+                                          histogram[-1]))
+            lines.append('%s_count%s %d' % (name, format_labels(labels),
+                                            histogram[-2]))
+        return ''.join(line + '\n' for line in lines)
+
+
+class StatsdMetrics(Metrics):
+    """
+    Sends metrics to a statsd server over UDP.
+
+    Labels are sent as DogStatsD style tags, which plain statsd servers
+    don't understand: pass tags=False for those. Send errors are ignored.
+    """
+    def __init__(self, host='localhost', port=8125, prefix='', tags=True):
+        # Resolve once, not on every send.
+        family, kind, proto, name, self.address = socket.getaddrinfo(
+            host, port, 0, socket.SOCK_DGRAM)[0]
+        self.socket = socket.socket(family, socket.SOCK_DGRAM)
+        self.prefix = prefix
+        self.tags = tags
+
+    def send(self, name, value, kind, labels):
+        line = '%s%s:%s|%s' % (self.prefix, name, value, kind)
+        if self.tags and labels:
+            line += '|#' + ','.join('%s:%s' % item
+                                    for item in sorted(labels.items()))
+        try:
+            self.socket.sendto(line.encode('utf-8'), self.address)
+        except socket.error:
+            # Losing a metric is better than failing a transfer.
+            pass
+
+    def increment(self, name, value=1, **labels):
+        self.send(name, value, 'c', labels)
+
+    def timing(self, name, seconds, **labels):
+        self.send(name, '%g' % (seconds * 1000), 'ms', labels)
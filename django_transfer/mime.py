@@ -0,0 +1,121 @@
+from __future__ import unicode_literals
+
+import mimetypes
+
+from django_transfer.cache import LRUCache
+
+
+# Number of distinct extensions whose content type is remembered.
+CACHE_SIZE = 512
+# Bytes read from the start of a file when sniffing.
+SNIFF_SIZE = 16
+
+# Magic numbers of common file formats, checked in order.
+SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'%PDF-', 'application/pdf'),
+    (b'PK\x03\x04', 'application/zip'),
+    (b'\x1f\x8b', 'application/gzip'),
+    (b'BZh', 'application/x-bzip2'),
+    (b'\xfd7zXZ\x00', 'application/x-xz'),
+    (b'7z\xbc\xaf\x27\x1c', 'application/x-7z-compressed'),
+    (b'Rar!\x1a\x07', 'application/vnd.rar'),
+    (b'OggS', 'audio/ogg'),
+    (b'fLaC', 'audio/flac'),
+    (b'ID3', 'audio/mpeg'),
+    (b'\x1aE\xdf\xa3', 'video/webm'),
+    (b'\x00\x00\x01\xba', 'video/mpeg'),
+)
+# Formats identified by a tag at an offset: (offset, tag, prefix, type).
+TAGGED_SIGNATURES = (
+    (8, b'WEBP', b'RIFF', 'image/webp'),
+    (8, b'WAVE', b'RIFF', 'audio/wav'),
+    (8, b'AVI ', b'RIFF', 'video/x-msvideo'),
+    (4, b'ftyp', b'', 'video/mp4'),
+)
+
+MISSING = object()
+
+# Extensions that mimetypes treats as an encoding of the previous one, such
+# as ".tar.gz".
+ENCODINGS = frozenset(ext.lower() for ext in mimetypes.encodings_map)
+
+
+def split_extension(name):
+    """
+    Returns name without its extension, and the lowercase extension.
+
+    Equivalent to posixpath.splitext(), but cheaper.
+    """
+    head, dot, ext = name.rpartition('.')
+    if not dot or '/' in ext:
+        return name, ''
+    # Leading dots of the file name don't start an extension.
+    stem = head.rstrip('.')
+    if not stem or stem[-1] == '/':
+        return name, ''
+    return head, '.' + ext.lower()
+
+
+def get_extension(name):
+    "Returns the lowercase extension that determines the type of name."
+    base, ext = split_extension(name)
+    if ext in ENCODINGS:
+        ext = split_extension(base)[1] + ext
+    return ext
+
+
+def sniff(path):
+    "Guesses the content type of a file from its first bytes."
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(SNIFF_SIZE)
+    except (IOError, OSError):
+        return None
+    for signature, content_type in SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    for offset, tag, prefix, content_type in TAGGED_SIGNATURES:
+        if head[offset:offset + len(tag)] == tag and head.startswith(prefix):
+            return content_type
+    return None
+
+
+class MimeResolver(object):
+    """
+    Guesses content types from file names.
+
+    mimetypes.guess_type() parses and normalizes the name on every call. The
+    answer only depends on the extension, so it is cached per extension.
+    overrides maps extensions to content types, and takes precedence. With
+    sniffing enabled, files whose name gives no answer have their first few
+    bytes compared against known signatures.
+    """
+    def __init__(self, overrides=None, sniffing=False, cache_size=CACHE_SIZE):
+        self.overrides = {}
+        for ext, content_type in (overrides or {}).items():
+            ext = ext.lower()
+            if not ext.startswith('.'):
+                ext = '.' + ext
+            self.overrides[ext] = content_type
+        self.sniffing = sniffing
+        self.cache = LRUCache(cache_size)
+
+    def guess(self, name, path=None):
+        """
+        Returns the content type for name, or None if unknown. path is the
+        file to sniff, if sniffing is enabled.
+        """
+        ext = get_extension(name)
+        content_type = self.cache.get(ext, MISSING)
+        if content_type is MISSING:
+            content_type = self.overrides.get(ext)
+            if content_type is None and ext:
+                content_type = mimetypes.guess_type('file' + ext)[0]
+            self.cache.set(ext, content_type)
+        if content_type is None and self.sniffing and path is not None:
+            content_type = sniff(path)
+        return content_type
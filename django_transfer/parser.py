@@ -0,0 +1,164 @@
+"""
+Parsing of request bodies rewritten by nginx's upload module.
+
+Once nginx has stored the uploaded files, the body forwarded to Django only
+holds small form fields. Django's MultiPartParser is built to stream large
+files to disk, which is wasted work for such bodies, and it only runs for
+POST requests. The parser here handles the rewritten body for any method.
+"""
+from __future__ import unicode_literals
+
+import re
+
+from io import BytesIO
+
+from django.conf import settings
+from django.http import QueryDict
+from django.http.multipartparser import MultiPartParserError
+from django.utils.datastructures import MultiValueDict
+try:
+    from django.core.exceptions import TooManyFieldsSent
+except ImportError:
+    # Django < 1.10
+    TooManyFieldsSent = None
+
+
+MULTIPART = 'multipart/form-data'
+URLENCODED = 'application/x-www-form-urlencoded'
+
+BOUNDARY = re.compile(r';\s*boundary=("?)([^";]+)\1', re.I)
+DISPOSITION_PARAM = re.compile(
+    br';\s*(\w+\*?)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)')
+QUOTED_PAIR = re.compile(br'\\(.)')
+
+
+def get_boundary(content_type):
+    match = BOUNDARY.search(content_type)
+    if match is None:
+        return None
+    return match.group(2).strip().encode('ascii', 'replace')
+
+
+def parse_disposition(value):
+    "Returns the parameters of a Content-Disposition header value."
+    params = {}
+    for match in DISPOSITION_PARAM.finditer(value):
+        name, param = match.groups()
+        param = param.strip()
+        if param[:1] == b'"':
+            param = param[1:-1]
+            if b'\\' in param:
+                param = QUOTED_PAIR.sub(br'\1', param)
+        params[name.lower()] = param
+    return params
+
+
+def parse_multipart_fields(body, boundary, encoding):
+    """
+    Parses a multipart/form-data body that only contains plain fields.
+
+    Returns a mutable QueryDict, or None if the body contains a file or
+    anything else that needs Django's MultiPartParser.
+    """
+    fields = {}
+    delimiter = b'\r\n--' + boundary
+    # Prepend a line break, the first delimiter may not have one.
+    parts = (b'\r\n' + body).split(delimiter)
+    if len(parts) < 2 or not parts[-1].startswith(b'--'):
+        raise MultiPartParserError('Invalid multipart/form-data body')
+    limit = getattr(settings, 'DATA_UPLOAD_MAX_NUMBER_FIELDS', None)
+    if limit is not None and TooManyFieldsSent is not None and \
+       len(parts) - 2 > limit:
+        raise TooManyFieldsSent(
+            'The number of GET/POST parameters exceeded '
+            'settings.DATA_UPLOAD_MAX_NUMBER_FIELDS.')
+    # Skip the preamble and the epilogue.
+    for part in parts[1:-1]:
+        head, sep, value = part.partition(b'\r\n\r\n')
+        if not sep:
+            raise MultiPartParserError('Invalid multipart/form-data part')
+        name = None
+        for line in head.split(b'\r\n'):
+            header, colon, header_value = line.partition(b':')
+            header = header.strip().lower()
+            if header == b'content-disposition':
+                params = parse_disposition(header_value)
+                if b'filename' in params or b'filename*' in params:
+                    return None
+                name = params.get(b'name')
+            elif header and header != b'content-type':
+                # Content-Transfer-Encoding and friends.
+                return None
+        if name is None:
+            raise MultiPartParserError('Part without a field name')
+        fields.setdefault(name.decode(encoding, 'replace'), []).append(
+            value.decode(encoding, 'replace'))
+    post = QueryDict('', mutable=True, encoding=encoding)
+    for name, values in fields.items():
+        post.setlist(name, values)
+    return post
+
+
+def get_body_limit():
+    """
+    Returns the size of the largest body load_form() parses itself.
+
+    Reading request.body applies DATA_UPLOAD_MAX_MEMORY_SIZE to the whole
+    body, files included, which Django's parser doesn't. Only bodies within
+    that limit are read, so uploads Django accepts are still accepted.
+    """
+    limit = settings.FILE_UPLOAD_MAX_MEMORY_SIZE
+    data_limit = getattr(settings, 'DATA_UPLOAD_MAX_MEMORY_SIZE', None)
+    if data_limit is not None:
+        limit = min(limit, data_limit)
+    return limit
+
+
+def load_form(request):
+    """
+    Populates request.POST and request.FILES from a form rewritten by
+    nginx's upload module.
+
+    Bodies up to the smaller of FILE_UPLOAD_MAX_MEMORY_SIZE and
+    DATA_UPLOAD_MAX_MEMORY_SIZE are parsed here. Larger bodies, or ones
+    containing files, are left to Django's parser.
+    """
+    if hasattr(request, '_post'):
+        # Already parsed.
+        return
+    content_type = request.META.get('CONTENT_TYPE', '')
+    multipart = content_type.startswith(MULTIPART)
+    if not multipart and not content_type.startswith(URLENCODED):
+        return
+    encoding = request.encoding or settings.DEFAULT_CHARSET
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    if length <= get_body_limit():
+        if multipart:
+            boundary = get_boundary(content_type)
+            if boundary is None:
+                raise MultiPartParserError('Invalid boundary in multipart: '
+                                           '%s' % content_type)
+            post = parse_multipart_fields(request.body, boundary, encoding)
+        else:
+            post = QueryDict(request.body, mutable=True, encoding=encoding)
+        if post is not None:
+            post._mutable = False
+            request._post, request._files = post, MultiValueDict()
+            return
+    if request.method == 'POST':
+        # Django will parse it when request.POST is accessed.
+        return
+    # Django only parses POST bodies, so do it for other methods.
+    if multipart:
+        data = request
+        if hasattr(request, '_body'):
+            # The body was read above, parse that.
+            data = BytesIO(request._body)
+        request._post, request._files = request.parse_file_upload(
+            request.META, data)
+    else:
+        request._post = QueryDict(request.body, encoding=encoding)
+        request._files = MultiValueDict()
@@ -0,0 +1,294 @@
+"""
+A stand-in for the proxy server, to test and benchmark offloading without
+installing nginx.
+
+TransferProxy is WSGI middleware that does for the application what the
+proxy in front of it would:
+
+* X-Accel-Redirect locations are mapped back to files through
+  TRANSFER_MAPPINGS, X-SendFile paths are used as is. The file is sent
+  instead of the application's response, like nginx or mod_xsendfile do.
+* Multipart forms sent to the upload locations have their files stored in
+  a directory, and are passed on rewritten like nginx's upload module does
+  it, with field[filename], field[path], field[content_type] and
+  field[size] fields (and optionally checksums).
+
+It also measures the CPU time the application spends on each request,
+including streaming the responses it sends itself. ProxyServer serves it on
+localhost, in a thread. None of this is meant for production.
+"""
+from __future__ import unicode_literals
+
+import os
+import time
+import tempfile
+import threading
+
+from io import BytesIO
+from wsgiref.util import FileWrapper
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+
+from six.moves import socketserver
+from six.moves.urllib.parse import unquote
+
+from django.conf import settings
+from django.core.handlers.wsgi import LimitedStream
+from django.core.files.uploadhandler import FileUploadHandler
+from django.http.multipartparser import MultiPartParser
+from django.test.client import encode_multipart
+
+from django_transfer.checksums import new_hasher
+
+
+BOUNDARY = 'TransferProxyBoundary'
+CHUNK_SIZE = 64 * 1024
+
+# Headers of the application's response the proxy acts on, and drops.
+REDIRECT_HEADERS = ('x-accel-redirect', 'x-sendfile')
+
+try:
+    thread_time = time.thread_time
+except AttributeError:
+    # Python < 3.7
+    thread_time = time.clock
+
+
+class StoredFile(object):
+    "A file of a form, as stored by the proxy."
+    def __init__(self, path, name, content_type, size, checksums):
+        self.path = path
+        self.name = name
+        self.content_type = content_type
+        self.size = size
+        self.checksums = checksums
+
+
+class StoreUploadHandler(FileUploadHandler):
+    "Stores the files of a form in a directory, like nginx's upload_store."
+    def __init__(self, directory, checksums=()):
+        super(StoreUploadHandler, self).__init__()
+        self.directory = directory
+        self.checksums = checksums
+
+    def new_file(self, *args, **kwargs):
+        super(StoreUploadHandler, self).new_file(*args, **kwargs)
+        fd, self.path = tempfile.mkstemp(dir=self.directory)
+        self.file = os.fdopen(fd, 'wb')
+        self.hashers = [(algorithm, new_hasher(algorithm))
+                        for algorithm in self.checksums]
+
+    def receive_data_chunk(self, raw_data, start):
+        self.file.write(raw_data)
+        for algorithm, hasher in self.hashers:
+            hasher.update(raw_data)
+
+    def file_complete(self, file_size):
+        self.file.close()
+        return StoredFile(self.path, self.file_name, self.content_type,
+                          file_size, dict((algorithm, hasher.hexdigest())
+                                          for algorithm, hasher
+                                          in self.hashers))
+
+
+class MeasuredIterable(object):
+    "Counts the CPU time spent producing a response body."
+    def __init__(self, iterable, proxy, cpu):
+        self.iterable = iterable
+        self.proxy = proxy
+        self.cpu = cpu
+
+    def __iter__(self):
+        iterator = iter(self.iterable)
+        while True:
+            start = thread_time()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                self.cpu += thread_time() - start
+            yield chunk
+
+    def close(self):
+        start = thread_time()
+        if hasattr(self.iterable, 'close'):
+            self.iterable.close()
+        self.proxy.add_cpu(self.cpu + thread_time() - start)
+
+
+class TransferProxy(object):
+    """
+    WSGI middleware acting as the proxy in front of application.
+
+    mappings defaults to TRANSFER_MAPPINGS. Files of forms sent to paths
+    starting with one of upload_locations are stored in upload_store (the
+    temporary directory by default), with the listed checksums. Stored files
+    are deleted when the application answers with an error, like nginx's
+    upload_cleanup 400-599.
+    """
+    def __init__(self, application, mappings=None, upload_store=None,
+                 upload_locations=('/upload',), checksums=(),
+                 chunk_size=CHUNK_SIZE):
+        self.application = application
+        if mappings is None:
+            mappings = getattr(settings, 'TRANSFER_MAPPINGS', None) or {}
+        # The longest locations first, so they win.
+        self.locations = sorted(
+            ((self.get_location(location), root)
+             for root, location in mappings.items()),
+            key=lambda item: len(item[0]), reverse=True)
+        self.upload_store = upload_store or tempfile.gettempdir()
+        self.upload_locations = tuple(upload_locations)
+        self.checksums = tuple(checksums)
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self.reset()
+
+    def get_location(self, location):
+        if isinstance(location, dict):
+            location = location['location']
+        return location.rstrip('/')
+
+    def reset(self):
+        "Resets the statistics."
+        with self.lock:
+            self.requests = self.offloaded = 0
+            self.cpu = 0.0
+
+    def add_cpu(self, seconds):
+        with self.lock:
+            self.cpu += seconds
+
+    def resolve(self, name, value):
+        "Returns the file a redirect header points to, or None."
+        path = unquote(value.partition('?')[0])
+        if name == 'x-sendfile':
+            return path
+        for location, root in self.locations:
+            if path == location or path.startswith(location + '/'):
+                return os.path.join(root, path[len(location):].lstrip('/'))
+        return None
+
+    def __call__(self, environ, start_response):
+        stored = []
+        if self.is_upload(environ):
+            environ = self.rewrite_upload(environ, stored)
+        captured = []
+
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers]
+
+        start = thread_time()
+        result = self.application(environ, capture)
+        cpu = thread_time() - start
+        status, headers = captured
+        with self.lock:
+            self.requests += 1
+        if int(status[:3]) >= 400:
+            for upload in stored:
+                if os.path.exists(upload.path):
+                    os.unlink(upload.path)
+        for name, value in headers:
+            name = name.lower()
+            if name in REDIRECT_HEADERS:
+                if hasattr(result, 'close'):
+                    result.close()
+                self.add_cpu(cpu)
+                with self.lock:
+                    self.offloaded += 1
+                return self.send_file(environ, start_response, status,
+                                      headers, self.resolve(name, value))
+        start_response(status, headers)
+        return MeasuredIterable(result, self, cpu)
+
+    def send_file(self, environ, start_response, status, headers, path):
+        try:
+            f = open(path, 'rb') if path else None
+        except IOError:
+            f = None
+        if f is None:
+            start_response('404 Not Found', [('Content-Type', 'text/plain'),
+                                             ('Content-Length', '0')])
+            return []
+        headers = [(name, value) for name, value in headers
+                   if not name.lower().startswith('x-accel-') and
+                   name.lower() not in REDIRECT_HEADERS + ('content-length',)]
+        headers.append(('Content-Length', str(os.fstat(f.fileno()).st_size)))
+        start_response(status, headers)
+        return environ.get('wsgi.file_wrapper', FileWrapper)(f,
+                                                             self.chunk_size)
+
+    def is_upload(self, environ):
+        return environ['REQUEST_METHOD'] in ('POST', 'PUT', 'PATCH') and \
+            environ.get('CONTENT_TYPE', '').startswith('multipart/form-data') \
+            and environ.get('PATH_INFO', '').startswith(self.upload_locations)
+
+    def rewrite_upload(self, environ, stored):
+        "Stores the files of the form, and returns the rewritten request."
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        parser = MultiPartParser(
+            environ, LimitedStream(environ['wsgi.input'], length),
+            [StoreUploadHandler(self.upload_store, self.checksums)], 'utf-8')
+        post, files = parser.parse()
+        data = {}
+        for name, values in post.lists():
+            data[name] = values
+        for field, uploads in files.lists():
+            stored.extend(uploads)
+            data['%s[filename]' % field] = [u.name for u in uploads]
+            data['%s[path]' % field] = [u.path for u in uploads]
+            data['%s[content_type]' % field] = [u.content_type
+                                                for u in uploads]
+            data['%s[size]' % field] = [str(u.size) for u in uploads]
+            for algorithm in self.checksums:
+                data['%s[%s]' % (field, algorithm)] = [
+                    u.checksums[algorithm] for u in uploads]
+        body = encode_multipart(BOUNDARY, data)
+        environ = dict(environ)
+        environ['wsgi.input'] = BytesIO(body)
+        environ['CONTENT_LENGTH'] = str(len(body))
+        environ['CONTENT_TYPE'] = 'multipart/form-data; boundary=%s' % \
+            BOUNDARY
+        return environ
+
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class ProxyServer(object):
+    """
+    Serves a TransferProxy in front of application over HTTP, on localhost
+    and an unused port by default. Use as a context manager, or call
+    start() and stop(). The proxy is in the proxy attribute, and url is
+    where it is served.
+    """
+    def __init__(self, application, host='127.0.0.1', port=0, **options):
+        self.proxy = TransferProxy(application, **options)
+        self.server = make_server(host, port, self.proxy,
+                                  server_class=ThreadingWSGIServer,
+                                  handler_class=QuietHandler)
+        self.url = 'http://%s:%d' % self.server.server_address[:2]
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,70 @@
+"""
+Bandwidth limits for files sent by Django.
+
+A TokenBucket can be shared by any number of responses and threads. Each
+chunk reserves its size from the buckets it goes through and waits until
+they can afford it. Reservations are served in order, so concurrent
+responses sharing a bucket get an even share of its rate.
+"""
+from __future__ import unicode_literals
+
+import time
+import threading
+
+import six
+
+try:
+    from time import monotonic as clock
+except ImportError:
+    # Python 2
+    from timeit import default_timer as clock
+
+
+class TokenBucket(object):
+    """
+    Allows rate bytes per second on average, and bursts of up to burst
+    bytes (one second worth by default).
+    """
+    def __init__(self, rate, burst=None, timer=None):
+        self.rate = float(rate)
+        self.burst = self.rate if burst is None else burst
+        self.timer = timer or clock
+        self.tokens = self.burst
+        self.updated = self.timer()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        """
+        Takes amount tokens, and returns how many seconds to wait before
+        using them. Tokens may be borrowed, later reservations wait longer.
+        """
+        with self.lock:
+            now = self.timer()
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+def throttle(limiters, amount):
+    "Waits until amount bytes may be sent through all limiters."
+    wait = max(limiter.reserve(amount) for limiter in limiters)
+    if wait > 0:
+        time.sleep(wait)
+
+
+def parse_limit_rate(value):
+    """
+    Returns a limit_rate option (as accepted for X-Accel-Limit-Rate) in bytes
+    per second, or None if it means no limit.
+    """
+    if value is None or value is False:
+        return None
+    if isinstance(value, six.string_types):
+        if value == 'off':
+            return None
+        value = int(value)
+    return value or None
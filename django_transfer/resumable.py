@@ -0,0 +1,348 @@
+"""
+Resumable uploads, assembled from chunks stored by nginx.
+
+Clients send a large file as a series of ordinary uploads of one chunk
+each, using the headers of nginx's upload module resumable protocol:
+
+    Session-ID: <unguessable id, the same for every chunk of the file>
+    X-Content-Range: bytes <first>-<last>/<total>
+
+Each chunk is stored by nginx and promoted by TransferMiddleware as usual,
+then added to its file by the resumable_upload view decorator, after the
+checks of outer decorators and middleware. The chunk that continues the
+file is appended to it, chunks that arrive early wait in the store until
+the gap before them is filled. Only new data is copied, and the first
+chunk is moved into place. The offsets of waiting chunks are kept in an
+SQLite index, in the store by default.
+
+Until the file is complete, the decorator answers with 201 Created and the
+range received so far ("0-<last>/<total>", also in the Range header) so
+the client knows where to resume. The request carrying the last missing
+chunk reaches the view, with the whole file in request.FILES.
+"""
+from __future__ import unicode_literals
+
+import os
+import re
+import time
+import uuid
+
+from contextlib import contextmanager
+from functools import wraps
+
+from django.http import HttpResponse, HttpResponseBadRequest
+
+from django_transfer.files import append_file
+from django_transfer.index import INDEX_NAME, SQLiteIndex
+
+
+# Seconds after which a claim on a file is considered abandoned, by a
+# process that died while appending to it.
+CLAIM_TIMEOUT = 300
+# Seconds between attempts to claim a file another request appends to.
+CLAIM_INTERVAL = 0.01
+
+SESSION_ID = re.compile(r'^[\w-]{1,128}$')
+CONTENT_RANGE = re.compile(r'^bytes\s+(\d+)-(\d+)/(\d+)$')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS uploads (
+    session TEXT PRIMARY KEY,
+    total INTEGER NOT NULL,
+    received INTEGER NOT NULL,
+    updated REAL NOT NULL,
+    -- The request appending to the file, and since when.
+    owner TEXT,
+    claimed REAL
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    session TEXT NOT NULL,
+    first INTEGER NOT NULL,
+    last INTEGER NOT NULL,
+    path TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunks_session ON chunks (session, first);
+'''
+
+
+def parse_content_range(value):
+    "Returns (first, last, total) from an X-Content-Range value, or None."
+    match = CONTENT_RANGE.match(value.strip())
+    if match is None:
+        return None
+    first, last, total = (int(group) for group in match.groups())
+    if first > last or last >= total:
+        return None
+    return first, last, total
+
+
+def is_chunk(request):
+    "Returns True if request carries a chunk of a resumable upload."
+    meta = request.META
+    return 'HTTP_SESSION_ID' in meta and 'HTTP_X_CONTENT_RANGE' in meta
+
+
+def resumable_upload(view):
+    """
+    Decorates a view receiving resumable uploads, see ResumableUploads.
+
+    Chunks are only accepted once the request reaches the view, apply the
+    decorators that authenticate and authorize the client above this one.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        from django_transfer import get_config
+        resumable = get_config().resumable
+        if resumable is not None and is_chunk(request):
+            response = resumable.receive(request)
+            if response is not None:
+                return response
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+class ResumableUploads(SQLiteIndex):
+    """
+    Assembles files uploaded in chunks under root.
+
+    Chunks of a file may arrive concurrently and from several processes. One
+    request at a time claims the file in the index and appends to it, the
+    others wait. The index is only locked while claiming and releasing
+    files, not while data is copied.
+    """
+    schema = SCHEMA
+    # Transactions are managed below.
+    isolation_level = None
+
+    def __init__(self, root, index=None):
+        super(ResumableUploads, self).__init__(
+            index or os.path.join(root, INDEX_NAME))
+        self.root = root
+
+    @contextmanager
+    def write(self):
+        "A write transaction on the index, keep it short."
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def get_path(self, session):
+        "Returns where the file of session is assembled."
+        return os.path.join(self.root, '%s.part' % session)
+
+    def receive(self, request):
+        """
+        Adds the chunk in request.FILES to its file.
+
+        Returns the response to send the client while the file is
+        incomplete, or None once it is complete, after replacing the chunk
+        in request.FILES with the whole file.
+        """
+        from django_transfer import ProxyUploadedFile
+        session = request.META['HTTP_SESSION_ID']
+        content_range = parse_content_range(
+            request.META.get('HTTP_X_CONTENT_RANGE', ''))
+        uploads = [(field, upload) for field, files in request.FILES.lists()
+                   for upload in files]
+        if not SESSION_ID.match(session) or content_range is None or \
+           len(uploads) != 1:
+            return HttpResponseBadRequest('Invalid resumable upload chunk')
+        field, chunk = uploads[0]
+        if not isinstance(chunk, ProxyUploadedFile):
+            # Sent with the file itself, not stored by nginx.
+            return HttpResponseBadRequest('Resumable upload chunks must be '
+                                          'stored by nginx')
+        first, last, total = content_range
+        if chunk.size != last - first + 1:
+            return HttpResponseBadRequest('Chunk size does not match '
+                                          'X-Content-Range')
+        received = self.add_chunk(session, chunk, first, total)
+        if received is None:
+            return HttpResponseBadRequest('X-Content-Range does not match '
+                                          'the upload')
+        if received < total:
+            progress = '0-%d/%d' % (received - 1, total) if received else \
+                '*/%d' % total
+            response = HttpResponse(progress, status=201,
+                                    content_type='text/plain')
+            response['Range'] = progress
+            return response
+        upload = ProxyUploadedFile(self.get_path(session), chunk.name,
+                                   chunk.content_type, total)
+        request.FILES._mutable = True
+        request.FILES.setlist(field, [upload])
+        request.FILES._mutable = False
+        return None
+
+    def add_chunk(self, session, chunk, first, total):
+        """
+        Adds chunk (a ProxyUploadedFile) at offset first of the file.
+
+        Returns the number of bytes of the file received from its start, or
+        None if total doesn't match the previous chunks. The file is
+        complete when that number equals total.
+        """
+        owner = uuid.uuid4().hex
+        received = self.claim(session, total, owner)
+        if received is None:
+            return None
+        try:
+            received = self.assemble(session, chunk, first, received)
+        except:
+            self.release(session, owner)
+            raise
+        self.release(session, owner, received, total)
+        return received
+
+    def claim(self, session, total, owner):
+        """
+        Makes owner the only request appending to the file of session, once
+        the current one is done. Returns the number of bytes received, or
+        None if total doesn't match the previous chunks.
+        """
+        while True:
+            now = time.time()
+            with self.write() as connection:
+                row = connection.execute(
+                    'SELECT total, received, owner, claimed FROM uploads '
+                    'WHERE session = ?', (session,)).fetchone()
+                if row is None:
+                    connection.execute(
+                        'INSERT INTO uploads (session, total, received, '
+                        'updated, owner, claimed) VALUES (?, ?, 0, ?, ?, ?)',
+                        (session, total, now, owner, now))
+                    return 0
+                if row[0] != total:
+                    return None
+                if row[2] is None or row[3] < now - CLAIM_TIMEOUT:
+                    connection.execute(
+                        'UPDATE uploads SET owner = ?, claimed = ?, '
+                        'updated = ? WHERE session = ?',
+                        (owner, now, now, session))
+                    return row[1]
+            time.sleep(CLAIM_INTERVAL)
+
+    def release(self, session, owner, received=None, total=None):
+        """
+        Ends the claim of owner, recording how many bytes were received. The
+        upload is forgotten once it is complete.
+        """
+        with self.write() as connection:
+            if received is None:
+                connection.execute(
+                    'UPDATE uploads SET owner = NULL, claimed = NULL '
+                    'WHERE session = ? AND owner = ?', (session, owner))
+            elif received == total:
+                connection.execute(
+                    'DELETE FROM uploads WHERE session = ? AND owner = ?',
+                    (session, owner))
+            else:
+                connection.execute(
+                    'UPDATE uploads SET received = ?, updated = ?, '
+                    'owner = NULL, claimed = NULL '
+                    'WHERE session = ? AND owner = ?',
+                    (received, time.time(), session, owner))
+
+    def assemble(self, session, chunk, first, received):
+        "Adds chunk to the claimed file, returns the bytes received."
+        connection = self.connection
+        path = self.get_path(session)
+        last = first + chunk.size - 1
+        if first > received:
+            # Keep it until the gap is filled. The same chunk may be sent
+            # again meanwhile.
+            pending = '%s.%d.%s' % (path, first, uuid.uuid4().hex)
+            chunk.move(pending)
+            connection.execute(
+                'INSERT INTO chunks (session, first, last, path) '
+                'VALUES (?, ?, ?, ?)', (session, first, last, pending))
+            return received
+        if first == 0 and received == 0:
+            chunk.move(path)
+            received = last + 1
+        else:
+            chunk.close()
+            received = self.append(chunk.path, first, last, path, received)
+        return self.append_pending(connection, session, path, received)
+
+    def append(self, src, first, last, path, received):
+        "Appends what is new in src, a chunk at first, and deletes it."
+        if last >= received:
+            append_file(src, path, received - first)
+            received = last + 1
+        os.unlink(src)
+        return received
+
+    def append_pending(self, connection, session, path, received):
+        "Appends the waiting chunks that now continue the file."
+        while True:
+            rows = connection.execute(
+                'SELECT rowid, first, last, path FROM chunks '
+                'WHERE session = ? AND first <= ? ORDER BY first',
+                (session, received)).fetchall()
+            if not rows:
+                return received
+            for rowid, first, last, pending in rows:
+                received = self.append(pending, first, last, path, received)
+                connection.execute('DELETE FROM chunks WHERE rowid = ?',
+                                   (rowid,))
+
+    def status(self, session):
+        "Returns (received, total) for an incomplete file, or None."
+        row = self.connection.execute(
+            'SELECT received, total FROM uploads WHERE session = ?',
+            (session,)).fetchone()
+        return None if row is None else tuple(row)
+
+    def purge(self, max_age):
+        """
+        Deletes files that did not receive a chunk for max_age seconds, and
+        their waiting chunks. Also deletes complete files older than that,
+        which views did not move out of root. Returns the number of files
+        deleted.
+        """
+        with self.write() as connection:
+            sessions = [row[0] for row in connection.execute(
+                'SELECT session FROM uploads WHERE updated < ?',
+                (time.time() - max_age,))]
+            for session in sessions:
+                paths = [row[0] for row in connection.execute(
+                    'SELECT path FROM chunks WHERE session = ?', (session,))]
+                for path in paths + [self.get_path(session)]:
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                connection.execute('DELETE FROM chunks WHERE session = ?',
+                                   (session,))
+                connection.execute('DELETE FROM uploads WHERE session = ?',
+                                   (session,))
+            tracked = set(row[0] for row in connection.execute(
+                'SELECT session FROM uploads'))
+        return len(sessions) + self.purge_untracked(tracked, max_age)
+
+    def purge_untracked(self, tracked, max_age):
+        "Deletes files of sessions not in tracked, older than max_age."
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return 0
+        deleted, cutoff = 0, time.time() - max_age
+        for name in names:
+            session, part, rest = name.partition('.part')
+            if not part or session in tracked:
+                continue
+            path = os.path.join(self.root, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.unlink(path)
+                    deleted += 1
+            except OSError:
+                # Deleted meanwhile.
+                pass
+        return deleted
@@ -110,8 +110,8 @@ INSTALLED_APPS = (
 
 TRANSFER_SERVER = 'apache'
 
-# We test using PATCH method. Please understand how django-transfer mutilates
-# request handling before you enable it for other methods.
+# We test using PATCH method. Uploads forwarded by nginx are parsed for any
+# method listed here.
 TRANSFER_UPLOAD_METHODS = ('POST', 'PATCH')
 
 # url patterns to whitelist / blacklist upload handling.
@@ -0,0 +1,52 @@
+"""
+Storages that move uploads stored by the proxy.
+
+FileSystemStorage moves ProxyUploadedFiles with file_move_safe(), thanks to
+their temporary_file_path(). When the file is on another filesystem, that
+copies it in Python. TransferStorageMixin moves them with
+django_transfer.files.move_file() instead, which links, clones or copies
+in the kernel, in that order.
+"""
+from __future__ import unicode_literals
+
+import os
+
+from django.core.files.storage import FileSystemStorage
+
+from django_transfer import ProxyUploadedFile
+from django_transfer.files import makedirs
+
+
+class TransferStorageMixin(object):
+    "Mixin for FileSystemStorage subclasses."
+    def _save(self, name, content):
+        if not isinstance(content, ProxyUploadedFile):
+            return super(TransferStorageMixin, self)._save(name, content)
+        full_path = self.path(name)
+        self.make_directory(os.path.dirname(full_path))
+        # As in FileSystemStorage, the name may have been taken since
+        # get_available_name() was called.
+        while os.path.exists(full_path):
+            name = self.get_available_name(name)
+            full_path = self.path(name)
+        content.move(full_path)
+        if self.file_permissions_mode is not None:
+            os.chmod(full_path, self.file_permissions_mode)
+        name = os.path.relpath(full_path, self.location)
+        return name.replace('\\', '/')
+
+    def make_directory(self, directory):
+        mode = getattr(self, 'directory_permissions_mode', None)
+        if mode is None:
+            makedirs(directory)
+            return
+        # makedirs() doesn't apply mode to intermediate directories.
+        umask = os.umask(0o777 & ~mode)
+        try:
+            makedirs(directory, mode)
+        finally:
+            os.umask(umask)
+
+
+class TransferFileSystemStorage(TransferStorageMixin, FileSystemStorage):
+    pass
@@ -0,0 +1,105 @@
+"""
+A content-addressed store for uploads.
+
+Each distinct content is kept once, under a name derived from its checksum.
+Saving an upload whose content is already stored discards the upload, and
+any copy requested elsewhere is a hard link to the stored file. Storing a
+duplicate is then a metadata operation, whatever the size of the file.
+"""
+from __future__ import unicode_literals
+
+import os
+import logging
+
+from django_transfer.files import link_file, makedirs
+from django_transfer.index import INDEX_NAME, SQLiteIndex
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS contents (
+    digest TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL
+);
+'''
+
+
+class ContentStore(SQLiteIndex):
+    """
+    Stores uploaded files under root by checksum.
+
+    The checksums of stored contents are kept in an SQLite index (by default
+    in root), so finding a duplicate is a single indexed lookup. Stored files
+    may be shared by many hard links and must be treated as read-only.
+    """
+    schema = SCHEMA
+
+    def __init__(self, root, index=None, algorithm='sha256'):
+        super(ContentStore, self).__init__(
+            index or os.path.join(root, INDEX_NAME))
+        self.root = root
+        self.algorithm = algorithm
+
+    def get_path(self, digest):
+        "Returns where content with the given digest is stored."
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def lookup(self, digest, size):
+        "Returns the path of the stored content, or None."
+        row = self.connection.execute(
+            'SELECT path, size FROM contents WHERE digest = ?',
+            (digest,)).fetchone()
+        if row is None:
+            return None
+        path, stored_size = row
+        if stored_size != size or not os.path.exists(path):
+            # Removed behind our back.
+            with self.connection:
+                self.connection.execute(
+                    'DELETE FROM contents WHERE digest = ?', (digest,))
+            return None
+        return path
+
+    def save(self, upload, dst=None):
+        """
+        Stores a ProxyUploadedFile, unless its content is already stored.
+
+        The upload's file is moved into the store, or deleted when it is a
+        duplicate. If dst is given, it is made a hard link to the stored
+        content (or a copy, across filesystems).
+
+        Checksums sent with the form are verified against the file, unless
+        TRANSFER_TRUST_UPLOAD_CHECKSUMS is set. SuspiciousOperation is raised
+        when they don't match.
+
+        Returns a tuple of the path of the content (dst if given) and
+        whether it was newly stored.
+        """
+        from django_transfer import get_config
+        if get_config().upload_checksums_trusted:
+            digest = upload.checksum(self.algorithm)
+        else:
+            digest = upload.verify_checksum(self.algorithm)
+        # The size field may come from the client too.
+        size = os.path.getsize(upload.path)
+        path = self.lookup(digest, size)
+        created = path is None
+        if created:
+            path = self.get_path(digest)
+            makedirs(os.path.dirname(path))
+            upload.move(path)
+            with self.connection:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO contents (digest, path, size) '
+                    'VALUES (?, ?, ?)', (digest, path, size))
+        else:
+            upload.close()
+            os.unlink(upload.path)
+            LOGGER.debug('%s is a duplicate of %s', upload.path, path)
+        if dst is not None:
+            link_file(path, dst)
+            path = dst
+        return path, created
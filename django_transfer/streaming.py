@@ -0,0 +1,194 @@
+from __future__ import unicode_literals
+
+import re
+import uuid
+
+from django.utils.http import http_date, parse_http_date_safe
+
+from django_transfer.ratelimit import throttle
+
+
+# Requests asking for more ranges than this get the whole file instead.
+MAX_RANGES = 64
+
+RANGE_SPEC = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+class FileIterator(object):
+    """
+    Iterates over a file in fixed size chunks.
+
+    Line iteration, which is what a bare file object gives a streaming
+    response, produces arbitrarily large chunks for binary files. Reads start
+    at offset and stop after length bytes (or at EOF if length is None).
+    Closing the iterator closes the file. sent counts the bytes produced.
+    Reads of the file wait for the TokenBuckets in limiters.
+    """
+    limiters = ()
+
+    def __init__(self, file, chunk_size, offset=0, length=None):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.offset = offset
+        self.length = length
+        self.sent = 0
+        # Keep the original method. The WSGI handler may replace file.close
+        # with the response's close() when using wsgi.file_wrapper.
+        self._close = file.close
+
+    def __iter__(self):
+        for part in self.parts():
+            if isinstance(part, tuple):
+                for chunk in self.read(*part):
+                    yield chunk
+            else:
+                self.sent += len(part)
+                yield part
+
+    def parts(self):
+        """
+        Returns the body as a list of bytes and (offset, length) ranges of
+        the file, so it can be sent without reading the file.
+        """
+        return [(self.offset, self.length)]
+
+    def read(self, offset, length):
+        read, chunk_size = self.file.read, self.chunk_size
+        limiters = self.limiters
+        self.file.seek(offset)
+        while length is None or length > 0:
+            chunk = read(chunk_size if length is None else
+                         min(chunk_size, length))
+            if not chunk:
+                break
+            if length is not None:
+                length -= len(chunk)
+            if limiters:
+                throttle(limiters, len(chunk))
+            self.sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        self._close()
+
+
+class MultipartFileIterator(FileIterator):
+    "Produces a multipart/byteranges body for several ranges of a file."
+    def __init__(self, file, chunk_size, ranges, size, content_type):
+        super(MultipartFileIterator, self).__init__(file, chunk_size)
+        self.ranges = ranges
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/byteranges; boundary=%s' % self.boundary
+        self.headers = []
+        for start, end in ranges:
+            header = '\r\n--%s\r\n' % self.boundary
+            if content_type:
+                header += 'Content-Type: %s\r\n' % content_type
+            header += 'Content-Range: bytes %d-%d/%d\r\n\r\n' % (start, end,
+                                                                 size)
+            self.headers.append(header.encode('ascii'))
+        self.trailer = ('\r\n--%s--\r\n' % self.boundary).encode('ascii')
+        self.content_length = sum(len(header) for header in self.headers) + \
+            sum(end - start + 1 for start, end in ranges) + len(self.trailer)
+
+    def parts(self):
+        parts = []
+        for header, (start, end) in zip(self.headers, self.ranges):
+            parts.append(header)
+            parts.append((start, end - start + 1))
+        parts.append(self.trailer)
+        return parts
+
+
+def make_etag(stat):
+    "Builds a strong ETag from a stat result, the same way nginx does."
+    return '"%x-%x"' % (int(stat.st_mtime), stat.st_size)
+
+
+def parse_etags(header):
+    "Returns the ETags in an If-None-Match header, without weak prefixes."
+    etags = []
+    for etag in header.split(','):
+        etag = etag.strip()
+        if etag.startswith('W/'):
+            etag = etag[2:]
+        etags.append(etag)
+    return etags
+
+
+def is_not_modified(meta, etag, mtime):
+    "Checks If-None-Match and If-Modified-Since against the file."
+    if_none_match = meta.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        return '*' in etags or etag in etags
+    if_modified_since = meta.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since:
+        if_modified_since = parse_http_date_safe(if_modified_since)
+        return if_modified_since is not None and \
+            int(mtime) <= if_modified_since
+    return False
+
+
+def if_range_matches(meta, etag, mtime):
+    "Checks whether the Range header should be honoured."
+    if_range = meta.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        # Only strong validators can be used.
+        return if_range == etag
+    return if_range == http_date(mtime)
+
+
+def parse_ranges(header, size):
+    """
+    Parses a Range header for a file of the given size.
+
+    Returns a sorted list of inclusive (start, end) tuples, overlapping or
+    adjacent ranges merged. The list is empty when no range is satisfiable.
+    None is returned when the header is missing, invalid, asks for too many
+    ranges or for more bytes than the file has, in which case it should be
+    ignored.
+    """
+    if not header:
+        return None
+    unit, sep, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not sep:
+        return None
+    specs = specs.split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        match = RANGE_SPEC.match(spec)
+        if match is None:
+            return None
+        start, end = match.groups()
+        if not start:
+            # Suffix range, the last N bytes.
+            if not end:
+                return None
+            length = int(end)
+            if length == 0:
+                continue
+            start, end = max(size - length, 0), size - 1
+        else:
+            start = int(start)
+            end = int(end) if end else size - 1
+            if end < start:
+                return None
+            end = min(end, size - 1)
+        if start < size:
+            ranges.append((start, end))
+    # Overlapping ranges would let a small request produce a huge response.
+    if sum(end - start + 1 for start, end in ranges) > size:
+        return None
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
@@ -2,30 +2,77 @@ from __future__ import unicode_literals
 from tempfile import gettempdir
 
 import os
+import re
+import errno
+import shutil
+import threading
+import tempfile
 import json
+import zlib
+import base64
+import hashlib
+import socket
+import subprocess
+import sys
+import zipfile
+import mimetypes
 
 from unittest import skipIf
 
 import django
+import six
 from django.test import TestCase
-from django.test.client import Client, encode_multipart
-from django.core.exceptions import ImproperlyConfigured
+from django.test.client import Client, RequestFactory, encode_multipart
+from django.core.management import call_command, CommandError
+from django.core.exceptions import ImproperlyConfigured, SuspiciousOperation
+from django.core.handlers.wsgi import WSGIHandler
+from django.http import HttpResponseForbidden
+from django.http.multipartparser import MultiPartParserError
+from django.utils.http import http_date
 
-from django_transfer import settings
+from django.conf import settings
+from django_transfer import setting_changed, get_config
 from django_transfer import SERVER_HEADERS
+from django_transfer import MappingIndex, get_header_value
+from django_transfer import resolve_transfer_paths
+from django_transfer import UploadACL, check_acl
+from django_transfer import TransferHttpResponse, TransferZipResponse
+from django_transfer import archive
+from django_transfer import cache
+from django_transfer.cache import LRUCache, StatCache
+from django_transfer.mime import MimeResolver
+from django_transfer import files
+import django_transfer
+from django_transfer import ProxyUploadedFile, TransferMiddleware
+from django_transfer import checksums
+from django_transfer import ratelimit
+from django_transfer.streaming import FileIterator
+from django_transfer.store import ContentStore
+from django_transfer.storage import TransferFileSystemStorage
+from django_transfer.resumable import ResumableUploads, resumable_upload
+from django_transfer.metrics import LocalMetrics, StatsdMetrics
+from django_transfer.parser import load_form, parse_multipart_fields
+from django_transfer import checks
+from django_transfer.checks import check_upload_filesystem
 from django_transfer.views import make_tempfile
+from django_transfer import benchmarks
+from django_transfer.proxy import ProxyServer
+try:
+    import asyncio
+    from asgiref.sync import sync_to_async
+    from django.test.client import AsyncRequestFactory
+    from django_transfer import asgi
+except ImportError:
+    # Python 2 or Django < 3.1
+    asgi = None
 
 
 MULTIPART = 'multipart/form-data'
 
 
-# Note: I tried using the override_settings() decorator and the
-# TestCase.with_settings() method to manage per-test settings. This however
-# DOES NOT WORK. The reason is that if settings has already been imported,
-# it is untouched. These methods ONLY affect settings imported from the
-# point of their calling onward. This is no help to us since our module
-# imports beforehand. Instead I simply pull settings in from our module
-# and manage changing the settings on THAT.
+# Note: override_settings() cannot remove a setting, which several tests
+# need. The Settings helper below can, and like override_settings() it sends
+# setting_changed so django_transfer rebuilds its cached configuration.
 
 
 class Settings(object):
@@ -39,22 +86,25 @@ class Settings(object):
         self.settings = settings
         for name, value in kwargs.items():
             self.restore[name] = getattr(settings, name, Settings.Missing)
-            if value is Settings.Missing:
-                if hasattr(settings, name):
-                    delattr(settings, name)
-            else:
-                setattr(settings, name, value)
+            self.set(name, value)
+
+    def set(self, name, value):
+        if value is Settings.Missing:
+            if hasattr(self.settings, name):
+                delattr(self.settings, name)
+            value = None
+        else:
+            setattr(self.settings, name, value)
+        # Let django_transfer drop anything it derived from the old value.
+        setting_changed.send(sender=self.__class__, setting=name,
+                             value=value, enter=True)
 
     def __enter__(self):
         return self
 
     def __exit__(self, *args):
         for name, value in self.restore.items():
-            if value is Settings.Missing:
-                if hasattr(self.settings, name):
-                    delattr(self.settings, name)
-            else:
-                setattr(self.settings, name, value)
+            self.set(name, value)
 
 
 def get_content(response):
@@ -191,6 +241,10 @@ class NginxTestCase(DownloadTestCase, UploadTestCase, ServerTestCase):
         data = {
             'test': 'value',
             'test[foobar]': 'value',
+            # Named like optional upload attributes, but not uploads.
+            'doc[sha1]': 'abc',
+            'doc[md5]': 'abc',
+            'doc[size]': '3',
         }
         with Settings(settings, DEBUG=False,
                       TRANSFER_SERVER=self.transfer_server):
@@ -198,6 +252,20 @@ class NginxTestCase(DownloadTestCase, UploadTestCase, ServerTestCase):
         r = json.loads(r.content.decode())
         self.assertEqual(data, r['fields'])
 
+    def test_upload_temp_dir(self):
+        "Uploads outside TRANSFER_UPLOAD_TEMP_DIR are refused."
+        t = make_tempfile()
+        with Settings(settings, DEBUG=False,
+                      TRANSFER_SERVER=self.transfer_server,
+                      TRANSFER_UPLOAD_TEMP_DIR=os.path.dirname(t)):
+            for path, status in ((t, 200), ('/etc/passwd', 400),
+                                 (os.path.dirname(t) + '/../etc/passwd', 400)):
+                r = self.getClient().post('/upload/', {
+                    'file[filename]': 'foobar.png',
+                    'file[path]': path,
+                })
+                self.assertEqual(status, r.status_code)
+
     def test_upload_proxy(self):
         "Upload test case with proxied file."
         t = make_tempfile()
@@ -297,3 +365,1901 @@ class NginxTestCase(DownloadTestCase, UploadTestCase, ServerTestCase):
             'content-type': 'image/png',
             'data': 'bar'
         }, r['files']['file'][1])
+
+
+class MappingTestCase(TestCase):
+    def test_longest_prefix(self):
+        "The most specific root wins, regardless of mapping order."
+        index = MappingIndex({
+            '/mnt': '/mnt',
+            '/mnt/shared/downloads': '/downloads',
+            '/mnt/shared': '/shared',
+        })
+        self.assertEqual('/downloads/foo/bar.png',
+                         index.lookup('/mnt/shared/downloads/foo/bar.png'))
+        self.assertEqual('/shared/uploads/bar.png',
+                         index.lookup('/mnt/shared/uploads/bar.png'))
+        self.assertEqual('/mnt/other', index.lookup('/mnt/other'))
+
+    def test_component_boundary(self):
+        "Roots only match whole path components."
+        index = MappingIndex({'/mnt/shared/': '/downloads/'})
+        self.assertEqual('/downloads', index.lookup('/mnt/shared'))
+        self.assertEqual('/downloads/a', index.lookup('/mnt/shared/a'))
+        self.assertEqual(None, index.lookup('/mnt/shared2/a'))
+        self.assertEqual(None, index.lookup('/mnt/shared/../other/a'))
+        self.assertEqual(None, index.lookup('relative/path'))
+
+    def test_filesystem_root(self):
+        index = MappingIndex({'/': '/'})
+        self.assertEqual('/foo/bar', index.lookup('/foo/bar'))
+        self.assertEqual(None, index.lookup('foo/bar'))
+
+    def test_setting_changed(self):
+        "The index is rebuilt when TRANSFER_MAPPINGS changes."
+        with Settings(settings, TRANSFER_SERVER='nginx',
+                      TRANSFER_MAPPINGS={'/foo': '/a'}):
+            self.assertEqual('/a/bar', get_header_value('/foo/bar'))
+            with Settings(settings, TRANSFER_MAPPINGS={'/foo': '/b'}):
+                self.assertEqual('/b/bar', get_header_value('/foo/bar'))
+            self.assertEqual('/a/bar', get_header_value('/foo/bar'))
+            with Settings(settings, TRANSFER_MAPPINGS={}):
+                self.assertRaises(ImproperlyConfigured, get_header_value,
+                                  '/foo/bar')
+
+
+class BulkTestCase(TestCase):
+    def test_resolve_many(self):
+        "resolve_many() agrees with resolve()."
+        index = MappingIndex({
+            '/mnt/shared': '/shared',
+            '/mnt/shared/downloads': {'location': '/downloads',
+                                      'buffering': False},
+            '/mnt/file.bin': '/file',
+            '/srv/': '/',
+        })
+        paths = ['/mnt/shared/a.png', '/mnt/shared/b.png',
+                 '/mnt/shared/downloads', '/mnt/shared/downloads/c.mp4',
+                 '/mnt/shared/downloads/d/e.mp4', '/mnt/file.bin',
+                 '/mnt/other.bin', '/srv/f.txt', '/srv', '/', 'relative',
+                 '/mnt/shared//g.png', '/mnt/shared/../h.png']
+        self.assertEqual([index.resolve(path) for path in paths],
+                         list(index.resolve_many(paths)))
+
+    def test_resolve_transfer_paths(self):
+        paths = ['/mnt/a b.png', '/srv/c.mp4', '/mnt/d/e', '/tmp/f.txt']
+        with Settings(settings, TRANSFER_SERVER='nginx',
+                      TRANSFER_MAPPINGS={'/mnt': '/downloads'}):
+            resolved, unmapped = resolve_transfer_paths(iter(paths))
+        self.assertEqual(['/mnt/a b.png', '/mnt/d/e'], list(resolved))
+        self.assertEqual(('/downloads/a%20b.png', 'image/png'),
+                         resolved['/mnt/a b.png'])
+        self.assertEqual(('/downloads/d/e', None), resolved['/mnt/d/e'])
+        self.assertEqual(['/srv/c.mp4', '/tmp/f.txt'], unmapped)
+        with Settings(settings, TRANSFER_SERVER='apache'):
+            resolved, unmapped = resolve_transfer_paths(paths)
+        self.assertEqual(paths, list(resolved))
+        self.assertEqual(('/srv/c.mp4', 'video/mp4'), resolved['/srv/c.mp4'])
+        self.assertEqual([], unmapped)
+
+    def test_no_server(self):
+        with Settings(settings, TRANSFER_SERVER=Settings.Missing):
+            self.assertRaises(ImproperlyConfigured, resolve_transfer_paths,
+                              ['/mnt/a'])
+
+
+class HeaderCacheTestCase(TestCase):
+    def setUp(self):
+        super(HeaderCacheTestCase, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'f\xf6\xf6 bar.txt')
+        with open(self.path, 'w') as f:
+            f.write('foobar')
+        # The start of a 60 second window.
+        self.now = 999960
+
+    def resolve(self, **kwargs):
+        "Returns the header value, and the number of mapping lookups."
+        kwargs.setdefault('TRANSFER_SERVER', 'nginx')
+        kwargs.setdefault('TRANSFER_MAPPINGS', {self.dir: '/downloads'})
+        lookups = []
+
+        class Clock(object):
+            time = staticmethod(lambda: self.now)
+
+        with Settings(settings, **kwargs):
+            index = get_config().mappings
+            resolve = index.resolve
+
+            def record(path):
+                lookups.append(path)
+                return resolve(path)
+
+            with Patch(index, resolve=record):
+                with Patch(django_transfer, time=Clock):
+                    values = [get_header_value(self.path) for i in range(3)]
+        self.assertEqual(1, len(set(values)))
+        return values[0], len(lookups)
+
+    def test_cache(self):
+        value, lookups = self.resolve()
+        self.assertEqual('/downloads/f%C3%B6%C3%B6%20bar.txt', value)
+        self.assertEqual(1, lookups)
+        value, lookups = self.resolve(TRANSFER_HEADER_CACHE_SIZE=0)
+        self.assertEqual('/downloads/f%C3%B6%C3%B6%20bar.txt', value)
+        self.assertEqual(3, lookups)
+
+    def test_secure_link(self):
+        secure_link = {'secret': 's3cr3t', 'ttl': 60}
+        value, lookups = self.resolve(TRANSFER_SECURE_LINK=secure_link)
+        self.assertEqual(1, lookups)
+        location, query = value.split('?')
+        self.assertEqual('/downloads/f%C3%B6%C3%B6%20bar.txt', location)
+        args = dict(arg.split('=') for arg in query.split('&'))
+        version = '%x-6' % int(os.path.getmtime(self.path))
+        self.assertEqual(version, args['v'])
+        # Valid for at least ttl seconds, the same for the whole window.
+        self.assertEqual('1000080', args['expires'])
+        self.now += 59
+        self.assertEqual(value, self.resolve(
+            TRANSFER_SECURE_LINK=secure_link)[0])
+        # What nginx computes for secure_link_md5.
+        digest = hashlib.md5(('1000080/downloads/f\xf6\xf6 bar.txt%s s3cr3t'
+                              % version).encode('utf-8')).digest()
+        self.assertEqual(base64.urlsafe_b64encode(digest).rstrip(b'='),
+                         args['md5'].encode('ascii'))
+        # Renewed for the next window.
+        self.now += 1
+        self.assertTrue('expires=1000140' in self.resolve(
+            TRANSFER_SECURE_LINK=secure_link)[0])
+
+    def test_secure_link_modified(self):
+        "Modifying the file changes its signed location."
+        secure_link = {'secret': 's3cr3t'}
+        with Settings(settings, TRANSFER_SERVER='nginx',
+                      TRANSFER_SECURE_LINK=secure_link,
+                      TRANSFER_MAPPINGS={self.dir: '/downloads'}):
+            value = get_header_value(self.path)
+            self.assertEqual(value, get_header_value(self.path))
+            with open(self.path, 'a') as f:
+                f.write('baz')
+            self.assertNotEqual(value, get_header_value(self.path))
+            self.assertTrue('v=%x-9&' % int(os.path.getmtime(self.path)) in
+                            get_header_value(self.path))
+
+
+class ACLTestCase(TestCase):
+    def test_empty(self):
+        acl = UploadACL(((), ()))
+        self.assertTrue(acl.check('/anything/'))
+
+    def test_whitelist_blacklist(self):
+        acl = UploadACL(((r'^upload/', r'^api/(\w+)/upload/$'),
+                         (r'^upload/private/', r'(?i)^UPLOAD/SECRET')))
+        self.assertTrue(acl.check('/upload/'))
+        self.assertTrue(acl.check('/api/v1/upload/'))
+        self.assertFalse(acl.check('/api/v1/download/'))
+        self.assertFalse(acl.check('/upload/private/'))
+        self.assertFalse(acl.check('/upload/secret/'))
+        self.assertFalse(acl.check('/other/'))
+
+    def test_combined_semantics(self):
+        "Combining patterns must not change their meaning."
+        acl = UploadACL(((r'a|b', r'^(x)\1$', r'(?P<n>y)(?P=n)', r'c$'),
+                         (r'bz',)))
+        self.assertTrue(acl.check('/a'))
+        self.assertTrue(acl.check('/bb'))
+        self.assertFalse(acl.check('/bz'))
+        self.assertTrue(acl.check('/xx'))
+        self.assertFalse(acl.check('/xy'))
+        self.assertTrue(acl.check('/yy'))
+        self.assertFalse(acl.check('/dc'))
+        self.assertTrue(acl.check('/c'))
+
+    def test_compiled_patterns(self):
+        acl = UploadACL(((re.compile(r'^UP', re.I),), ()))
+        self.assertTrue(acl.check('/upload/'))
+        self.assertFalse(acl.check('/download/'))
+
+    def test_setting_changed(self):
+        self.assertTrue(check_acl('/upload/'))
+        with Settings(settings, TRANSFER_UPLOAD_ACL=((), (r'^upload/',))):
+            self.assertFalse(check_acl('/upload/'))
+        self.assertTrue(check_acl('/upload/'))
+
+
+class LRUCacheTestCase(TestCase):
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # Touch 'a' so that 'b' is the least recently used.
+        self.assertEqual(1, cache.get('a'))
+        cache.set('c', 3)
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual(2, len(cache))
+
+
+class ConfigTestCase(TestCase):
+    def test_immutable(self):
+        config = get_config()
+        self.assertRaises(AttributeError, setattr, config, 'enabled', True)
+        self.assertRaises(AttributeError, setattr, config, 'foo', True)
+        self.assertRaises(AttributeError, delattr, config, 'server')
+
+    def test_cached(self):
+        self.assertTrue(get_config() is get_config())
+
+    def test_setting_changed(self):
+        "The config is rebuilt only when a transfer setting changes."
+        config = get_config()
+        with Settings(settings, LANGUAGE_CODE='de'):
+            self.assertTrue(config is get_config())
+        with Settings(settings, DEBUG=False, TRANSFER_SERVER='nginx',
+                      TRANSFER_UPLOAD_METHODS=('PUT',)):
+            changed = get_config()
+            self.assertTrue(changed.enabled)
+            self.assertEqual('X-Accel-Redirect', changed.header_name)
+            self.assertEqual(frozenset(['PUT']), changed.upload_methods)
+        self.assertEqual('apache', get_config().server)
+
+
+class FallbackTestCase(TestCase):
+    def test_chunks(self):
+        "File contents are streamed in TRANSFER_CHUNK_SIZE reads."
+        t = make_tempfile('x' * 10)
+        with Settings(settings, DEBUG=True, TRANSFER_CHUNK_SIZE=4):
+            r = TransferHttpResponse(t)
+        self.assertEqual('10', r['Content-Length'])
+        self.assertEqual([b'xxxx', b'xxxx', b'xx'], list(r.streaming_content))
+        r.close()
+
+    def test_file_wrapper(self):
+        "The open file is exposed for wsgi.file_wrapper and closed after."
+        t = make_tempfile()
+        with Settings(settings, DEBUG=True):
+            r = TransferHttpResponse(t)
+        file = r.file_to_stream
+        self.assertEqual(t, file.name)
+        # This is what the WSGI handler does before wrapping the file.
+        file.close = r.close
+        r.close()
+        self.assertTrue(file.closed)
+
+    def test_enabled(self):
+        "Nothing is opened when the transfer is offloaded."
+        with Settings(settings, DEBUG=False, TRANSFER_SERVER='apache'):
+            r = TransferHttpResponse('/does/not/exist')
+        self.assertEqual('/does/not/exist', r['X-SendFile'])
+        self.assertEqual(None, getattr(r, 'file_to_stream', None))
+
+
+class RangeTestCase(TestCase):
+    def setUp(self):
+        super(RangeTestCase, self).setUp()
+        self.path = make_tempfile('0123456789')
+        self.mtime = os.path.getmtime(self.path)
+
+    def get(self, **headers):
+        request = RequestFactory().get('/download/', **headers)
+        with Settings(settings, DEBUG=True):
+            return TransferHttpResponse(self.path, content_type='text/plain',
+                                        request=request)
+
+    def test_validators(self):
+        r = self.get()
+        self.assertEqual(200, r.status_code)
+        self.assertEqual('bytes', r['Accept-Ranges'])
+        self.assertEqual(http_date(self.mtime), r['Last-Modified'])
+        self.assertEqual('"%x-a"' % int(self.mtime), r['ETag'])
+        self.assertEqual('0123456789', get_content(r))
+
+    def test_if_none_match(self):
+        etag = self.get()['ETag']
+        r = self.get(HTTP_IF_NONE_MATCH='"foo", W/%s' % etag)
+        self.assertEqual(304, r.status_code)
+        self.assertEqual('', get_content(r))
+        r = self.get(HTTP_IF_NONE_MATCH='"foo"',
+                     HTTP_IF_MODIFIED_SINCE=http_date(self.mtime))
+        self.assertEqual(200, r.status_code)
+
+    def test_if_modified_since(self):
+        r = self.get(HTTP_IF_MODIFIED_SINCE=http_date(self.mtime))
+        self.assertEqual(304, r.status_code)
+        r = self.get(HTTP_IF_MODIFIED_SINCE=http_date(self.mtime - 60))
+        self.assertEqual(200, r.status_code)
+        r = self.get(HTTP_IF_MODIFIED_SINCE='garbage')
+        self.assertEqual(200, r.status_code)
+
+    def test_single_range(self):
+        for header, content in (('bytes=2-4', '234'), ('bytes=7-', '789'),
+                                ('bytes=-3', '789'), ('bytes=8-100', '89'),
+                                ('bytes=-100', '0123456789')):
+            r = self.get(HTTP_RANGE=header)
+            self.assertEqual(206, r.status_code, header)
+            self.assertEqual(content, get_content(r), header)
+            self.assertEqual(str(len(content)), r['Content-Length'])
+            start = 10 - len(content) if header.startswith('bytes=-') \
+                else int(header[6])
+            self.assertEqual('bytes %d-%d/10' % (start,
+                             start + len(content) - 1), r['Content-Range'])
+
+    def test_multiple_ranges(self):
+        r = self.get(HTTP_RANGE='bytes=0-1, 5-6')
+        self.assertEqual(206, r.status_code)
+        content_type, boundary = r['Content-Type'].split('; boundary=')
+        self.assertEqual('multipart/byteranges', content_type)
+        content = get_content(r)
+        self.assertEqual(str(len(content)), r['Content-Length'])
+        self.assertEqual(
+            '\r\n--%(b)s\r\nContent-Type: text/plain\r\n'
+            'Content-Range: bytes 0-1/10\r\n\r\n01'
+            '\r\n--%(b)s\r\nContent-Type: text/plain\r\n'
+            'Content-Range: bytes 5-6/10\r\n\r\n56'
+            '\r\n--%(b)s--\r\n' % {'b': boundary}, content)
+
+    def test_ranges_out_of_order(self):
+        "Ranges are sent in ascending order."
+        r = self.get(HTTP_RANGE='bytes=5-6,0-1')
+        content = get_content(r)
+        # The random boundary may contain the digits, look for the bodies.
+        self.assertTrue(content.index('\r\n\r\n01') <
+                        content.index('\r\n\r\n56'))
+
+    def test_read_seeks(self):
+        "Reads start at their offset, even offset 0 after another read."
+        with open(self.path, 'rb') as f:
+            iterator = FileIterator(f, 4)
+            self.assertEqual([b'56'], list(iterator.read(5, 2)))
+            self.assertEqual([b'01'], list(iterator.read(0, 2)))
+
+    def test_overlapping_ranges(self):
+        "Overlapping and adjacent ranges are merged."
+        r = self.get(HTTP_RANGE='bytes=4-5,0-1,1-2,6-6')
+        self.assertEqual(206, r.status_code)
+        self.assertTrue(r['Content-Type'].startswith('multipart/byteranges'))
+        content = get_content(r)
+        self.assertTrue('Content-Range: bytes 0-2/10\r\n\r\n012\r\n' in
+                        content)
+        self.assertTrue('Content-Range: bytes 4-6/10\r\n\r\n456\r\n' in
+                        content)
+        r = self.get(HTTP_RANGE='bytes=2-4,3-5')
+        self.assertEqual('bytes 2-5/10', r['Content-Range'])
+        self.assertEqual('2345', get_content(r))
+
+    def test_range_amplification(self):
+        "Ranges asking for more than the file get the file, once."
+        for header in ('bytes=' + ','.join(['0-'] * 64), 'bytes=0-6,3-9'):
+            r = self.get(HTTP_RANGE=header)
+            self.assertEqual(200, r.status_code, header)
+            self.assertEqual('0123456789', get_content(r))
+
+    def test_unsatisfiable(self):
+        r = self.get(HTTP_RANGE='bytes=10-20')
+        self.assertEqual(416, r.status_code)
+        self.assertEqual('bytes */10', r['Content-Range'])
+        self.assertEqual('', get_content(r))
+
+    def test_invalid_range(self):
+        "Invalid or unsupported ranges are ignored."
+        for header in ('bytes=5-2', 'bytes=a-b', 'lines=1-2', 'bytes=-',
+                       'bytes=' + ','.join(['0-0'] * 100)):
+            r = self.get(HTTP_RANGE=header)
+            self.assertEqual(200, r.status_code, header)
+            self.assertEqual('0123456789', get_content(r))
+
+    def test_if_range(self):
+        etag = self.get()['ETag']
+        r = self.get(HTTP_RANGE='bytes=0-0', HTTP_IF_RANGE=etag)
+        self.assertEqual(206, r.status_code)
+        r = self.get(HTTP_RANGE='bytes=0-0',
+                     HTTP_IF_RANGE=http_date(self.mtime))
+        self.assertEqual(206, r.status_code)
+        r = self.get(HTTP_RANGE='bytes=0-0', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(200, r.status_code)
+        self.assertEqual('0123456789', get_content(r))
+
+    def test_without_request(self):
+        "Without the request, the whole file is always sent."
+        with Settings(settings, DEBUG=True):
+            r = TransferHttpResponse(self.path)
+        self.assertEqual(200, r.status_code)
+        self.assertFalse(r.has_header('ETag'))
+
+    def test_client(self):
+        with Settings(settings, DEBUG=True):
+            r = Client().get('/download/', HTTP_RANGE='bytes=0-0')
+        self.assertEqual(206, r.status_code)
+        self.assertEqual(str(os.getpid())[0], get_content(r))
+
+
+class AccelTestCase(TestCase):
+    mappings = {
+        '/mnt/media': {
+            'location': '/media',
+            'buffering': False,
+            'limit_rate': 1024 * 1024,
+        },
+        '/mnt/thumbs': {
+            'location': '/thumbs',
+            'expires': 3600,
+            'charset': 'utf-8',
+        },
+        '/mnt/other': '/other',
+    }
+
+    def get(self, path, **kwargs):
+        with Settings(settings, DEBUG=False, TRANSFER_SERVER='nginx',
+                      TRANSFER_MAPPINGS=self.mappings):
+            return TransferHttpResponse(path, **kwargs)
+
+    def test_mapping_defaults(self):
+        r = self.get('/mnt/media/movie.mp4')
+        self.assertEqual('/media/movie.mp4', r['X-Accel-Redirect'])
+        self.assertEqual('no', r['X-Accel-Buffering'])
+        self.assertEqual('1048576', r['X-Accel-Limit-Rate'])
+        self.assertFalse(r.has_header('X-Accel-Expires'))
+        r = self.get('/mnt/thumbs/a.png')
+        self.assertEqual('3600', r['X-Accel-Expires'])
+        self.assertEqual('utf-8', r['X-Accel-Charset'])
+        self.assertFalse(r.has_header('X-Accel-Buffering'))
+        r = self.get('/mnt/other/a.png')
+        self.assertEqual('/other/a.png', r['X-Accel-Redirect'])
+        self.assertFalse(r.has_header('X-Accel-Buffering'))
+
+    def test_arguments(self):
+        "Keyword arguments override the mapping defaults."
+        r = self.get('/mnt/media/movie.mp4', accel_buffering=True,
+                     accel_limit_rate=False, accel_expires='@1700000000')
+        self.assertEqual('yes', r['X-Accel-Buffering'])
+        self.assertEqual('off', r['X-Accel-Limit-Rate'])
+        self.assertEqual('@1700000000', r['X-Accel-Expires'])
+
+    def test_other_servers(self):
+        "X-Accel-* headers are only sent to nginx."
+        with Settings(settings, DEBUG=False, TRANSFER_SERVER='apache'):
+            r = TransferHttpResponse('/mnt/media/movie.mp4',
+                                     accel_buffering=False)
+        self.assertFalse(r.has_header('X-Accel-Buffering'))
+
+    def test_invalid_mapping(self):
+        self.assertRaises(ImproperlyConfigured, MappingIndex,
+                          {'/mnt': {'buffering': False}})
+        self.assertRaises(ImproperlyConfigured, MappingIndex,
+                          {'/mnt': {'location': '/mnt', 'foo': 'bar'}})
+
+
+class MimeTestCase(TestCase):
+    def test_guess(self):
+        resolver = MimeResolver()
+        for name in ('foo.png', 'FOO.PNG', '/a.b/foo.txt', 'foo.tar.gz',
+                     'foo.tgz', 'foo', '.bashrc', 'foo.unknown', 'a/..png',
+                     '..a.png', 'a.png/b', 'foo.svgz', 'foo.'):
+            self.assertEqual(mimetypes.guess_type(name)[0],
+                             resolver.guess(name), name)
+            # Again, from the cache.
+            self.assertEqual(mimetypes.guess_type(name)[0],
+                             resolver.guess(name), name)
+
+    def test_overrides(self):
+        resolver = MimeResolver({'MKV': 'video/x-matroska',
+                                 '.png': 'image/x-png'})
+        self.assertEqual('video/x-matroska', resolver.guess('movie.mkv'))
+        self.assertEqual('image/x-png', resolver.guess('image.PNG'))
+
+    def test_sniff(self):
+        t = make_tempfile('%PDF-1.4 ...')
+        self.assertEqual(None, MimeResolver().guess('document', t))
+        resolver = MimeResolver(sniffing=True)
+        self.assertEqual('application/pdf', resolver.guess('document', t))
+        # Names with a known type are not sniffed.
+        self.assertEqual('text/plain', resolver.guess('document.txt', t))
+        self.assertEqual(None, resolver.guess('document', t + '.missing'))
+
+    def test_upload(self):
+        "The middleware uses TRANSFER_MIME_TYPES and TRANSFER_MIME_SNIFF."
+        t = make_tempfile('GIF89a...')
+        data = {
+            'file[filename]': ['foobar', 'foobar.mkv'],
+            'file[path]': [t, t],
+        }
+        with Settings(settings, DEBUG=False, TRANSFER_SERVER='nginx',
+                      TRANSFER_MIME_SNIFF=True,
+                      TRANSFER_MIME_TYPES={'.mkv': 'video/x-matroska'}):
+            r = Client().post('/upload/', data)
+        r = json.loads(r.content.decode())
+        self.assertEqual('image/gif', r['files']['file'][0]['content-type'])
+        self.assertEqual('video/x-matroska',
+                         r['files']['file'][1]['content-type'])
+
+
+def fail(error):
+    "Returns a function that raises OSError(error)."
+    def raises(*args):
+        raise OSError(error, os.strerror(error))
+    return raises
+
+
+class Patch(object):
+    "Context manager that replaces attributes of an object, then restores them."
+    def __init__(self, obj, **kwargs):
+        self.obj, self.kwargs = obj, kwargs
+        self.restore = dict((name, getattr(obj, name)) for name in kwargs)
+
+    def __enter__(self):
+        for name, value in self.kwargs.items():
+            setattr(self.obj, name, value)
+        return self
+
+    def __exit__(self, *args):
+        for name, value in self.restore.items():
+            setattr(self.obj, name, value)
+
+
+class MoveTestCase(TestCase):
+    def setUp(self):
+        super(MoveTestCase, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.src = os.path.join(self.dir, 'src')
+        self.dst = os.path.join(self.dir, 'dst')
+        with open(self.src, 'wb') as f:
+            f.write(b'x' * (files.COPY_CHUNK_SIZE + 10))
+
+    def assertMoved(self, strategy, expected):
+        self.assertEqual(expected, strategy)
+        self.assertFalse(os.path.exists(self.src))
+        with open(self.dst, 'rb') as f:
+            self.assertEqual(b'x' * (files.COPY_CHUNK_SIZE + 10), f.read())
+
+    def test_rename(self):
+        self.assertMoved(files.move_file(self.src, self.dst),
+                         files.MOVE_RENAME)
+
+    def test_into_directory(self):
+        os.mkdir(self.dst)
+        self.assertEqual(files.MOVE_RENAME, files.move_file(self.src,
+                                                            self.dst))
+        self.assertTrue(os.path.exists(os.path.join(self.dst, 'src')))
+
+    def test_link(self):
+        with Patch(os, rename=fail(errno.EXDEV)):
+            strategy = files.move_file(self.src, self.dst)
+        self.assertMoved(strategy, files.MOVE_LINK)
+
+    def test_copy(self):
+        "When nothing cheaper works, the file is copied then removed."
+        with Patch(os, rename=fail(errno.EXDEV), link=fail(errno.EXDEV)):
+            with Patch(files, reflink=fail(errno.EXDEV)):
+                strategy = files.move_file(self.src, self.dst)
+        self.assertMoved(strategy, files.MOVE_COPY)
+
+    def test_copy_fallback(self):
+        "Kernel copy methods that fail are skipped."
+        patches = dict((name, fail(errno.ENOSYS))
+                       for name in ('copy_file_range', 'sendfile')
+                       if hasattr(os, name))
+        with Patch(os, **patches):
+            files.copy_file(self.src, self.dst)
+        with open(self.dst, 'rb') as f:
+            self.assertEqual(files.COPY_CHUNK_SIZE + 10, len(f.read()))
+
+    def test_errors(self):
+        "Errors other than crossing devices are raised."
+        self.assertRaises(OSError, files.move_file, self.src + '.missing',
+                          self.dst)
+
+    def test_proxy_uploaded_file(self):
+        f = ProxyUploadedFile(self.src, 'src', None, 10)
+        self.assertMoved(f.move(self.dst), files.MOVE_RENAME)
+
+    def test_check(self):
+        "A warning is issued when moves would have to copy."
+        with Settings(settings, TRANSFER_UPLOAD_TEMP_DIR=self.dir,
+                      MEDIA_ROOT=gettempdir()):
+            self.assertEqual([], check_upload_filesystem())
+            with Patch(checks, same_filesystem=lambda *paths: False):
+                warnings = check_upload_filesystem()
+        self.assertEqual(['django_transfer.W001'], [w.id for w in warnings])
+
+
+class FakeClock(object):
+    "A clock that only moves when something sleeps."
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class RateLimitTestCase(TestCase):
+    def setUp(self):
+        super(RateLimitTestCase, self).setUp()
+        self.clock = FakeClock()
+        patch = Patch(ratelimit, clock=self.clock, time=self.clock)
+        patch.__enter__()
+        self.addCleanup(patch.__exit__)
+        self.path = make_tempfile('x' * 1000)
+
+    def get(self, **kwargs):
+        with Settings(settings, DEBUG=True, TRANSFER_CHUNK_SIZE=100,
+                      **kwargs):
+            return TransferHttpResponse(self.path)
+
+    def test_bucket(self):
+        bucket = ratelimit.TokenBucket(100)
+        self.assertEqual(0, bucket.reserve(100))
+        self.assertEqual(0.5, bucket.reserve(50))
+        self.assertEqual(1.0, bucket.reserve(50))
+        self.clock.sleep(1.0)
+        self.assertEqual(0, bucket.reserve(0))
+        # Unused tokens don't pile up beyond the burst.
+        self.clock.sleep(60)
+        self.assertEqual(0, bucket.reserve(100))
+        self.assertEqual(0.01, bucket.reserve(1))
+
+    def test_fallback(self):
+        r = self.get(TRANSFER_LIMIT_RATE=100)
+        self.assertEqual(None, getattr(r, 'file_to_stream', None))
+        self.assertEqual(1000, len(get_content(r)))
+        # The first chunk is a burst.
+        self.assertEqual(1009.0, self.clock.now)
+
+    def test_global(self):
+        "Responses share the global limit evenly."
+        with Settings(settings, DEBUG=True, TRANSFER_CHUNK_SIZE=100,
+                      TRANSFER_GLOBAL_LIMIT_RATE=200):
+            responses = [TransferHttpResponse(self.path) for i in range(2)]
+            iterators = [iter(r.streaming_content) for r in responses]
+            for i in range(10):
+                for iterator in iterators:
+                    next(iterator)
+            for r in responses:
+                r.close()
+        self.assertEqual(1009.0, self.clock.now)
+
+    def test_unlimited(self):
+        r = self.get()
+        self.assertEqual(1000, len(get_content(r)))
+        self.assertEqual(1000.0, self.clock.now)
+        self.assertFalse(r.file_iterator.limiters)
+
+    def test_mapping(self):
+        "The mapping and arguments set limits like they do for nginx."
+        mappings = {os.path.dirname(self.path): {'location': '/downloads',
+                                                 'limit_rate': 500}}
+        with Settings(settings, TRANSFER_LIMIT_RATE=100,
+                      TRANSFER_MAPPINGS=mappings):
+            self.assertEqual(500, django_transfer.get_limit_rate(self.path))
+            self.assertEqual(None, django_transfer.get_limit_rate(
+                self.path, False))
+            self.assertEqual(100, django_transfer.get_limit_rate('/foo'))
+            with Settings(settings, DEBUG=False, TRANSFER_SERVER='nginx'):
+                r = TransferHttpResponse(self.path)
+                self.assertEqual('500', r['X-Accel-Limit-Rate'])
+                r = TransferHttpResponse(self.path, accel_limit_rate=False)
+                self.assertEqual('off', r['X-Accel-Limit-Rate'])
+        with Settings(settings, DEBUG=False, TRANSFER_SERVER='nginx',
+                      TRANSFER_LIMIT_RATE=100, TRANSFER_MAPPINGS={
+                          os.path.dirname(self.path): '/downloads'}):
+            r = TransferHttpResponse(self.path)
+        self.assertEqual('100', r['X-Accel-Limit-Rate'])
+
+    @skipIf(asgi is None, 'Needs ASGI support')
+    def test_zerocopy(self):
+        "Rate limited downloads are not handed to the server."
+        handler = asgi.TransferASGIHandler()
+        r = self.get(TRANSFER_LIMIT_RATE=100)
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.run(handler.send_response(r, asgi.ZeroCopySend(send)))
+        self.assertEqual(['http.response.start'] + ['http.response.body'] * 11,
+                         [message['type'] for message in messages])
+
+
+class StatCacheTestCase(TestCase):
+    def setUp(self):
+        super(StatCacheTestCase, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.path = os.path.join(self.root, 'foo.txt')
+        with open(self.path, 'w') as f:
+            f.write('foobar')
+        self.clock = FakeClock()
+        self.stats = []
+        stat = os.stat
+
+        def record(path):
+            # Other files, such as mimetypes' on first use, don't count.
+            if path.startswith(self.root):
+                self.stats.append(path)
+            return stat(path)
+
+        for patch in (Patch(cache, clock=self.clock),
+                      Patch(cache.os, stat=record),
+                      Settings(settings, DEBUG=False, TRANSFER_SERVER='nginx',
+                               TRANSFER_MAPPINGS={self.root: '/downloads'},
+                               TRANSFER_STAT_CACHE=True)):
+            patch.__enter__()
+            self.addCleanup(patch.__exit__)
+
+    def get(self, path=None, **headers):
+        request = RequestFactory().get('/download/', **headers)
+        return TransferHttpResponse(path or self.path, request=request)
+
+    def test_cache(self):
+        stats = StatCache(size=2, ttl=10, negative_ttl=2)
+        self.assertEqual(6, stats.stat(self.path).st_size)
+        self.assertEqual(None, stats.stat(self.path + '.missing'))
+        self.clock.sleep(5)
+        stats.stat(self.path)
+        stats.stat(self.path + '.missing')
+        self.assertEqual([self.path, self.path + '.missing',
+                          self.path + '.missing'], self.stats)
+        self.clock.sleep(5)
+        stats.stat(self.path)
+        self.assertEqual(4, len(self.stats))
+        stats.invalidate(self.path)
+        stats.stat(self.path)
+        self.assertEqual(5, len(self.stats))
+
+    def test_metadata(self):
+        r = self.get()
+        self.assertEqual('/downloads/foo.txt', r['X-Accel-Redirect'])
+        self.assertEqual('6', r['Content-Length'])
+        stat = os.stat(self.path)
+        self.assertEqual('"%x-6"' % int(stat.st_mtime), r['ETag'])
+        self.assertEqual(http_date(stat.st_mtime), r['Last-Modified'])
+
+    def test_not_modified(self):
+        "Hot files get 304s from the cache."
+        etag = self.get()['ETag']
+        r = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, r.status_code)
+        self.assertFalse(r.has_header('X-Accel-Redirect'))
+        self.assertEqual(1, len(self.stats))
+
+    def test_missing(self):
+        for i in range(2):
+            r = self.get(os.path.join(self.root, 'missing.png'))
+            self.assertEqual(404, r.status_code)
+            self.assertFalse(r.has_header('X-Accel-Redirect'))
+            self.assertFalse(r.has_header('ETag'))
+            self.assertFalse(r.has_header('Last-Modified'))
+            self.assertEqual('text/plain; charset=utf-8', r['Content-Type'])
+        self.assertEqual(1, len(self.stats))
+
+    def test_resolve_transfer_paths(self):
+        "Signed archive members are stated through the cache too."
+        with Settings(settings, TRANSFER_SECURE_LINK={'secret': 's3cr3t'}):
+            for i in range(2):
+                resolved, unmapped = resolve_transfer_paths([self.path])
+                self.assertTrue(resolved[self.path][0].startswith(
+                    '/downloads/foo.txt?'))
+        self.assertEqual([self.path], self.stats)
+
+    def test_disabled(self):
+        with Settings(settings, TRANSFER_STAT_CACHE=Settings.Missing):
+            r = TransferHttpResponse(self.path)
+        self.assertFalse(r.has_header('ETag'))
+        self.assertEqual([], self.stats)
+
+
+class ProxyUploadedFileTestCase(TestCase):
+    def setUp(self):
+        super(ProxyUploadedFileTestCase, self).setUp()
+        self.path = make_tempfile('foobar')
+
+    def test_lazy(self):
+        "The file is not opened until its contents are needed."
+        f = ProxyUploadedFile(self.path, 'foo.txt', 'text/plain', 6)
+        self.assertEqual(None, f._file)
+        self.assertTrue(f.closed)
+        self.assertEqual(6, f.size)
+        self.assertEqual('foo.txt', f.name)
+        self.assertEqual(b'foo', f.read(3))
+        self.assertFalse(f.closed)
+        self.assertEqual([b'foobar'], list(f.chunks()))
+        f.close()
+        self.assertTrue(f.closed)
+        # Reopening starts from the beginning.
+        self.assertEqual(b'foobar', f.open().read())
+        f.close()
+
+    def test_move_without_opening(self):
+        f = ProxyUploadedFile(self.path, 'foo.txt', 'text/plain', 6)
+        dst = self.path + '.moved'
+        self.addCleanup(os.unlink, dst)
+        f.move(dst)
+        self.assertEqual(None, f._file)
+        self.assertFalse(os.path.exists(self.path))
+
+
+class StorageTestCase(TestCase):
+    def setUp(self):
+        super(StorageTestCase, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.path = make_tempfile('foobar')
+        self.inode = os.stat(self.path).st_ino
+        # No bytes may be copied, neither by Python nor by the kernel.
+        patch = Patch(files, copy_fd=self.fail_copy)
+        patch.__enter__()
+        self.addCleanup(patch.__exit__)
+
+    def fail_copy(self, *args):
+        self.fail('The file was copied')
+
+    def get_upload(self):
+        upload = ProxyUploadedFile(self.path, 'foo.txt', 'text/plain', 6)
+        upload.chunks = upload.read = self.fail_copy
+        return upload
+
+    def assertMoved(self, storage, name):
+        self.assertEqual(self.inode, os.stat(storage.path(name)).st_ino)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_temporary_file_path(self):
+        "Django's own storage moves uploads too."
+        from django.core.files.storage import FileSystemStorage
+
+        upload = self.get_upload()
+        self.assertEqual(self.path, upload.temporary_file_path())
+        storage = FileSystemStorage(location=self.root)
+        name = storage.save('a/foo.txt', upload)
+        self.assertMoved(storage, name)
+
+    def test_save(self):
+        storage = TransferFileSystemStorage(location=self.root,
+                                            file_permissions_mode=0o640)
+        with open(storage.path('foo.txt'), 'w') as f:
+            f.write('taken')
+        name = storage.save('foo.txt', self.get_upload())
+        self.assertNotEqual('foo.txt', name)
+        self.assertMoved(storage, name)
+        self.assertEqual(0o640, os.stat(storage.path(name)).st_mode & 0o777)
+        with open(storage.path('foo.txt')) as f:
+            self.assertEqual('taken', f.read())
+
+    def test_other_filesystem(self):
+        "Across filesystems the file is hard linked when possible."
+        def rename(src, dst):
+            raise OSError(errno.EXDEV, 'Cross-device link')
+
+        storage = TransferFileSystemStorage(location=self.root)
+        with Patch(files.os, rename=rename):
+            name = storage.save('a/b/foo.txt', self.get_upload())
+        self.assertMoved(storage, name)
+
+    def test_other_files(self):
+        from django.core.files.base import ContentFile
+
+        storage = TransferFileSystemStorage(location=self.root)
+        name = storage.save('bar.txt', ContentFile(b'bar'))
+        with storage.open(name) as f:
+            self.assertEqual(b'bar', f.read())
+
+
+class ChecksumTestCase(TestCase):
+    def setUp(self):
+        super(ChecksumTestCase, self).setUp()
+        self.data = b'foobar' * 1000
+        self.path = make_tempfile(self.data.decode())
+        self.passes = []
+        hash_file = checksums.hash_file
+
+        def record(path, hashers, *args):
+            self.passes.append(sorted(offset for hasher, offset in hashers))
+            return hash_file(path, hashers, *args)
+
+        patch = Patch(django_transfer, hash_file=record)
+        patch.__enter__()
+        self.addCleanup(patch.__exit__)
+
+    def get_file(self, **kwargs):
+        return ProxyUploadedFile(self.path, 'foo.txt', 'text/plain',
+                                 len(self.data), **kwargs)
+
+    def test_compute(self):
+        f = self.get_file()
+        self.assertEqual(hashlib.sha256(self.data).hexdigest(), f.checksum())
+        self.assertEqual(hashlib.md5(self.data).hexdigest(),
+                         f.checksum('MD5'))
+        self.assertEqual('%08x' % (zlib.crc32(self.data) & 0xffffffff),
+                         f.checksum('crc32'))
+        # Cached.
+        f.checksum()
+        self.assertEqual(3, len(self.passes))
+        self.assertTrue(f.closed)
+
+    def test_provided(self):
+        "Checksums from nginx are used as is."
+        f = self.get_file(checksums={'md5': 'abc'}, track=('md5', 'sha1'))
+        self.assertEqual('abc', f.checksum('md5'))
+        self.assertEqual([], self.passes)
+        self.assertEqual(hashlib.sha1(self.data).hexdigest(),
+                         f.checksum('sha1'))
+
+    def test_tracked(self):
+        "Reads of the file feed the tracked checksums."
+        f = self.get_file(track=('sha256', 'md5'))
+        self.assertEqual(self.data, b''.join(f.chunks(chunk_size=100)))
+        self.assertEqual(hashlib.md5(self.data).hexdigest(),
+                         f.checksum('md5'))
+        self.assertEqual(hashlib.sha256(self.data).hexdigest(), f.checksum())
+        # Nothing was left to read.
+        self.assertEqual([[len(self.data)] * 2], self.passes)
+
+    def test_tracked_partial(self):
+        "A single pass completes tracked checksums and computes others."
+        f = self.get_file(track=('sha256',))
+        f.read(10)
+        f.seek(100)
+        f.read(10)
+        self.assertEqual(hashlib.sha1(self.data).hexdigest(),
+                         f.checksum('sha1'))
+        self.assertEqual(hashlib.sha256(self.data).hexdigest(), f.checksum())
+        self.assertEqual([[0, 10]], self.passes)
+        f.close()
+
+    def test_middleware(self):
+        t = make_tempfile()
+        request = RequestFactory().post('/upload/', {
+            'file[filename]': ['a.txt', 'b.txt'],
+            'file[path]': [t, t],
+            'file[md5]': ['ABC', ''],
+            'file[sha1]': ['def', 'ghi'],
+        })
+        with Settings(settings, DEBUG=False, TRANSFER_SERVER='nginx',
+                      TRANSFER_UPLOAD_CHECKSUMS=('sha256',)):
+            TransferMiddleware(lambda r: None).process_request(request)
+        a, b = request.FILES.getlist('file')
+        self.assertEqual({'md5': 'abc', 'sha1': 'def'}, a.checksums)
+        self.assertEqual({'sha1': 'ghi'}, b.checksums)
+        self.assertEqual(['sha256'], list(a._hashers))
+        self.assertEqual([], list(request.POST.keys()))
+
+
+class ContentStoreTestCase(TestCase):
+    def setUp(self):
+        super(ContentStoreTestCase, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.store = ContentStore(os.path.join(self.dir, 'store'))
+
+    def upload(self, data, **checksums):
+        path = make_tempfile(data)
+        return ProxyUploadedFile(path, 'foo.txt', 'text/plain', len(data),
+                                 checksums)
+
+    def test_save(self):
+        first = self.upload('foobar')
+        path, created = self.store.save(first)
+        self.assertTrue(created)
+        self.assertFalse(os.path.exists(first.path))
+        self.assertEqual(
+            self.store.get_path(hashlib.sha256(b'foobar').hexdigest()), path)
+        with open(path) as f:
+            self.assertEqual('foobar', f.read())
+        # The same content is only stored once.
+        second = self.upload('foobar')
+        self.assertEqual((path, False), self.store.save(second))
+        self.assertFalse(os.path.exists(second.path))
+        other, created = self.store.save(self.upload('barfoo'))
+        self.assertTrue(created)
+        self.assertNotEqual(path, other)
+
+    def test_dst(self):
+        "Copies elsewhere are hard links to the stored content."
+        dsts = [os.path.join(self.dir, name) for name in ('a', 'b')]
+        for dst in dsts:
+            self.assertEqual(dst, self.store.save(self.upload('foobar'),
+                                                  dst)[0])
+        stored = self.store.get_path(hashlib.sha256(b'foobar').hexdigest())
+        self.assertTrue(os.path.samefile(stored, dsts[0]))
+        self.assertTrue(os.path.samefile(stored, dsts[1]))
+        self.assertEqual(3, os.stat(stored).st_nlink)
+
+    def test_stale_index(self):
+        "Contents removed from the store are stored again."
+        path, created = self.store.save(self.upload('foobar'))
+        os.unlink(path)
+        upload = self.upload('foobar')
+        self.assertEqual((path, True), self.store.save(upload))
+        self.assertTrue(os.path.exists(path))
+        # The index persists.
+        store = ContentStore(self.store.root)
+        self.assertEqual(path, store.lookup(upload.checksum(), 6))
+
+    def test_nginx_checksum(self):
+        "Checksums sent with the form are verified."
+        digest = hashlib.sha256(b'foobar').hexdigest()
+        upload = self.upload('foobar', sha256=digest)
+        self.assertEqual((self.store.get_path(digest), True),
+                         self.store.save(upload))
+        # A client may send any digest, it can't be used to poison the store.
+        upload = self.upload('barfoo', sha256=digest)
+        self.assertRaises(SuspiciousOperation, self.store.save, upload)
+        self.assertTrue(os.path.exists(upload.path))
+        with open(self.store.get_path(digest)) as f:
+            self.assertEqual('foobar', f.read())
+
+    def test_trusted_checksum(self):
+        "When nginx strips the client's fields, its checksums are used as is."
+        upload = self.upload('foobar', sha256='cafe' * 16)
+        with Settings(settings, TRANSFER_TRUST_UPLOAD_CHECKSUMS=True):
+            path, created = self.store.save(upload)
+        self.assertEqual(self.store.get_path('cafe' * 16), path)
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        super(MetricsTestCase, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.path = os.path.join(self.root, 'foo.txt')
+        with open(self.path, 'w') as f:
+            f.write('0123456789')
+        settings = Settings(django_transfer.conf.settings,
+                            TRANSFER_METRICS='django_transfer.metrics.'
+                                             'LocalMetrics',
+                            TRANSFER_MAPPINGS={self.root: '/downloads'})
+        settings.__enter__()
+        self.addCleanup(settings.__exit__)
+        self.metrics = django_transfer.get_metrics()
+
+    def test_disabled(self):
+        with Settings(settings, TRANSFER_METRICS=Settings.Missing):
+            self.assertEqual(None, django_transfer.get_metrics())
+            r = TransferHttpResponse(self.path)
+        self.assertEqual(None, r.metrics)
+
+    def test_offload(self):
+        with Settings(settings, DEBUG=False, TRANSFER_SERVER='nginx'):
+            TransferHttpResponse(self.path).close()
+        self.assertEqual(1, self.metrics.get(
+            'transfer_responses_total', mode='offload', server='nginx',
+            root=self.root))
+        self.assertEqual({}, dict(
+            (key, value) for key, value in self.metrics.counters.items()
+            if key[0] == 'transfer_fallback_bytes_total'))
+
+    def test_missing(self):
+        "Files the stat cache finds missing are not counted as offloaded."
+        with Settings(settings, DEBUG=False, TRANSFER_SERVER='nginx',
+                      TRANSFER_STAT_CACHE=True):
+            r = TransferHttpResponse(os.path.join(self.root, 'missing.txt'))
+            r.close()
+        self.assertEqual(404, r.status_code)
+        self.assertEqual(0, self.metrics.get(
+            'transfer_responses_total', mode='offload', server='nginx',
+            root=self.root))
+
+    def test_fallback(self):
+        request = RequestFactory().get('/download/', HTTP_RANGE='bytes=2-5')
+        with Settings(settings, DEBUG=True, TRANSFER_SERVER='nginx'):
+            r = TransferHttpResponse(self.path, request=request)
+            self.assertEqual('2345', get_content(r))
+            r.close()
+            # Counted once.
+            r.close()
+            TransferHttpResponse('/etc/hostname').close()
+        labels = {'server': 'nginx', 'root': self.root}
+        self.assertEqual(1, self.metrics.get(
+            'transfer_responses_total', mode='fallback', **labels))
+        self.assertEqual(4, self.metrics.get(
+            'transfer_fallback_bytes_total', **labels))
+        self.assertEqual(0, self.metrics.get(
+            'transfer_fallback_bytes_total', server='nginx', root=''))
+
+    def test_upload(self):
+        t = make_tempfile()
+        request = RequestFactory().post('/upload/', {
+            'file[filename]': ['a.txt', 'b.txt'],
+            'file[path]': [t, t],
+        })
+        with Settings(settings, DEBUG=False, TRANSFER_SERVER='nginx'):
+            TransferMiddleware(lambda r: None).process_request(request)
+            request.FILES['file'].move(os.path.join(self.root, 'a.txt'))
+        self.assertEqual(2, self.metrics.get('transfer_uploads_total',
+                                             server='nginx'))
+        text = self.metrics.prometheus()
+        self.assertTrue('# TYPE transfer_upload_seconds histogram\n' in text)
+        self.assertTrue('transfer_upload_seconds_count{server="nginx"} 1\n'
+                        in text)
+        self.assertTrue(re.search(
+            r'transfer_upload_move_seconds_bucket\{root="%s",server="nginx",'
+            r'strategy="rename",le="\+Inf"\} 1\n' % re.escape(self.root),
+            text))
+
+    def test_prometheus(self):
+        metrics = LocalMetrics(buckets=(0.1, 1))
+        metrics.increment('requests_total', path='say "hi"\n')
+        metrics.timing('latency_seconds', 0.05)
+        metrics.timing('latency_seconds', 0.5)
+        metrics.timing('latency_seconds', 5)
+        self.assertEqual(
+            '# TYPE requests_total counter\n'
+            'requests_total{path="say \\"hi\\"\\n"} 1\n'
+            '# TYPE latency_seconds histogram\n'
+            'latency_seconds_bucket{le="0.1"} 1\n'
+            'latency_seconds_bucket{le="1"} 2\n'
+            'latency_seconds_bucket{le="+Inf"} 3\n'
+            'latency_seconds_sum 5.55\n'
+            'latency_seconds_count 3\n', metrics.prometheus())
+
+    def test_statsd(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        metrics = StatsdMetrics('127.0.0.1', server.getsockname()[1],
+                                prefix='app.')
+        metrics.increment('uploads_total', 3, server='nginx')
+        metrics.timing('upload_seconds', 0.25)
+        self.assertEqual(b'app.uploads_total:3|c|#server:nginx',
+                         server.recv(512))
+        self.assertEqual(b'app.upload_seconds:250|ms', server.recv(512))
+
+    def test_upload_unparsed(self):
+        "Measuring doesn't make Django parse a form the middleware didn't."
+        request = RequestFactory().post(
+            '/upload/', b'--XyZ\r\ngarbage',
+            content_type=MULTIPART + '; boundary=XyZ')
+        with Settings(settings, DEBUG=False, TRANSFER_SERVER='nginx'):
+            TransferMiddleware(lambda r: None).process_request(request)
+        self.assertFalse(hasattr(request, '_files'))
+        # Views may still choose how uploads are handled.
+        request.upload_handlers = []
+        self.assertEqual(0, self.metrics.get('transfer_uploads_total',
+                                             server='nginx'))
+
+
+class ResumableTestCase(TestCase):
+    data = b'0123456789'
+
+    def setUp(self):
+        super(ResumableTestCase, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        settings = Settings(django_transfer.conf.settings, DEBUG=False,
+                            TRANSFER_SERVER='nginx',
+                            TRANSFER_RESUMABLE_UPLOADS={'root': self.root})
+        settings.__enter__()
+        self.addCleanup(settings.__exit__)
+        self.middleware = TransferMiddleware(lambda r: None)
+        self.view = resumable_upload(lambda request: None)
+
+    def receive(self, request):
+        self.middleware.process_request(request)
+        return self.view(request)
+
+    def send(self, first, last, session='abc', total=None):
+        chunk = make_tempfile(self.data[first:last + 1].decode())
+        request = RequestFactory().post('/upload/', {
+            'file[filename]': 'foo.bin',
+            'file[path]': chunk,
+            'file[size]': str(last - first + 1),
+            'file[content_type]': 'application/octet-stream',
+        }, HTTP_SESSION_ID=session, HTTP_X_CONTENT_RANGE='bytes %d-%d/%d' % (
+            first, last, len(self.data) if total is None else total))
+        return self.receive(request), request, chunk
+
+    def assertProgress(self, progress, response):
+        self.assertEqual(201, response.status_code)
+        self.assertEqual(progress, response['Range'])
+        self.assertEqual(progress.encode(), response.content)
+
+    def assertComplete(self, response, request):
+        self.assertEqual(None, response)
+        upload = request.FILES['file']
+        self.assertTrue(isinstance(upload, ProxyUploadedFile))
+        self.assertEqual('foo.bin', upload.name)
+        self.assertEqual(10, upload.size)
+        self.assertEqual(self.data, upload.read())
+        upload.close()
+        # Nothing is left behind but the file.
+        self.assertEqual(['abc.part', 'index.sqlite3'],
+                         sorted(os.listdir(self.root)))
+
+    def test_in_order(self):
+        response, request, chunk = self.send(0, 3)
+        self.assertProgress('0-3/10', response)
+        # The first chunk is moved into place.
+        self.assertFalse(os.path.exists(chunk))
+        self.assertProgress('0-6/10', self.send(4, 6)[0])
+        self.assertEqual((7, 10), django_transfer.get_config().resumable
+                         .status('abc'))
+        response, request, chunk = self.send(7, 9)
+        self.assertComplete(response, request)
+        self.assertFalse(os.path.exists(chunk))
+
+    def test_out_of_order(self):
+        self.assertProgress('*/10', self.send(7, 9)[0])
+        self.assertProgress('*/10', self.send(4, 6)[0])
+        # Sent again, it is discarded once the gap is filled.
+        self.assertProgress('*/10', self.send(5, 9)[0])
+        self.assertComplete(*self.send(0, 3)[:2])
+
+    def test_overlap(self):
+        "Only the bytes not received yet are appended."
+        self.assertProgress('0-5/10', self.send(0, 5)[0])
+        self.assertProgress('0-5/10', self.send(0, 2)[0])
+        self.assertComplete(*self.send(3, 9)[:2])
+
+    def test_no_reread(self):
+        "Earlier chunks are never read again."
+        self.send(0, 3)
+        offsets = []
+        append_file = files.append_file
+
+        def record(src, dst, offset=0):
+            offsets.append(offset)
+            return append_file(src, dst, offset)
+
+        with Patch(django_transfer.resumable, append_file=record):
+            self.send(2, 6)
+            self.send(7, 9)
+        self.assertEqual([2, 0], offsets)
+
+    def test_concurrent(self):
+        "The index isn't locked while appending, other uploads go on."
+        self.send(0, 3)
+        appending, done = threading.Event(), threading.Event()
+        append_file = files.append_file
+        results = []
+
+        def slow(src, dst, offset=0):
+            appending.set()
+            done.wait(30)
+            return append_file(src, dst, offset)
+
+        with Patch(django_transfer.resumable, append_file=slow):
+            thread = threading.Thread(
+                target=lambda: results.append(self.send(4, 9)[:2]))
+            thread.start()
+            try:
+                self.assertTrue(appending.wait(5))
+                self.assertProgress('0-3/10',
+                                    self.send(0, 3, session='def')[0])
+            finally:
+                done.set()
+                thread.join()
+        response, request = results[0]
+        self.assertEqual(None, response)
+        self.assertEqual(self.data, request.FILES['file'].read())
+        request.FILES['file'].close()
+
+    def test_abandoned_claim(self):
+        "Files claimed by a request that died are claimed again."
+        resumable = django_transfer.get_config().resumable
+        self.assertEqual(0, resumable.claim('abc', 10, 'dead'))
+        with Patch(django_transfer.resumable, CLAIM_TIMEOUT=-1):
+            self.assertProgress('0-3/10', self.send(0, 3)[0])
+
+    def test_invalid(self):
+        for kwargs in ({'session': '../x'}, {'total': 3}):
+            self.assertEqual(400, self.send(0, 3, **kwargs)[0].status_code)
+        self.send(0, 3)
+        # The total can't change.
+        self.assertEqual(400, self.send(4, 6, total=20)[0].status_code)
+
+    def test_not_stored(self):
+        "Chunks sent as regular files, not stored by nginx, are refused."
+        t = make_tempfile('0123')
+        with open(t, 'rb') as f:
+            request = RequestFactory().post(
+                '/upload/', {'file': f}, HTTP_SESSION_ID='abc',
+                HTTP_X_CONTENT_RANGE='bytes 0-3/10')
+        self.assertEqual(400, self.receive(request).status_code)
+        self.assertEqual(None, django_transfer.get_config().resumable
+                         .status('abc'))
+
+    def test_purge(self):
+        resumable = ResumableUploads(self.root)
+        self.send(0, 3)
+        self.send(7, 9)
+        self.assertEqual(0, resumable.purge(60))
+        self.assertEqual(1, resumable.purge(-1))
+        self.assertEqual(['index.sqlite3'], os.listdir(self.root))
+        self.assertEqual(None, resumable.status('abc'))
+
+    def test_purge_complete(self):
+        "Complete files the view left in root are purged too."
+        resumable = ResumableUploads(self.root)
+        self.assertComplete(*self.send(0, 9)[:2])
+        self.send(0, 3, session='def')
+        self.assertEqual(0, resumable.purge(60))
+        self.assertEqual(2, resumable.purge(-1))
+        self.assertEqual(['index.sqlite3'], os.listdir(self.root))
+
+    def test_session_only(self):
+        "Requests without X-Content-Range are not chunks."
+        chunk = make_tempfile('foo')
+        request = RequestFactory().post('/upload/', {
+            'file[filename]': 'foo.bin',
+            'file[path]': chunk,
+        }, HTTP_SESSION_ID='abc')
+        self.assertEqual(None, self.receive(request))
+        self.assertEqual(chunk, request.FILES['file'].path)
+        self.assertEqual(None, django_transfer.get_config().resumable
+                         .status('abc'))
+
+    def test_middleware_only(self):
+        "Views that are not decorated receive chunks as regular uploads."
+        self.view = lambda request: None
+        response, request, chunk = self.send(0, 3)
+        self.assertEqual(None, response)
+        self.assertEqual(chunk, request.FILES['file'].path)
+        self.assertEqual(None, django_transfer.get_config().resumable
+                         .status('abc'))
+
+    def test_rejected(self):
+        "Chunks are not accepted when an outer decorator rejects them."
+        def login_required(view):
+            def wrapper(request):
+                return HttpResponseForbidden()
+            return wrapper
+
+        self.view = login_required(self.view)
+        self.assertEqual(403, self.send(0, 3)[0].status_code)
+        self.assertEqual(None, django_transfer.get_config().resumable
+                         .status('abc'))
+
+
+class RawBodyTestCase(TestCase):
+    def setUp(self):
+        super(RawBodyTestCase, self).setUp()
+        self.path = make_tempfile('{"foo": "bar"}')
+
+    def send(self, method='patch', path='/upload/', **kwargs):
+        kwargs.setdefault('HTTP_X_FILE', self.path)
+        request = getattr(RequestFactory(), method)(
+            path, b'', content_type='application/json; charset=utf-8',
+            **kwargs)
+        with Settings(settings, DEBUG=False, TRANSFER_SERVER='nginx',
+                      TRANSFER_UPLOAD_FILE_HEADER='X-File'):
+            TransferMiddleware(lambda r: None).process_request(request)
+        return request
+
+    def test_body(self):
+        request = self.send(
+            HTTP_CONTENT_DISPOSITION='attachment; filename="data.json"')
+        upload = request.FILES['file']
+        self.assertTrue(isinstance(upload, ProxyUploadedFile))
+        self.assertEqual(self.path, upload.path)
+        self.assertEqual('data.json', upload.name)
+        self.assertEqual('application/json', upload.content_type)
+        self.assertEqual(14, upload.size)
+        self.assertEqual(0, len(request.POST))
+        # The body was never parsed.
+        self.assertFalse(hasattr(request, '_body'))
+
+    def test_name(self):
+        "Without Content-Disposition, the name comes from the URL."
+        self.assertEqual('upload', self.send().FILES['file'].name)
+
+    def test_rules(self):
+        "ACL and methods apply as for forms."
+        for request in (self.send(method='put'),
+                        self.send(path='/download/')):
+            self.assertFalse(hasattr(request, '_files'))
+
+    def test_disabled(self):
+        request = RequestFactory().patch('/upload/', b'', HTTP_X_FILE=self.path)
+        with Settings(settings, DEBUG=False, TRANSFER_SERVER='nginx'):
+            TransferMiddleware(lambda r: None).process_request(request)
+        self.assertEqual(0, len(request.FILES))
+
+    def test_temp_dir(self):
+        with Settings(settings, TRANSFER_UPLOAD_TEMP_DIR=os.path.dirname(
+                self.path)):
+            self.assertEqual(self.path, self.send().FILES['file'].path)
+            self.assertRaises(SuspiciousOperation, self.send,
+                              HTTP_X_FILE='/etc/passwd')
+            self.assertRaises(SuspiciousOperation, self.send,
+                              HTTP_X_FILE=os.path.dirname(self.path) +
+                              '/../etc/passwd')
+
+
+class ParserTestCase(TestCase):
+    def request(self, method, data, content_type=MULTIPART + '; boundary=XyZ',
+                encode=True):
+        if encode:
+            data = encode_multipart('XyZ', data)
+        return getattr(RequestFactory(), method)('/upload/', data,
+                                                 content_type=content_type)
+
+    def test_fields(self):
+        data = {
+            'file[filename]': ['foo.png', 'bar.png'],
+            'file[path]': ['/tmp/1', '/tmp/2'],
+            'field': 'value \u00e9',
+        }
+        for method in ('post', 'put', 'patch'):
+            request = self.request(method, data)
+            load_form(request)
+            self.assertEqual(['foo.png', 'bar.png'],
+                             request.POST.getlist('file[filename]'))
+            self.assertEqual('/tmp/2', request.POST['file[path]'])
+            self.assertEqual('value \u00e9', request.POST['field'])
+            self.assertFalse(request.POST._mutable)
+            self.assertEqual(0, len(request.FILES))
+
+    def test_quoted_name(self):
+        body = (b'--XyZ\r\nContent-Disposition: form-data; '
+                b'name="a\\"b;c"\r\n\r\nvalue\r\n--XyZ--\r\n')
+        post = parse_multipart_fields(body, b'XyZ', 'utf-8')
+        self.assertEqual({'a"b;c': ['value']}, dict(post.lists()))
+
+    def test_urlencoded(self):
+        request = self.request('patch', 'file%5Bpath%5D=%2Ftmp%2F1&a=b',
+                               content_type='application/x-www-form-'
+                                            'urlencoded', encode=False)
+        load_form(request)
+        self.assertEqual('/tmp/1', request.POST['file[path]'])
+
+    def test_files(self):
+        "Bodies with real files are parsed by Django, even for PUT."
+        t = make_tempfile('foo')
+        for method in ('post', 'put'):
+            with open(t, 'rb') as f:
+                request = self.request(method, {'file': f, 'a': 'b'})
+            load_form(request)
+            self.assertEqual(b'foo', request.FILES['file'].read())
+            self.assertEqual('b', request.POST['a'])
+
+    def test_large_body(self):
+        "Large bodies are not read into memory by the fast path."
+        with Settings(settings, FILE_UPLOAD_MAX_MEMORY_SIZE=10):
+            request = self.request('post', {'a': 'b'})
+            load_form(request)
+            self.assertFalse(hasattr(request, '_body'))
+            self.assertEqual('b', request.POST['a'])
+
+    @skipIf(django.VERSION[:2] < (1, 10), 'no DATA_UPLOAD_MAX_MEMORY_SIZE')
+    def test_data_limit(self):
+        "Files over DATA_UPLOAD_MAX_MEMORY_SIZE are accepted, as by Django."
+        t = make_tempfile('x' * 3000)
+        with Settings(settings, FILE_UPLOAD_MAX_MEMORY_SIZE=10000,
+                      DATA_UPLOAD_MAX_MEMORY_SIZE=1000):
+            with open(t, 'rb') as f:
+                request = self.request('post', {'file': f, 'a': 'b'})
+            load_form(request)
+            self.assertFalse(hasattr(request, '_body'))
+            self.assertEqual(3000, len(request.FILES['file'].read()))
+            self.assertEqual('b', request.POST['a'])
+
+    def test_invalid(self):
+        request = self.request('put', b'--XyZ\r\ngarbage', encode=False)
+        self.assertRaises(MultiPartParserError, load_form, request)
+
+    @skipIf(django.VERSION[:2] < (1, 10), 'no DATA_UPLOAD_MAX_NUMBER_FIELDS')
+    def test_too_many_fields(self):
+        from django.core.exceptions import TooManyFieldsSent
+        with Settings(settings, DATA_UPLOAD_MAX_NUMBER_FIELDS=2):
+            request = self.request('post', {'a': ['1', '2', '3']})
+            self.assertRaises(TooManyFieldsSent, load_form, request)
+
+    def test_middleware_put(self):
+        "Uploads via PUT are promoted without changing request.method."
+        t = make_tempfile()
+        data = encode_multipart('XyZ', {
+            'file[filename]': 'foobar.png',
+            'file[path]': t,
+        })
+        with Settings(settings, DEBUG=False, TRANSFER_SERVER='nginx',
+                      TRANSFER_UPLOAD_METHODS=('POST', 'PUT')):
+            r = Client().put('/upload/', data,
+                             content_type=MULTIPART + '; boundary=XyZ')
+        r = json.loads(r.content.decode())
+        self.assertEqual(os.getpid(), int(r['files']['file']['data']))
+
+
+class ArchiveTestCase(TestCase):
+    def setUp(self):
+        super(ArchiveTestCase, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.paths = []
+        for name, data in (('a.txt', 'foo'), ('b.txt', ''), ('c.txt', 'bar')):
+            path = os.path.join(self.dir, name)
+            with open(path, 'w') as f:
+                f.write(data)
+            self.paths.append(path)
+        self.files = [self.paths[0], (self.paths[1], 'dir/b.txt'),
+                      (self.paths[2], '\xe9t\xe9.txt')]
+
+    def get_zip(self, response):
+        content = b''.join(response.streaming_content)
+        self.assertEqual(str(len(content)), response['Content-Length'])
+        z = zipfile.ZipFile(six.BytesIO(content))
+        self.assertEqual(None, z.testzip())
+        return z
+
+    def test_stream(self):
+        with Settings(settings, DEBUG=True):
+            r = TransferZipResponse(self.files)
+        self.assertEqual('application/zip', r['Content-Type'])
+        z = self.get_zip(r)
+        self.assertEqual(['a.txt', 'dir/b.txt', '\xe9t\xe9.txt'],
+                         z.namelist())
+        self.assertEqual(b'foo', z.read('a.txt'))
+        self.assertEqual(b'bar', z.read('\xe9t\xe9.txt'))
+        self.assertEqual(zipfile.ZIP_STORED, z.getinfo('a.txt').compress_type)
+
+    def test_zip64(self):
+        "ZIP64 records are used past the limits."
+        with Patch(archive, ZIP64_LIMIT=2, ZIP_FILECOUNT_LIMIT=2):
+            with Settings(settings, DEBUG=True):
+                r = TransferZipResponse(self.files)
+            z = self.get_zip(r)
+        self.assertEqual(b'foo', z.read('a.txt'))
+        self.assertEqual(b'', z.read('dir/b.txt'))
+        self.assertEqual(b'bar', z.read('\xe9t\xe9.txt'))
+
+    @skipIf(six.PY2, 'no tracemalloc')
+    def test_memory(self):
+        "Memory use does not grow with the size of the archive."
+        import tracemalloc
+        size, count = 64 * 1024, 3000
+        paths = [make_sparse_file(os.path.join(self.dir, '%d.bin' % i), size)
+                 for i in range(count)]
+        tracemalloc.start()
+        try:
+            with Settings(settings, DEBUG=True):
+                r = TransferZipResponse(paths)
+            length = sum(len(chunk) for chunk in r.streaming_content)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertTrue(length > size * count)
+        self.assertTrue(peak < 8 * 1024 * 1024, peak)
+
+    def test_nginx(self):
+        "nginx gets a mod_zip manifest of the mapped locations."
+        with Settings(settings, DEBUG=False, TRANSFER_SERVER='nginx',
+                      TRANSFER_MAPPINGS={self.dir: '/downloads'}):
+            r = TransferZipResponse(self.files)
+        self.assertEqual('zip', r['X-Archive-Files'])
+        self.assertFalse(r.has_header('Content-Length'))
+        self.assertEqual(
+            '- 3 /downloads/a.txt a.txt\n'
+            '- 0 /downloads/b.txt dir/b.txt\n'
+            '- 3 /downloads/c.txt \xe9t\xe9.txt\n', get_content(r))
+
+    def test_nginx_unmapped(self):
+        with Settings(settings, DEBUG=False, TRANSFER_SERVER='nginx',
+                      TRANSFER_MAPPINGS={'/foo': '/downloads'}):
+            try:
+                TransferZipResponse(self.files)
+            except ImproperlyConfigured as e:
+                # All of them are reported.
+                self.assertTrue(all(path in str(e) for path in self.paths))
+            else:
+                self.fail('ImproperlyConfigured not raised')
+
+
+def make_sparse_file(path, size):
+    with open(path, 'wb') as f:
+        f.truncate(size)
+    return path
+
+
+class NoAsyncTestCase(TestCase):
+    def test_import(self):
+        "The package works where django_transfer.asgi can't be imported."
+        code = (
+            'import sys\n'
+            'sys.modules["django_transfer.asgi"] = None\n'
+            'import django\n'
+            'django.setup()\n'
+            'from django_transfer import TransferMiddleware\n'
+            'TransferMiddleware(lambda request: None)\n'
+        )
+        env = dict(os.environ,
+                   DJANGO_SETTINGS_MODULE='django_transfer.settings')
+        process = subprocess.Popen([sys.executable, '-c', code], env=env,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        self.assertEqual(0, process.returncode, output)
+
+
+@skipIf(asgi is None, 'no ASGI support')
+class AsyncTestCase(TestCase):
+    def setUp(self):
+        super(AsyncTestCase, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+
+    def run_async(self, awaitable):
+        return self.loop.run_until_complete(awaitable)
+
+    def consume(self, iterator):
+        "Collects the chunks of an async iterator."
+        chunks, iterator = [], iterator.__aiter__()
+        while True:
+            try:
+                chunks.append(self.run_async(iterator.__anext__()))
+            except StopAsyncIteration:
+                return chunks
+
+    def get_middleware(self):
+        from django.http import HttpResponse
+        return TransferMiddleware(sync_to_async(lambda r: HttpResponse()))
+
+    def test_middleware_passthrough(self):
+        "Requests that can't carry uploads stay in the event loop."
+        middleware = self.get_middleware()
+        calls = []
+        middleware.process_request = calls.append
+        with Settings(settings, DEBUG=False, TRANSFER_SERVER='nginx'):
+            for request in (AsyncRequestFactory().get('/upload/'),
+                            AsyncRequestFactory().post('/other/')):
+                response = self.run_async(middleware(request))
+                self.assertEqual(200, response.status_code)
+        self.assertEqual([], calls)
+
+    def test_middleware_upload(self):
+        t = make_tempfile()
+        data = encode_multipart('XyZ', {
+            'file[filename]': 'foobar.png',
+            'file[path]': t,
+        })
+        request = AsyncRequestFactory().post(
+            '/upload/', data, content_type=MULTIPART + '; boundary=XyZ')
+        with Settings(settings, DEBUG=False, TRANSFER_SERVER='nginx'):
+            self.run_async(self.get_middleware()(request))
+        self.assertEqual(t, request.FILES['file'].path)
+
+    def test_iterator(self):
+        "Async iteration reads the file outside of the event loop."
+        t = make_tempfile('0123456789')
+        threads = []
+
+        class File(object):
+            def __init__(self):
+                self.file = open(t, 'rb')
+                self.seek, self.close = self.file.seek, self.file.close
+
+            def read(self, size):
+                threads.append(threading.current_thread())
+                return self.file.read(size)
+
+        iterator = asgi.AsyncFileIterator(File(), 4, 1, 7)
+        self.assertEqual([b'1234', b'567'], self.consume(iterator))
+        iterator.close()
+        self.assertTrue(threads)
+        self.assertFalse(threading.current_thread() in threads)
+
+    def test_response(self):
+        "Fallback downloads for ASGI requests iterate asynchronously."
+        t = make_tempfile('0123456789')
+        request = AsyncRequestFactory().get('/download/')
+        request.META['HTTP_RANGE'] = 'bytes=0-0,2-3'
+        with Settings(settings, DEBUG=True):
+            r = TransferHttpResponse(t, request=request)
+        self.assertEqual(206, r.status_code)
+        self.assertTrue(isinstance(r.file_iterator,
+                                   asgi.AsyncMultipartFileIterator))
+        self.assertTrue(b'23' in b''.join(self.consume(r.file_iterator)))
+        r.close()
+        with Settings(settings, DEBUG=True):
+            r = TransferHttpResponse(t, request=RequestFactory().get(
+                '/download/'))
+        self.assertFalse(hasattr(r.file_iterator, '__aiter__'))
+        r.close()
+
+    def serve(self, *extensions, **headers):
+        "Serves a request with TransferASGIHandler, returns the messages."
+        requests, messages = asyncio.Queue(), asyncio.Queue()
+        requests.put_nowait({'type': 'http.request', 'body': b''})
+        scope = {
+            'type': 'http',
+            'method': 'GET',
+            'path': '/download/',
+            'query_string': b'',
+            'headers': [(b'host', b'testserver')] + [
+                (name.encode(), value.encode())
+                for name, value in headers.items()],
+            'extensions': dict((name, {}) for name in extensions),
+        }
+        with Settings(settings, DEBUG=True, TRANSFER_CHUNK_SIZE=2):
+            self.run_async(asgi.TransferASGIHandler()(scope, requests.get,
+                                                      messages.put))
+        start = messages.get_nowait()
+        self.assertEqual('http.response.start', start['type'])
+        result = [start]
+        while not messages.empty():
+            result.append(messages.get_nowait())
+        return result
+
+    def test_handler(self):
+        "TransferASGIHandler sends fallback downloads chunk by chunk."
+        messages = self.serve()
+        self.assertEqual(200, messages[0]['status'])
+        body = [message.get('body', b'') for message in messages[1:]]
+        self.assertEqual(str(os.getpid()).encode(), b''.join(body))
+        self.assertTrue(all(len(chunk) <= 2 for chunk in body))
+
+    def test_zerocopy(self):
+        "The file is handed to servers supporting zero-copy send."
+        messages = self.serve(asgi.ZEROCOPY_SEND)
+        self.assertEqual(2, len(messages))
+        message = messages[1]
+        self.assertEqual(asgi.ZEROCOPY_SEND, message['type'])
+        self.assertEqual(0, message['offset'])
+        self.assertFalse('count' in message)
+        self.assertFalse(message['more_body'])
+        # Closed once sent.
+        self.assertTrue(message['file'].closed)
+        with open(message['file'].name) as f:
+            self.assertEqual(os.getpid(), int(f.read()))
+
+    def test_zerocopy_ranges(self):
+        # The file holds the PID, keep within its shortest length.
+        messages = self.serve(asgi.ZEROCOPY_SEND, range='bytes=0-0,2-2')
+        self.assertEqual(206, messages[0]['status'])
+        types = [message['type'] for message in messages[1:]]
+        self.assertEqual(['http.response.body', asgi.ZEROCOPY_SEND] * 2 +
+                         ['http.response.body'], types)
+        self.assertEqual([(0, 1), (2, 1)], [
+            (message['offset'], message['count'])
+            for message in messages[1:] if message['type'] != types[0]])
+        self.assertEqual([True] * 4 + [False],
+                         [message['more_body'] for message in messages[1:]])
+
+
+class ProxyTestCase(TestCase):
+    "End to end, over HTTP, through the stand-in proxy."
+    def setUp(self):
+        super(ProxyTestCase, self).setUp()
+        self.store = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.store)
+        # Requests don't come from the test client, CSRF checks would apply.
+        middleware = [name for name in settings.MIDDLEWARE
+                      if 'csrf' not in name]
+        patch = Settings(settings, DEBUG=False, TRANSFER_SERVER='nginx',
+                         TRANSFER_MAPPINGS={gettempdir(): '/protected'},
+                         ALLOWED_HOSTS=['127.0.0.1'], MIDDLEWARE=middleware)
+        patch.__enter__()
+        self.addCleanup(patch.__exit__)
+
+    def serve(self, **options):
+        server = ProxyServer(WSGIHandler(), upload_store=self.store,
+                             **options).start()
+        self.addCleanup(server.stop)
+        return server
+
+    def download(self, server):
+        response = six.moves.urllib.request.urlopen(server.url + '/download/')
+        try:
+            return response.read().decode(), response.info()
+        finally:
+            response.close()
+
+    def test_offload(self):
+        server = self.serve()
+        for name in ('nginx', 'apache', 'lighttpd'):
+            with Settings(settings, TRANSFER_SERVER=name):
+                body, headers = self.download(server)
+            self.assertEqual(six.text_type(os.getpid()), body)
+            self.assertEqual(len(body), int(headers['Content-Length']))
+            for header in SERVER_HEADERS.values():
+                self.assertFalse(header in headers)
+        self.assertEqual(3, server.proxy.offloaded)
+
+    def test_fallback(self):
+        server = self.serve()
+        with Settings(settings, DEBUG=True):
+            body, headers = self.download(server)
+        self.assertEqual(six.text_type(os.getpid()), body)
+        self.assertEqual(0, server.proxy.offloaded)
+        self.assertEqual(1, server.proxy.requests)
+
+    def test_unmapped(self):
+        server = self.serve(mappings={})
+        try:
+            self.download(server)
+        except six.moves.urllib.error.HTTPError as e:
+            self.assertEqual(404, e.code)
+        else:
+            self.fail('Unmapped file was sent')
+
+    def post(self, server, host=None):
+        boundary = 'ProxyTestBoundary'
+        f = six.BytesIO(b'foobar')
+        f.name = 'foo.txt'
+        request = six.moves.urllib.request.Request(
+            server.url + '/upload/',
+            encode_multipart(boundary, {'file': f, 'name': 'bar'}),
+            {'Content-Type': 'multipart/form-data; boundary=%s' % boundary})
+        if host:
+            request.add_header('Host', host)
+        response = six.moves.urllib.request.urlopen(request)
+        try:
+            return json.loads(response.read().decode())
+        finally:
+            response.close()
+
+    def test_upload(self):
+        server = self.serve(checksums=('md5',))
+        echo = self.post(server)
+        self.assertEqual({'name': 'bar'}, echo['fields'])
+        self.assertEqual('foobar', echo['files']['file']['data'])
+        self.assertEqual('foo.txt', echo['files']['file']['path'])
+        self.assertEqual(6, echo['files']['file']['size'])
+        # The view left the file where the proxy stored it.
+        self.assertEqual(1, len(os.listdir(self.store)))
+
+    def test_upload_cleanup(self):
+        server = self.serve()
+        try:
+            self.post(server, host='example.com')
+        except six.moves.urllib.error.HTTPError as e:
+            self.assertEqual(400, e.code)
+        else:
+            self.fail('Disallowed host was accepted')
+        self.assertEqual([], os.listdir(self.store))
+
+
+class BenchmarkTestCase(TestCase):
+    def run_command(self, *args):
+        stdout = six.StringIO()
+        call_command('transfer_benchmark', *args, stdout=stdout,
+                     stderr=six.StringIO())
+        return stdout.getvalue()
+
+    def test_json(self):
+        data = json.loads(self.run_command('mime', '--json'))
+        self.assertEqual(['mime guess_type', 'mime resolver'],
+                         [result['name'] for result in data['results']])
+        self.assertTrue(all(result['unit'] == 'us/op' and result['value'] > 0
+                            for result in data['results']))
+        self.assertEqual(django.get_version(), data['django'])
+
+    def test_compare(self):
+        path = os.path.join(tempfile.mkdtemp(), 'baseline.json')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        self.run_command('mime', '--output', path)
+        with open(path) as f:
+            baseline = json.load(f)
+        for result in baseline['results']:
+            result['value'] *= 2
+        baseline['results'].append(
+            {'name': 'gone', 'value': 1.0, 'unit': 'us/op'})
+        with open(path, 'w') as f:
+            json.dump(baseline, f)
+        output = self.run_command('mime', '--compare', path)
+        self.assertTrue(re.search(r'mime resolver .*%', output))
+        self.assertFalse('gone' in output)
+
+    def test_list(self):
+        output = self.run_command('--list').split()
+        self.assertEqual([func.__name__ for func in benchmarks.BENCHMARKS],
+                         output)
+        self.assertTrue('downloads' in output)
+        self.assertTrue('middleware' in output)
+
+    def test_unknown(self):
+        self.assertRaises(CommandError, self.run_command, 'nonexistent')
+
+    def test_settings_restored(self):
+        server = settings.TRANSFER_SERVER
+        with Settings(settings, DEBUG=True):
+            self.run_command('bulk')
+            self.assertTrue(settings.DEBUG)
+        self.assertEqual(server, settings.TRANSFER_SERVER)
+        self.assertEqual(server, get_config().server)
+        self.assertFalse(hasattr(settings, 'TRANSFER_MAPPINGS'))
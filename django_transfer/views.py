@@ -19,7 +19,7 @@ def make_tempfile(data=None):
 
 
 def download(request):
-    return TransferHttpResponse(make_tempfile())
+    return TransferHttpResponse(make_tempfile(), request=request)
 
 
 def upload(request):
@@ -25,6 +25,8 @@ setup(
     ],
     packages = [
         "django_transfer",
+        "django_transfer.management",
+        "django_transfer.management.commands",
     ],
     classifiers = (
           'Development Status :: 4 - Beta',